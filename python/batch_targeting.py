@@ -0,0 +1,172 @@
+"""Vectorized targeting for many searchlights and many targets at once."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import numpy
+
+import searchlight as searchlight_lib
+from searchlight import AZIMUTH_CHANNEL
+from searchlight import ELEVATION_CHANNEL
+from searchlight import SEARCHLIGHT_NAME_ALL
+
+
+def clamp_and_scale(value, min_value, max_value, scaled_min, scaled_max):
+  """Like searchlight.clamp_and_scale, but for NumPy arrays."""
+  value = numpy.clip(value, min_value, max_value)
+  return (scaled_max - scaled_min) * (value - min_value) / (max_value - min_value) + scaled_min
+
+
+def _column(values):
+  """Returns values as a float array of shape (len(values), 1), to broadcast against targets."""
+  return numpy.array(values, dtype=float).reshape(-1, 1)
+
+
+class SearchlightArray(object):
+  """Computes angles and motor positions for several searchlights using NumPy.
+
+  This performs the same calculation as Searchlight.target_position and Searchlight.target_angle,
+  for every searchlight and every target in one vectorized call. Target arrays are broadcast
+  against an array of shape (number of searchlights, 1), so pass 1-D arrays to aim every
+  searchlight at every target, or arrays of shape (number of searchlights, 1) to give each
+  searchlight its own target.
+  """
+
+  def __init__(self, searchlights):
+    """Initializes a SearchlightArray.
+
+    Args:
+      searchlights: A list of searchlight.Searchlight instances. Each must have a position and
+        zero_position.
+    """
+    self.searchlights = searchlights
+    self.pos_lat = _column([s.pos_lat for s in searchlights])
+    self.pos_lon = _column([s.pos_lon for s in searchlights])
+    self.meters_per_degree_lon = _column([s.meters_per_degree_lon for s in searchlights])
+    self.zero_east = _column([s.zero_east for s in searchlights])
+    self.zero_north = _column([s.zero_north for s in searchlights])
+
+    self.direct = numpy.array(
+        [s.positioning_mode == searchlight_lib.POSITIONING_MODE_DIRECT for s in searchlights]
+        ).reshape(-1, 1)
+    positionings = [
+        s.direct_positioning if s.positioning_mode == searchlight_lib.POSITIONING_MODE_DIRECT
+        else s.mirror_positioning for s in searchlights]
+    self.azimuth_degrees_min, self.azimuth_degrees_max = (
+        _column(bounds) for bounds in zip(*[p['azimuth_angle_bound'] for p in positionings]))
+    self.elevation_degrees_min, self.elevation_degrees_max = (
+        _column(bounds) for bounds in zip(*[p['elevation_angle_bound'] for p in positionings]))
+    self.degrees_at_zero = _column([p.get('degrees_at_zero_position', 0) for p in positionings])
+    # The motor bounds may be changed over OSC, so they are read again whenever a config is
+    # committed.
+    self.refresh_motor_bounds()
+    config_stores = []
+    for searchlight in searchlights:
+      if searchlight.config_store not in config_stores:
+        config_stores.append(searchlight.config_store)
+        searchlight.config_store.add_commit_callback(self.refresh_motor_bounds)
+
+  def refresh_motor_bounds(self):
+    """Reads the configured motor bounds of each searchlight into columns."""
+    # Only direct mode applies the configured motor bounds; scaling to (-1, 1) leaves mirror mode
+    # positions unchanged.
+    motor_bounds = []
+    for searchlight, direct in zip(self.searchlights, self.direct.flat):
+      config = searchlight.config
+      if direct:
+        motor_bounds.append((config.azimuth_lower_bound, config.azimuth_upper_bound,
+                             config.elevation_lower_bound, config.elevation_upper_bound))
+      else:
+        motor_bounds.append((-1, 1, -1, 1))
+    self.azimuth_lower, self.azimuth_upper, self.elevation_lower, self.elevation_upper = (
+        _column(bounds) for bounds in zip(*motor_bounds))
+
+  def angles(self, latitudes, longitudes, altitudes):
+    """Returns arrays (azimuth, elevation) of angles in radians, relative to zero."""
+    east = (numpy.asarray(longitudes) - self.pos_lon) * self.meters_per_degree_lon
+    north = (numpy.asarray(latitudes) - self.pos_lat) * searchlight_lib.METERS_PER_DEGREE_LATITUDE
+    forward = east * self.zero_east + north * self.zero_north
+    right = east * self.zero_north - north * self.zero_east
+    return (numpy.arctan2(right, forward),
+            numpy.arctan2(numpy.asarray(altitudes, dtype=float), numpy.hypot(east, north)))
+
+  def motor_positions_for_angles(self, azimuth, elevation):
+    """Returns arrays (azimuth, elevation) of motor positions for angles in radians."""
+    azimuth_degrees = numpy.degrees(azimuth)
+    elevation_degrees = numpy.degrees(elevation)
+    # In mirror mode, each degree of mirror rotation moves the beam by two degrees.
+    azimuth_degrees = numpy.where(
+        self.direct, azimuth_degrees, (self.degrees_at_zero + azimuth_degrees) / 2.0)
+    # TODO(robgaunt): Azimuth motor position is inverted because the controllers aren't set up
+    # right.
+    azimuth_positions = clamp_and_scale(
+        azimuth_degrees, self.azimuth_degrees_min, self.azimuth_degrees_max, 1, -1)
+    elevation_positions = clamp_and_scale(
+        elevation_degrees, self.elevation_degrees_min, self.elevation_degrees_max, -1, 1)
+    azimuth_positions = clamp_and_scale(
+        azimuth_positions, -1, 1, self.azimuth_lower, self.azimuth_upper)
+    elevation_positions = clamp_and_scale(
+        elevation_positions, -1, 1, self.elevation_lower, self.elevation_upper)
+    return azimuth_positions, elevation_positions
+
+  def motor_positions(self, latitudes, longitudes, altitudes):
+    """Returns arrays (azimuth, elevation) of motor positions to aim at the given targets."""
+    return self.motor_positions_for_angles(*self.angles(latitudes, longitudes, altitudes))
+
+
+class AllTargetGrid(object):
+  """Handles the target grid OSC addresses for "all" searchlights with a single calculation.
+
+  This overrides the per-searchlight callbacks for /all/target_grid and /all/target_grid_elevation.
+  It transforms the grid touch through every searchlight's target grid and aims them all at once.
+  """
+
+  def __init__(self, searchlights, osc_dispatcher):
+    """Initializes an AllTargetGrid.
+
+    Args:
+      searchlights: A list of searchlight.Searchlight instances which have a target grid.
+      osc_dispatcher: An instance of osc_server.OscDispatcher.
+    """
+    self.searchlights = searchlights
+    self.searchlight_array = SearchlightArray(searchlights)
+    grids = [s.target_grid for s in searchlights]
+    # TargetGrid.transform is affine: target = origin + x * x_axis + y * y_axis.
+    self.origin_lat = _column([g.ul_lat for g in grids])
+    self.origin_lon = _column([g.ul_lon for g in grids])
+    self.x_axis_lat = _column([g.ll_lat - g.ul_lat for g in grids])
+    self.x_axis_lon = _column([g.ll_lon - g.ul_lon for g in grids])
+    self.y_axis_lat = _column([g.ur_lat - g.ul_lat for g in grids])
+    self.y_axis_lon = _column([g.ur_lon - g.ul_lon for g in grids])
+    osc_dispatcher.add_callback(
+        '/%s/%s' % (SEARCHLIGHT_NAME_ALL, 'target_grid'), self.osc_target_grid)
+    osc_dispatcher.add_callback(
+        '/%s/%s' % (SEARCHLIGHT_NAME_ALL, 'target_grid_elevation'),
+        self.osc_target_grid_elevation)
+
+  def osc_target_grid(self, y, x):
+    assert 0 <= x and x <= 1, 'Invalid osc_target_grid x: %s' % x
+    assert 0 <= y and y <= 1, 'Invalid osc_target_grid y: %s' % y
+    latitudes = self.origin_lat + x * self.x_axis_lat + y * self.y_axis_lat
+    longitudes = self.origin_lon + x * self.x_axis_lon + y * self.y_axis_lon
+    for searchlight, latitude, longitude in zip(
+        self.searchlights, latitudes.flat, longitudes.flat):
+      searchlight.last_target_lat = float(latitude)
+      searchlight.last_target_lon = float(longitude)
+    self.target_last_positions_(latitudes, longitudes)
+
+  def osc_target_grid_elevation(self, elevation):
+    assert 0 <= elevation and elevation <= 1, 'Invalid osc_target_grid_elevation: %s' % elevation
+    for searchlight in self.searchlights:
+      searchlight.last_elevation = elevation * searchlight_lib.MAX_ELEVATION
+    self.target_last_positions_(
+        _column([s.last_target_lat for s in self.searchlights]),
+        _column([s.last_target_lon for s in self.searchlights]))
+
+  def target_last_positions_(self, latitudes, longitudes):
+    azimuth_positions, elevation_positions = self.searchlight_array.motor_positions(
+        latitudes, longitudes, _column([s.last_elevation for s in self.searchlights]))
+    for searchlight, azimuth_position, elevation_position in zip(
+        self.searchlights, azimuth_positions.flat, elevation_positions.flat):
+      searchlight.set_motor_positions({
+          AZIMUTH_CHANNEL: float(azimuth_position),
+          ELEVATION_CHANNEL: float(elevation_position)})
@@ -0,0 +1,127 @@
+"""Tests for batch_targeting."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import unittest
+
+import numpy
+from twisted.internet import task
+
+from batch_targeting import AllTargetGrid
+from batch_targeting import SearchlightArray
+from motor_controller import MotorController
+from osc_server import OscDispatcher
+from searchlight import AZIMUTH_CHANNEL
+from searchlight import ELEVATION_CHANNEL
+from searchlight import Searchlight
+from searchlight_config import SearchlightConfigStore
+
+# From configs/searchlights_1_2.yaml.
+TARGET_GRID = {
+    'upper_left': [40.80075, -119.21187],
+    'upper_right': [40.78249, -119.18758],
+    'lower_left': [40.78990, -119.22544],
+}
+DIRECT_POSITIONING = {'azimuth_angle_bound': [-90, 90], 'elevation_angle_bound': [0, 90]}
+MIRROR_POSITIONING = {
+    'azimuth_angle_bound': [-90, 90], 'elevation_angle_bound': [0, 90],
+    'degrees_at_zero_position': 20,
+}
+TARGETS = (
+    numpy.array([40.7900, 40.7800, 40.8050, 40.7950, 40.7970]),
+    numpy.array([-119.2100, -119.1900, -119.2000, -119.2200, -119.1989]),
+    numpy.array([100, 500, 1000, 50, 20]),
+)
+
+
+class BatchTargetingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.config_store = SearchlightConfigStore.create_with_sqlite_database(':memory:')
+    self.config_store.create_config_table()
+    self.osc_dispatcher = OscDispatcher()
+    self.searchlights = [
+        self.create_searchlight('1', 'direct', (40.79704, -119.19889), (40.78639, -119.20647)),
+        self.create_searchlight('2', 'direct', (40.79500, -119.19500), (40.80000, -119.20000)),
+        self.create_searchlight('3', 'mirror', (40.79000, -119.21000), (40.78000, -119.20000)),
+    ]
+    config = self.searchlights[1].config
+    config.azimuth_lower_bound, config.azimuth_upper_bound = -0.5, 0.8
+    config.elevation_lower_bound, config.elevation_upper_bound = -0.2, 0.9
+    self.config_store.commit()
+    self.searchlight_array = SearchlightArray(self.searchlights)
+
+  def create_searchlight(self, name, positioning_mode, position, zero_position):
+    searchlight = Searchlight(
+        self.clock, MotorController(self.clock, '', 2), self.osc_dispatcher, self.config_store,
+        name, positioning_mode, position=position, zero_position=zero_position,
+        target_grid=TARGET_GRID, direct_positioning=DIRECT_POSITIONING,
+        mirror_positioning=MIRROR_POSITIONING)
+    searchlight.positions = []
+    searchlight.set_motor_positions = searchlight.positions.append
+    return searchlight
+
+  def scalar_motor_positions(self, searchlight, latitude, longitude, altitude):
+    searchlight.target_position(latitude, longitude, altitude)
+    positions = searchlight.positions.pop()
+    return positions[AZIMUTH_CHANNEL], positions[ELEVATION_CHANNEL]
+
+  def assertMatchesScalar(self, azimuth_positions, elevation_positions):
+    for index, searchlight in enumerate(self.searchlights):
+      for target_index, target in enumerate(zip(*TARGETS)):
+        azimuth, elevation = self.scalar_motor_positions(searchlight, *target)
+        self.assertAlmostEqual(azimuth, azimuth_positions[index, target_index], places=9)
+        self.assertAlmostEqual(elevation, elevation_positions[index, target_index], places=9)
+
+  def test_matches_scalar_targeting(self):
+    azimuth_positions, elevation_positions = self.searchlight_array.motor_positions(*TARGETS)
+    self.assertEqual((3, 5), azimuth_positions.shape)
+    self.assertMatchesScalar(azimuth_positions, elevation_positions)
+
+  def test_matches_scalar_angles(self):
+    azimuths, elevations = self.searchlight_array.angles(*TARGETS)
+    for index, searchlight in enumerate(self.searchlights):
+      angles = []
+      searchlight.target_angle = lambda azimuth, elevation: angles.append((azimuth, elevation))
+      for target_index, target in enumerate(zip(*TARGETS)):
+        searchlight.target_position(*target)
+        azimuth, elevation = angles.pop()
+        self.assertAlmostEqual(azimuth, azimuths[index, target_index])
+        self.assertAlmostEqual(elevation, elevations[index, target_index])
+
+  def test_one_target_per_searchlight(self):
+    latitudes, longitudes, altitudes = (values[:3].reshape(-1, 1) for values in TARGETS)
+    azimuth_positions, elevation_positions = self.searchlight_array.motor_positions(
+        latitudes, longitudes, altitudes)
+    self.assertEqual((3, 1), azimuth_positions.shape)
+    for index, searchlight in enumerate(self.searchlights):
+      azimuth, elevation = self.scalar_motor_positions(
+          searchlight, latitudes[index, 0], longitudes[index, 0], altitudes[index, 0])
+      self.assertAlmostEqual(azimuth, azimuth_positions[index, 0])
+      self.assertAlmostEqual(elevation, elevation_positions[index, 0])
+
+  def test_bounds_change_is_picked_up(self):
+    config = self.searchlights[0].config
+    config.azimuth_lower_bound, config.azimuth_upper_bound = -0.3, 0.3
+    config.elevation_lower_bound = 0.1
+    self.config_store.commit()
+    azimuth_positions, elevation_positions = self.searchlight_array.motor_positions(*TARGETS)
+    self.assertTrue(numpy.all(numpy.abs(azimuth_positions[0]) <= 0.3))
+    self.assertTrue(numpy.all(elevation_positions[0] >= 0.1))
+    self.assertMatchesScalar(azimuth_positions, elevation_positions)
+
+  def test_all_target_grid_matches_each_searchlight(self):
+    all_target_grid = AllTargetGrid(self.searchlights, self.osc_dispatcher)
+    all_target_grid.osc_target_grid_elevation(0.3)
+    all_target_grid.osc_target_grid(0.25, 0.75)
+    batch_positions = [searchlight.positions.pop() for searchlight in self.searchlights]
+    for searchlight, positions in zip(self.searchlights, batch_positions):
+      searchlight.osc_target_grid(0.25, 0.75)
+      expected_positions = searchlight.positions.pop()
+      for channel in (AZIMUTH_CHANNEL, ELEVATION_CHANNEL):
+        self.assertAlmostEqual(expected_positions[channel], positions[channel])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+"""Executable script which benchmarks the OSC to motor controller path.
+
+Synthetic OSC datagrams are fed through the real osc_server handler and dispatcher, Searchlight
+and MotorController classes, with simulated motor controllers. Time on the reactor is simulated
+with a twisted.internet.task.Clock, so runs are reproducible and the results measure only the cost
+of our own code. The benchmark is repeated for each number of searchlights given, and the results
+are written as JSON so they can be compared between versions.
+
+For each run, the results include:
+  messages_per_second: Datagrams processed per second of wall time.
+  cpu_microseconds_per_message: User and system CPU time per datagram.
+  latency_microseconds: Percentiles of the wall time from a datagram being received to the
+    resulting setpoint being written to the serial port. Setpoints which wait for a reply from
+    the simulated controller include the wall time spent processing later frames meanwhile.
+
+Example usage:
+  ./benchmark_main.py --num_searchlights 1 2 4 8 16 --frames 2000 --output results.json
+"""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import struct
+import sys
+import timeit
+
+import numpy
+from twisted.internet import task
+
+from motor_controller import MotorController
+from searchlight import Searchlight
+from searchlight_config import SearchlightConfigStore
+import logging_common
+import osc_server
+
+LATENCY_PERCENTILES = (50, 90, 99)
+BENCHMARK_CLIENT = ('benchmark', 0)
+SEARCHLIGHT_CONFIG = {
+    'positioning_mode': 'direct',
+    'draw_grid': {
+        'azimuth_angle_bound': [-45, 45],
+        'elevation_angle_bound': [35, 80],
+    },
+    'direct_positioning': {
+        'azimuth_angle_bound': [-90, 90],
+        'elevation_angle_bound': [0, 90],
+    },
+}
+
+
+def encode_message(address, values, base64_address=False):
+  """Returns an OSC message with float arguments, optionally with a base64 encoded address."""
+  if base64_address:
+    address = base64.b64encode(address)
+  address += '\x00' * (4 - len(address) % 4)
+  type_tag = ',' + 'f' * len(values)
+  type_tag += '\x00' * (4 - len(type_tag) % 4)
+  return address + type_tag + struct.pack('>%df' % len(values), *values)
+
+
+def cpu_seconds():
+  user, system = os.times()[:2]
+  return user + system
+
+
+class TimedOscDispatcher(osc_server.OscDispatcher):
+  """An OscDispatcher which notes when the datagram for each message it dispatches arrived."""
+
+  def __init__(self, groups=None):
+    osc_server.OscDispatcher.__init__(self, groups)
+    # Maps address to the time the newest datagram for that address was received.
+    self.arrival_times = {}
+    # The arrival time of the message currently being dispatched.
+    self.arrival_time = None
+
+  def dispatch_values(self, address, values, client):
+    self.arrival_time = self.arrival_times.get(address)
+    osc_server.OscDispatcher.dispatch_values(self, address, values, client)
+
+
+class InstrumentedMotorController(MotorController):
+  """A simulated MotorController which times each setpoint from datagram to serial write."""
+
+  def __init__(self, reactor, dispatcher, num_channels):
+    MotorController.__init__(self, reactor, '', num_channels, max_commands_in_flight=2)
+    self.dispatcher = dispatcher
+    # Maps channel to the arrival time of the datagram for the setpoint waiting to be written.
+    self.setpoint_arrival_times = {}
+    self.write_latencies = []
+    self.command_lines_written = 0
+
+  def go_multiple(self, channel_values):
+    for channel in channel_values:
+      self.setpoint_arrival_times[channel] = self.dispatcher.arrival_time
+    MotorController.go_multiple(self, channel_values)
+
+  def transmit_(self, command, callback, setpoints=None):
+    write_time = timeit.default_timer()
+    self.command_lines_written += 1
+    for channel, unused_setpoint in setpoints or ():
+      arrival_time = self.setpoint_arrival_times.pop(channel, None)
+      if arrival_time is not None:
+        self.write_latencies.append(write_time - arrival_time)
+    MotorController.transmit_(self, command, callback, setpoints)
+
+
+def run_benchmark(num_searchlights, frames, frame_seconds, messages_per_frame, base64_addresses):
+  """Runs the benchmark for a number of searchlights and returns a dict of results.
+
+  Args:
+    num_searchlights: The number of searchlights to configure.
+    frames: The number of frames to send. Each frame sends messages_per_frame draw_grid messages
+      to every searchlight, then advances the simulated time by frame_seconds.
+    frame_seconds: The simulated time between frames.
+    messages_per_frame: Messages per searchlight per frame. More than one simulates a flood of
+      input, where all but the newest message for each address may be dropped.
+    base64_addresses: Whether to base64 encode addresses, as broken TouchOSC clients do.
+  """
+  clock = task.Clock()
+  config_store = SearchlightConfigStore.create_with_sqlite_database(':memory:')
+  config_store.create_config_table()
+  dispatcher = TimedOscDispatcher()
+  handler = osc_server.OscDatagramHandler(clock, dispatcher)
+  controllers = []
+  addresses = []
+  for index in xrange(num_searchlights):
+    name = 'benchmark%d' % index
+    motor_controller = InstrumentedMotorController(clock, dispatcher, 2)
+    dispatcher.add_bundle_callbacks(motor_controller.begin_batch, motor_controller.end_batch)
+    Searchlight(clock, motor_controller, dispatcher, config_store, name, **SEARCHLIGHT_CONFIG)
+    controllers.append(motor_controller)
+    addresses.append('/%s/draw_grid' % name)
+  dispatcher.compile()
+
+  # Encode every datagram up front, so that only receiving them is timed. Each searchlight traces
+  # a circle, with successive messages in a frame moving a little further round.
+  datagrams = []
+  for frame in xrange(frames):
+    frame_datagrams = []
+    for index, address in enumerate(addresses):
+      for message in xrange(messages_per_frame):
+        angle = 2 * math.pi * (frame * messages_per_frame + message) / 500.0 + index
+        frame_datagrams.append((address, encode_message(
+            address, (0.5 + 0.3 * math.cos(angle), 0.5 + 0.3 * math.sin(angle)),
+            base64_address=base64_addresses)))
+    datagrams.append(frame_datagrams)
+
+  timer = timeit.default_timer
+  start_cpu_seconds = cpu_seconds()
+  start_time = timer()
+  for frame_datagrams in datagrams:
+    for address, datagram in frame_datagrams:
+      dispatcher.arrival_times[address] = timer()
+      handler.datagramReceived(datagram, BENCHMARK_CLIENT)
+    # Runs the drain of received datagrams, then delivers any simulated replies which are due.
+    clock.advance(0)
+    clock.advance(frame_seconds)
+  wall_seconds = timer() - start_time
+  cpu_seconds_used = cpu_seconds() - start_cpu_seconds
+
+  latencies = numpy.array(sum((c.write_latencies for c in controllers), [])) * 1e6
+  messages = handler.received_count
+  results = {
+      'num_searchlights': num_searchlights,
+      'messages': messages,
+      'messages_dropped': handler.dropped_count,
+      'command_lines_written': sum(c.command_lines_written for c in controllers),
+      'setpoints_written': len(latencies),
+      'setpoints_coalesced': sum(
+          sum(c.coalesced_setpoint_counts.values()) for c in controllers),
+      'setpoints_suppressed': sum(
+          sum(c.suppressed_setpoint_counts.values()) for c in controllers),
+      'wall_seconds': wall_seconds,
+      'messages_per_second': messages / wall_seconds,
+      'cpu_microseconds_per_message': cpu_seconds_used / messages * 1e6,
+      'latency_microseconds': {},
+  }
+  if len(latencies):
+    for percentile in LATENCY_PERCENTILES:
+      results['latency_microseconds']['p%d' % percentile] = float(
+          numpy.percentile(latencies, percentile))
+    results['latency_microseconds']['max'] = float(latencies.max())
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Benchmarks OSC handling with simulated motor controllers.')
+  parser.add_argument('--num_searchlights', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                      help='Numbers of searchlights to run the benchmark with.')
+  parser.add_argument('--frames', type=int, default=2000)
+  parser.add_argument('--frame_seconds', type=float, default=0.02,
+                      help='Simulated time between frames of messages.')
+  parser.add_argument('--messages_per_frame', type=int, default=1,
+                      help='Messages per searchlight per frame. Above 1 simulates a flood.')
+  parser.add_argument('--base64_addresses', action='store_true',
+                      help='Base64 encode addresses, as broken TouchOSC clients do.')
+  parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                      help='File to write JSON results to. Defaults to stdout.')
+  logging_common.add_logging_args(parser)
+  args = parser.parse_args()
+
+  logging_common.configure_logging_from_args(args)
+
+  runs = [run_benchmark(num_searchlights, args.frames, args.frame_seconds,
+                        args.messages_per_frame, args.base64_addresses)
+          for num_searchlights in args.num_searchlights]
+  json.dump({
+      'python_version': platform.python_version(),
+      'frames': args.frames,
+      'frame_seconds': args.frame_seconds,
+      'messages_per_frame': args.messages_per_frame,
+      'base64_addresses': args.base64_addresses,
+      'runs': runs,
+  }, args.output, indent=2, sort_keys=True)
+  args.output.write('\n')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,197 @@
+"""Plays precomposed shows, which move several searchlights together along keyframed timelines.
+
+A show file is YAML of the form:
+
+  duration: 20        # Optional. Defaults to the time of the last keyframe.
+  loop: true          # Optional. Whether to start again from the beginning after duration.
+  searchlights:
+    searchlight1:
+      - {time: 0, azimuth: -30, elevation: 20}
+      - {time: 10, azimuth: 30, elevation: 60}
+    searchlight2:
+      - {time: 0, azimuth: 30, elevation: 20}
+      - {time: 10, azimuth: -30, elevation: 60}
+
+Times are in seconds, and azimuth and elevation are angles in degrees relative to each
+searchlight's zero position. Angles are interpolated linearly between keyframes.
+
+Every searchlight in a show is evaluated on the same tick, and the resulting motor positions are
+all sent together once the whole frame has been computed.
+"""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import logging
+import os
+
+import numpy
+import yaml
+
+from twisted.internet import task
+
+from searchlight import DEGREES_TO_RADIANS
+
+# OSC addresses which control the scheduler. They do not belong to any one searchlight.
+OSC_ADDRESS_START = '/show/start'
+OSC_ADDRESS_STOP = '/show/stop'
+
+SHOW_KEYS = frozenset(['searchlights', 'duration', 'loop'])
+KEYFRAME_KEYS = frozenset(['time', 'azimuth', 'elevation'])
+
+
+class ShowFormatException(Exception):
+  pass
+
+
+class Timeline(object):
+  """The keyframes of a single searchlight, as arrays for interpolation."""
+
+  def __init__(self, keyframes):
+    if not keyframes:
+      raise ShowFormatException('A timeline needs at least one keyframe.')
+    for keyframe in keyframes:
+      if not isinstance(keyframe, dict) or set(keyframe) != KEYFRAME_KEYS:
+        raise ShowFormatException('Keyframe %r needs exactly the keys %s.' % (
+            keyframe, ', '.join(sorted(KEYFRAME_KEYS))))
+      if not all(isinstance(value, (int, long, float)) for value in keyframe.itervalues()):
+        raise ShowFormatException('Keyframe %r has a value which is not a number.' % keyframe)
+    keyframes = sorted(keyframes, key=lambda keyframe: keyframe['time'])
+    self.times = numpy.array([k['time'] for k in keyframes], dtype=float)
+    self.azimuths = numpy.array([k['azimuth'] for k in keyframes], dtype=float) * DEGREES_TO_RADIANS
+    self.elevations = numpy.array(
+        [k['elevation'] for k in keyframes], dtype=float) * DEGREES_TO_RADIANS
+
+  def angles_at(self, show_time):
+    """Returns (azimuth, elevation) in radians. Holds the first or last keyframe outside them."""
+    return (float(numpy.interp(show_time, self.times, self.azimuths)),
+            float(numpy.interp(show_time, self.times, self.elevations)))
+
+
+class Show(object):
+  """A set of timelines for named searchlights."""
+
+  def __init__(self, searchlights, duration=None, loop=False):
+    """Initializes a Show.
+
+    Args:
+      searchlights: A dict mapping searchlight name to a list of keyframe dicts, each with time,
+        azimuth and elevation.
+      duration: The length of the show in seconds. Defaults to the time of the last keyframe.
+      loop: Whether the show repeats after duration.
+    """
+    if not searchlights:
+      raise ShowFormatException('A show needs at least one searchlight.')
+    self.timelines = dict(
+        (name, Timeline(keyframes)) for name, keyframes in searchlights.iteritems())
+    if duration is None:
+      duration = max(timeline.times[-1] for timeline in self.timelines.itervalues())
+    if loop and duration <= 0:
+      raise ShowFormatException('A looping show needs a positive duration.')
+    self.duration = duration
+    self.loop = loop
+
+  @classmethod
+  def load(cls, path):
+    """Loads a show file. Raises ShowFormatException, naming the file, if it isn't valid."""
+    try:
+      with open(path) as f:
+        contents = yaml.safe_load(f)
+      if not isinstance(contents, dict):
+        raise ShowFormatException('A show file must be a mapping.')
+      unknown_keys = set(contents) - SHOW_KEYS
+      if unknown_keys:
+        raise ShowFormatException('Unknown keys %s.' % ', '.join(sorted(map(str, unknown_keys))))
+      if 'searchlights' not in contents:
+        raise ShowFormatException('A show file needs searchlights.')
+      if not isinstance(contents['searchlights'], dict):
+        raise ShowFormatException('searchlights must map searchlight name to keyframes.')
+      return cls(**contents)
+    except (ShowFormatException, yaml.YAMLError) as e:
+      raise ShowFormatException('%s: %s' % (path, e))
+
+
+class ShowScheduler(object):
+  """Plays shows on a fixed tick, and registers the OSC addresses to start and stop them."""
+
+  def __init__(self, reactor, name_to_searchlight, osc_dispatcher, shows, tick_seconds=0.02,
+               show_directory=''):
+    """Initializes a ShowScheduler.
+
+    Args:
+      reactor: The twisted.internet.reactor module.
+      name_to_searchlight: A dict mapping name to searchlight.Searchlight instance.
+      osc_dispatcher: An instance of osc_server.OscDispatcher.
+      shows: A dict mapping show name to the path of a show file. Files are loaded immediately, so
+        errors are found on startup rather than during a performance.
+      tick_seconds: The interval between successive frames of a show.
+      show_directory: The directory which relative show file paths are resolved against.
+    """
+    self.reactor = reactor
+    self.name_to_searchlight = name_to_searchlight
+    self.tick_seconds = tick_seconds
+    self.shows = {}
+    for show_name, path in shows.iteritems():
+      show = Show.load(os.path.join(show_directory, path))
+      for searchlight_name in show.timelines:
+        if searchlight_name not in name_to_searchlight:
+          raise ShowFormatException('Show %s refers to unknown searchlight %s' % (
+              show_name, searchlight_name))
+      self.shows[show_name] = show
+    self.show = None
+    self.start_time = None
+    self.task_ = task.LoopingCall(self.tick_)
+    self.task_.clock = reactor
+    for searchlight in name_to_searchlight.itervalues():
+      searchlight.show_scheduler = self
+    osc_dispatcher.add_callback(OSC_ADDRESS_START, self.osc_start)
+    osc_dispatcher.add_callback(OSC_ADDRESS_STOP, self.osc_stop)
+
+  def start(self, show_name):
+    """Starts a show from the beginning, replacing any show already playing."""
+    if show_name not in self.shows:
+      logging.error('Unknown show %s', show_name)
+      return
+    logging.info('Starting show %s', show_name)
+    self.show = self.shows[show_name]
+    # Stop any patterns, which would otherwise fight the show for the searchlights.
+    for searchlight_name in self.show.timelines:
+      self.name_to_searchlight[searchlight_name].pattern_player.stop()
+    self.start_time = self.reactor.seconds()
+    if not self.task_.running:
+      self.task_.start(self.tick_seconds)
+
+  def stop(self):
+    if self.task_.running:
+      self.task_.stop()
+    self.show = None
+
+  def stop_for_searchlight(self, searchlight_name):
+    """Stops the show if it moves the named searchlight, which something else is now moving."""
+    if self.show and searchlight_name in self.show.timelines:
+      logging.info('Stopping show: searchlight %s was moved by other input', searchlight_name)
+      self.stop()
+
+  def tick_(self):
+    show_time = self.reactor.seconds() - self.start_time
+    finished = show_time >= self.show.duration
+    if finished and self.show.loop:
+      show_time %= self.show.duration
+      finished = False
+    # Evaluate the whole frame before sending anything, so every searchlight's update goes out
+    # together rather than being spread across the time taken to evaluate the others.
+    frame = []
+    for searchlight_name, timeline in self.show.timelines.iteritems():
+      searchlight = self.name_to_searchlight[searchlight_name]
+      frame.append((searchlight, searchlight.motor_positions_for_angle(
+          *timeline.angles_at(show_time))))
+    for searchlight, channel_positions in frame:
+      searchlight.set_motor_positions(channel_positions, stop_show=False)
+    if finished:
+      logging.info('Show finished')
+      self.stop()
+
+  def osc_start(self, show_name):
+    self.start(show_name)
+
+  def osc_stop(self, *unused_values):
+    self.stop()
@@ -0,0 +1,240 @@
+"""Tests for choreography."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import task
+
+from choreography import Show
+from choreography import ShowFormatException
+from choreography import ShowScheduler
+from choreography import Timeline
+from motor_controller import MotorController
+from osc_server import OscDispatcher
+from searchlight import Searchlight
+from searchlight_config import SearchlightConfigStore
+
+
+class FakePatternPlayer(object):
+
+  def stop(self):
+    pass
+
+
+class FakeSearchlight(object):
+
+  def __init__(self):
+    self.pattern_player = FakePatternPlayer()
+    self.show_scheduler = None
+
+
+class TimelineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.timeline = Timeline([
+        {'time': 10, 'azimuth': 30, 'elevation': 60},
+        {'time': 0, 'azimuth': -30, 'elevation': 20},
+    ])
+
+  def assertAnglesAlmostEqual(self, expected_degrees, angles):
+    for expected, angle in zip(expected_degrees, angles):
+      self.assertAlmostEqual(math.radians(expected), angle)
+
+  def test_keyframes(self):
+    self.assertAnglesAlmostEqual((-30, 20), self.timeline.angles_at(0))
+    self.assertAnglesAlmostEqual((30, 60), self.timeline.angles_at(10))
+
+  def test_interpolates_between_keyframes(self):
+    self.assertAnglesAlmostEqual((0, 40), self.timeline.angles_at(5))
+    self.assertAnglesAlmostEqual((-15, 30), self.timeline.angles_at(2.5))
+
+  def test_holds_outside_keyframes(self):
+    self.assertAnglesAlmostEqual((-30, 20), self.timeline.angles_at(-1))
+    self.assertAnglesAlmostEqual((30, 60), self.timeline.angles_at(11))
+
+  def test_needs_a_keyframe(self):
+    self.assertRaises(ShowFormatException, Timeline, [])
+
+
+class ShowTest(unittest.TestCase):
+
+  def test_duration_defaults_to_last_keyframe(self):
+    show = Show({
+        'a': [{'time': 0, 'azimuth': 0, 'elevation': 0}, {'time': 4, 'azimuth': 0, 'elevation': 0}],
+        'b': [{'time': 6, 'azimuth': 0, 'elevation': 0}],
+    })
+    self.assertEqual(6, show.duration)
+
+  def test_looping_show_needs_positive_duration(self):
+    keyframes = {'a': [{'time': 0, 'azimuth': 0, 'elevation': 0}]}
+    self.assertRaises(ShowFormatException, Show, keyframes, loop=True)
+    self.assertRaises(ShowFormatException, Show, keyframes, duration=0, loop=True)
+    self.assertEqual(5, Show(keyframes, duration=5, loop=True).duration)
+
+  def test_needs_a_searchlight(self):
+    self.assertRaises(ShowFormatException, Show, {})
+
+
+class ShowLoadTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'show.yaml')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def load(self, contents):
+    with open(self.path, 'w') as f:
+      f.write(contents)
+    return Show.load(self.path)
+
+  def assertLoadFails(self, contents):
+    try:
+      self.load(contents)
+    except ShowFormatException as e:
+      self.assertIn(self.path, str(e))
+    else:
+      self.fail('No ShowFormatException for %r' % contents)
+
+  def test_loads_show(self):
+    show = self.load('duration: 8\nloop: true\nsearchlights:\n'
+                     '  a:\n    - {time: 0, azimuth: 0, elevation: 10}\n')
+    self.assertEqual(['a'], show.timelines.keys())
+    self.assertEqual(8, show.duration)
+    self.assertTrue(show.loop)
+
+  def test_not_a_mapping(self):
+    self.assertLoadFails('')
+    self.assertLoadFails('- {time: 0, azimuth: 0, elevation: 0}\n')
+
+  def test_invalid_yaml(self):
+    self.assertLoadFails('searchlights: [\n')
+
+  def test_unknown_key(self):
+    self.assertLoadFails(
+        'speed: 2\nsearchlights:\n  a:\n    - {time: 0, azimuth: 0, elevation: 0}\n')
+
+  def test_missing_searchlights(self):
+    self.assertLoadFails('duration: 5\n')
+    self.assertLoadFails('searchlights: [a, b]\n')
+
+  def test_missing_keyframe_key(self):
+    self.assertLoadFails('searchlights:\n  a:\n    - {time: 0, azimuth: 0}\n')
+
+  def test_unknown_keyframe_key(self):
+    self.assertLoadFails(
+        'searchlights:\n  a:\n    - {time: 0, azimuth: 0, elevation: 0, speed: 1}\n')
+
+  def test_keyframe_value_not_a_number(self):
+    self.assertLoadFails('searchlights:\n  a:\n    - {time: 0, azimuth: left, elevation: 0}\n')
+
+  def test_invalid_show(self):
+    self.assertLoadFails(
+        'loop: true\nsearchlights:\n  a:\n    - {time: 0, azimuth: 0, elevation: 0}\n')
+
+
+class ShowSchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'show.yaml'), 'w') as f:
+      f.write('searchlights:\n  a:\n    - {time: 0, azimuth: 0, elevation: 0}\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_show_paths_are_relative_to_show_directory(self):
+    scheduler = ShowScheduler(None, {'a': FakeSearchlight()}, OscDispatcher(),
+                              {'show': 'show.yaml'}, show_directory=self.directory)
+    self.assertEqual(['a'], scheduler.shows['show'].timelines.keys())
+
+  def test_unknown_searchlight(self):
+    self.assertRaises(ShowFormatException, ShowScheduler, None, {}, OscDispatcher(),
+                      {'show': 'show.yaml'}, show_directory=self.directory)
+
+
+
+class ShowPlaybackTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    with open(os.path.join(self.directory, 'show.yaml'), 'w') as f:
+      f.write('searchlights:\n'
+              '  a:\n    - {time: 0, azimuth: 0, elevation: 0}\n'
+              '    - {time: 1, azimuth: 10, elevation: 20}\n'
+              '  b:\n    - {time: 0, azimuth: 0, elevation: 0}\n')
+    self.clock = task.Clock()
+    self.config_store = SearchlightConfigStore.create_with_sqlite_database(':memory:')
+    self.config_store.create_config_table()
+    osc_dispatcher = OscDispatcher()
+    self.name_to_searchlight = dict(
+        (name, self.create_searchlight(osc_dispatcher, name)) for name in ('a', 'b', 'c'))
+    self.scheduler = ShowScheduler(self.clock, self.name_to_searchlight, osc_dispatcher,
+                                   {'show': 'show.yaml'}, tick_seconds=0.1,
+                                   show_directory=self.directory)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def create_searchlight(self, osc_dispatcher, name):
+    searchlight = Searchlight(
+        self.clock, MotorController(self.clock, '', 2), osc_dispatcher, self.config_store, name,
+        'direct', direct_positioning={
+            'azimuth_angle_bound': [-90, 90], 'elevation_angle_bound': [0, 90]})
+    searchlight.positions = []
+    searchlight.motor_controller.go_multiple = searchlight.positions.append
+    return searchlight
+
+  def test_moves_searchlights_in_show(self):
+    self.scheduler.start('show')
+    self.clock.pump([0.1] * 5)
+    self.assertEqual(6, len(self.name_to_searchlight['a'].positions))
+    self.assertEqual(6, len(self.name_to_searchlight['b'].positions))
+    self.assertEqual([], self.name_to_searchlight['c'].positions)
+    self.assertIsNotNone(self.scheduler.show)
+
+  def test_finishes(self):
+    self.scheduler.start('show')
+    self.clock.pump([0.1] * 20)
+    self.assertIsNone(self.scheduler.show)
+    searchlight = self.name_to_searchlight['a']
+    # The last frame holds the final keyframe.
+    expected = searchlight.motor_positions_for_angle(math.radians(10), math.radians(20))
+    for channel, position in searchlight.positions[-1].iteritems():
+      self.assertAlmostEqual(expected[channel], position, places=6)
+    self.assertEqual([], self.clock.getDelayedCalls())
+
+  def test_manual_input_stops_show(self):
+    self.scheduler.start('show')
+    self.clock.pump([0.1] * 2)
+    searchlight = self.name_to_searchlight['b']
+    searchlight.osc_raw_azimuth(0.5)
+    self.assertIsNone(self.scheduler.show)
+    del searchlight.positions[:]
+    self.clock.pump([0.1] * 5)
+    # Only the manual input moves the searchlight now.
+    self.assertEqual([], searchlight.positions)
+    self.assertEqual([], self.clock.getDelayedCalls())
+
+  def test_pattern_stops_show(self):
+    self.scheduler.start('show')
+    self.name_to_searchlight['a'].osc_pattern('sweep')
+    self.clock.pump([0.1] * 2)
+    self.assertIsNone(self.scheduler.show)
+
+  def test_manual_input_to_other_searchlight(self):
+    self.scheduler.start('show')
+    self.name_to_searchlight['c'].osc_raw_azimuth(0.5)
+    self.assertIsNotNone(self.scheduler.show)
+    self.clock.pump([0.1] * 2)
+    self.assertEqual(3, len(self.name_to_searchlight['a'].positions))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,160 @@
+"""Streams motor setpoints at a fixed rate, independent of how often targets arrive."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import math
+
+from twisted.internet import task
+
+# Positions closer than this to their target are considered to have arrived.
+POSITION_EPSILON = 1e-4
+
+
+class _ChannelState(object):
+  def __init__(self):
+    # Positions are in motor units, between -1 and 1. position is None until the first target
+    # arrives, since we don't know where the motor starts.
+    self.position = None
+    self.velocity = 0.0
+    self.target = None
+
+
+class MotionScheduler(object):
+  """Ticks MotionEngines together, so that targets set together are sent together.
+
+  Engines with the same tick_seconds share one LoopingCall. Each tick steps every moving engine,
+  with all of their motor controllers held in one batch. Engines woken in the same reactor
+  iteration, such as by one OSC bundle which moves several searchlights, start on the same tick
+  rather than each on its own.
+  """
+
+  def __init__(self, reactor):
+    self.reactor = reactor
+    # Maps tick_seconds to the list of engines which are moving.
+    self.moving_engines = {}
+    # Maps tick_seconds to its LoopingCall.
+    self.tasks = {}
+    # The tick_seconds whose LoopingCall is due to start.
+    self.pending_starts = set()
+
+  def wake(self, engine):
+    """Ticks an engine until it stops moving."""
+    tick_seconds = engine.tick_seconds
+    engines = self.moving_engines.setdefault(tick_seconds, [])
+    if engine not in engines:
+      engines.append(engine)
+    loop = self.tasks.get(tick_seconds)
+    if not loop:
+      loop = self.tasks[tick_seconds] = task.LoopingCall(self.tick_, tick_seconds)
+      loop.clock = self.reactor
+    if not loop.running and tick_seconds not in self.pending_starts:
+      # Start once the current reactor iteration is done, so every engine woken during it is
+      # stepped by the first tick.
+      self.pending_starts.add(tick_seconds)
+      self.reactor.callLater(0, self.start_, tick_seconds)
+
+  def start_(self, tick_seconds):
+    self.pending_starts.discard(tick_seconds)
+    loop = self.tasks[tick_seconds]
+    if self.moving_engines[tick_seconds] and not loop.running:
+      loop.start(tick_seconds)
+
+  def tick_(self, tick_seconds):
+    engines = self.moving_engines[tick_seconds]
+    motor_controllers = []
+    for engine in engines:
+      if engine.motor_controller not in motor_controllers:
+        motor_controllers.append(engine.motor_controller)
+    for motor_controller in motor_controllers:
+      motor_controller.begin_batch()
+    try:
+      engines[:] = [engine for engine in engines if engine.tick_()]
+    finally:
+      for motor_controller in motor_controllers:
+        motor_controller.end_batch()
+    if not engines:
+      self.tasks[tick_seconds].stop()
+
+
+class MotionEngine(object):
+  """Moves a motor controller's channels towards their latest targets on a fixed tick.
+
+  Targets may be set at any rate; only the latest target for each channel is kept. Each tick, every
+  channel moves towards its target subject to the velocity and acceleration limits, and all changed
+  channels are sent to the motor controller together. The tick only runs while a channel is moving.
+  """
+
+  def __init__(self, reactor, motor_controller, tick_seconds=0.02, max_velocity=None,
+               max_acceleration=None, scheduler=None):
+    """Initializes a MotionEngine.
+
+    Args:
+      reactor: The twisted.internet.reactor module.
+      motor_controller: An instance of motor_controller.MotorController.
+      tick_seconds: The interval between setpoints sent to the motor controller.
+      max_velocity: The maximum speed, in motor units (the range from 0 to 1) per second. If None,
+        speed is unlimited.
+      max_acceleration: The maximum acceleration, in motor units per second squared. If None,
+        acceleration is unlimited.
+      scheduler: The MotionScheduler which ticks this engine, shared with other engines which
+        should move together. If None, the engine gets a scheduler of its own.
+    """
+    self.motor_controller = motor_controller
+    self.tick_seconds = tick_seconds
+    self.max_velocity = max_velocity
+    self.max_acceleration = max_acceleration
+    self.scheduler = scheduler or MotionScheduler(reactor)
+    # Maps channel to _ChannelState.
+    self.channels = {}
+
+  def set_targets(self, channel_positions):
+    """Sets the target positions of one or more channels.
+
+    Args:
+      channel_positions: A dict mapping channel to position, between -1 and 1.
+    """
+    for channel, position in channel_positions.iteritems():
+      state = self.channels.get(channel)
+      if not state:
+        state = self.channels[channel] = _ChannelState()
+      state.target = position
+    self.scheduler.wake(self)
+
+  def tick_(self):
+    """Sends the next setpoints. Returns whether any channel is still moving."""
+    channel_positions = {}
+    for channel, state in self.channels.iteritems():
+      if state.target is None or state.position == state.target:
+        continue
+      if state.position is None:
+        state.position = state.target
+      else:
+        self.step_(state)
+      channel_positions[channel] = state.position
+    if channel_positions:
+      self.motor_controller.go_multiple(channel_positions)
+    return bool(channel_positions)
+
+  def step_(self, state):
+    """Advances a channel's position by one tick towards its target."""
+    error = state.target - state.position
+    direction = math.copysign(1, error)
+    # The fastest speed from which we can still stop at the target.
+    desired_speed = self.max_velocity if self.max_velocity is not None else float('inf')
+    if self.max_acceleration is not None:
+      desired_speed = min(desired_speed, math.sqrt(2 * self.max_acceleration * abs(error)))
+    desired_velocity = direction * desired_speed
+    if self.max_acceleration is None:
+      velocity = desired_velocity
+    else:
+      max_change = self.max_acceleration * self.tick_seconds
+      velocity = min(max(desired_velocity, state.velocity - max_change),
+                     state.velocity + max_change)
+    step = velocity * self.tick_seconds
+    if abs(error) - POSITION_EPSILON <= step * direction:
+      # Arrived, or would overshoot.
+      state.position = state.target
+      state.velocity = 0.0
+    else:
+      state.position += step
+      state.velocity = velocity
@@ -0,0 +1,137 @@
+"""Tests for motion_engine."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import unittest
+
+from twisted.internet import task
+
+from motion_engine import MotionEngine
+from motion_engine import MotionScheduler
+
+TICK_SECONDS = 0.02
+
+
+class FakeMotorController(object):
+  """Records the setpoints sent in each batch."""
+
+  def __init__(self):
+    self.batch_depth = 0
+    self.batches = []
+    self.unbatched = []
+
+  def begin_batch(self):
+    if not self.batch_depth:
+      self.batch_positions = {}
+    self.batch_depth += 1
+
+  def end_batch(self):
+    self.batch_depth -= 1
+    if not self.batch_depth and self.batch_positions:
+      self.batches.append(self.batch_positions)
+
+  def go_multiple(self, channel_positions):
+    if self.batch_depth:
+      self.batch_positions.update(channel_positions)
+    else:
+      self.unbatched.append(dict(channel_positions))
+
+
+class MotionEngineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.motor_controller = FakeMotorController()
+
+  def create_engine(self, **kwargs):
+    return MotionEngine(self.clock, self.motor_controller, tick_seconds=TICK_SECONDS,
+                        scheduler=MotionScheduler(self.clock), **kwargs)
+
+  def run_ticks(self, ticks):
+    self.clock.pump([0] + [TICK_SECONDS] * ticks)
+
+  def test_first_target_is_sent_directly(self):
+    engine = self.create_engine(max_velocity=1.0)
+    engine.set_targets({1: 0.5})
+    self.run_ticks(3)
+    self.assertEqual([{1: 0.5}], self.motor_controller.batches)
+
+  def test_velocity_limit(self):
+    engine = self.create_engine(max_velocity=1.0)
+    engine.set_targets({1: 0.0})
+    self.run_ticks(1)
+    engine.set_targets({1: 0.1})
+    self.run_ticks(10)
+    positions = [batch[1] for batch in self.motor_controller.batches[1:]]
+    for expected, position in zip([0.02, 0.04, 0.06, 0.08, 0.1], positions):
+      self.assertAlmostEqual(expected, position)
+    self.assertEqual(5, len(positions))
+
+  def test_acceleration_limit(self):
+    engine = self.create_engine(max_acceleration=10.0)
+    engine.set_targets({1: 0.0})
+    self.run_ticks(1)
+    engine.set_targets({1: 1.0})
+    self.run_ticks(2)
+    # Velocity rises by 0.2 each tick, so the steps are 0.004 and then 0.008.
+    positions = [batch[1] for batch in self.motor_controller.batches[1:]]
+    self.assertAlmostEqual(0.004, positions[0])
+    self.assertAlmostEqual(0.012, positions[1])
+
+  def test_stops_ticking_when_arrived(self):
+    engine = self.create_engine()
+    engine.set_targets({1: 0.5, 2: -0.5})
+    self.run_ticks(5)
+    self.assertEqual([{1: 0.5, 2: -0.5}], self.motor_controller.batches)
+    self.assertFalse(self.clock.getDelayedCalls())
+
+
+class MotionSchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.scheduler = MotionScheduler(self.clock)
+    self.motor_controllers = [FakeMotorController(), FakeMotorController()]
+    self.engines = [
+        MotionEngine(self.clock, motor_controller, tick_seconds=TICK_SECONDS, max_velocity=1.0,
+                     scheduler=self.scheduler)
+        for motor_controller in self.motor_controllers]
+
+  def test_engines_woken_together_tick_together(self):
+    for engine in self.engines:
+      engine.set_targets({1: 0.0})
+    # Nothing is sent until the current reactor iteration is done.
+    self.assertEqual([[], []], [c.batches for c in self.motor_controllers])
+    self.clock.advance(0)
+    self.assertEqual([[{1: 0.0}], [{1: 0.0}]], [c.batches for c in self.motor_controllers])
+
+  def test_engine_woken_later_joins_running_tick(self):
+    self.engines[0].set_targets({1: 0.0})
+    self.clock.advance(0)
+    self.engines[0].set_targets({1: 0.1})
+    self.clock.advance(TICK_SECONDS / 2)
+    self.engines[1].set_targets({1: 0.0})
+    self.clock.advance(TICK_SECONDS / 2)
+    self.assertEqual([[{1: 0.0}, {1: 0.02}], [{1: 0.0}]],
+                     [c.batches for c in self.motor_controllers])
+
+  def test_setpoints_are_sent_inside_batches(self):
+    for engine in self.engines:
+      engine.set_targets({1: 0.0})
+    self.clock.pump([0] + [TICK_SECONDS] * 3)
+    for motor_controller in self.motor_controllers:
+      self.assertEqual([], motor_controller.unbatched)
+      self.assertEqual(0, motor_controller.batch_depth)
+
+  def test_engines_with_different_ticks(self):
+    engine = MotionEngine(self.clock, self.motor_controllers[0], tick_seconds=0.05,
+                          max_velocity=1.0, scheduler=self.scheduler)
+    engine.set_targets({2: 0.0})
+    self.engines[1].set_targets({1: 0.0})
+    self.clock.advance(0)
+    self.assertEqual(set([TICK_SECONDS, 0.05]), set(self.scheduler.tasks))
+    self.assertEqual([[{2: 0.0}], [{1: 0.0}]], [c.batches for c in self.motor_controllers])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -7,8 +7,80 @@ from twisted.protocols import basic
 
 SIMULATION_DELAY_SECONDS = 0.1
 # If we do not receive a response within this many seconds after sending a command, sends the next
-# command anyway.
+# command anyway. This is the initial value; once enough replies have been timed, the expiry is
+# derived from the measured round-trip latency instead. Each expiry doubles it, up to a maximum.
 COMMAND_EXPIRY_SECONDS = 0.15
+# Number of recent round-trip latencies kept per controller.
+LATENCY_WINDOW_SIZE = 200
+# Number of latencies which must be measured before the expiry adapts to them, and how often (in
+# replies) it is recomputed after that.
+LATENCY_MIN_SAMPLES = 20
+LATENCY_UPDATE_INTERVAL = 10
+# The adaptive expiry is this multiple of the 99th percentile latency.
+LATENCY_EXPIRY_MULTIPLIER = 2.0
+# Separates multiple commands sent on a single line. The controller replies to each of them.
+COMMAND_SEPARATOR = '_'
+# 'G' command values are integers, where this many units span the range from 0 to 1.
+SETPOINT_SCALE = 1000
+
+
+class _InFlightCommand(object):
+  """A command line which has been transmitted and is awaiting its echo and replies.
+
+  A line may hold several commands joined by COMMAND_SEPARATOR. The controller may echo such a
+  line whole or one command at a time, and sends one reply per command.
+  """
+
+  def __init__(self, command, callback, setpoints=None):
+    self.command = command
+    self.callback = callback
+    # For setpoint commands, a list of (channel, setpoint) in the same order as subcommands.
+    self.setpoints = setpoints
+    self.subcommands = command.split(COMMAND_SEPARATOR)
+    self.echoes_seen = 0
+    self.replies = []
+    self.send_time = None
+    self.expiry_call = None
+
+  def echoed(self):
+    return self.echoes_seen > 0
+
+  def match_echo(self, line):
+    """Returns True if line is (part of) the echo of this command."""
+    if not self.echoes_seen and line == self.command:
+      self.echoes_seen = len(self.subcommands)
+      return True
+    if self.echoes_seen < len(self.subcommands) and line == self.subcommands[self.echoes_seen]:
+      self.echoes_seen += 1
+      return True
+    return False
+
+  def expects_reply(self, line):
+    """Returns True if line could be the next reply (or replies) to this command."""
+    replies = line.split(COMMAND_SEPARATOR)
+    subcommands = self.subcommands[len(self.replies):]
+    return len(replies) <= len(subcommands) and all(
+        _reply_matches(subcommand, reply) for subcommand, reply in zip(subcommands, replies))
+
+  def add_reply(self, line):
+    """Records a reply line. Returns True once every command on the line has been replied to."""
+    self.replies.extend(line.split(COMMAND_SEPARATOR))
+    return len(self.replies) >= len(self.subcommands)
+
+
+class _SetpointSlot(object):
+  """Holds the latest setpoints for one or more channels until their 'G' commands are transmitted.
+
+  All channels in a slot are sent together on a single command line.
+  """
+
+  def __init__(self):
+    # Maps channel to integer setpoint.
+    self.setpoints = {}
+
+  def command(self):
+    return COMMAND_SEPARATOR.join(
+        '!G %d %d' % channel_setpoint for channel_setpoint in sorted(self.setpoints.iteritems()))
 
 
 class MotorController(basic.LineOnlyReceiver):
@@ -19,11 +91,18 @@ class MotorController(basic.LineOnlyReceiver):
 
   Each line is terminated by a carriage return. After sending a command line, the controller will
   echo that command line back, followed by another line representing the command reply.
+
+  Up to max_commands_in_flight command lines may be transmitted before their replies arrive. The
+  controller processes lines in the order it receives them, so echoes and replies are matched
+  back to in-flight commands in transmission order. Each reply is also checked against the kind of
+  command it answers, so that a lost reply doesn't hand later commands each other's replies.
   """
 
   delimiter = '\r'
 
-  def __init__(self, reactor, serial_port, num_channels):
+  def __init__(self, reactor, serial_port, num_channels, max_commands_in_flight=1,
+               setpoint_deadband=0, min_command_expiry_seconds=0.03,
+               max_command_expiry_seconds=0.5):
     """Initializes a MotorController.
 
     Args:
@@ -31,62 +110,205 @@ class MotorController(basic.LineOnlyReceiver):
       serial_port: The address of the serial port to connect to. If empty, simulates sending
         and receiving commands instead.
       num_channels: The number of motors connected to the controller.
+      max_commands_in_flight: The number of command lines which may be awaiting a reply at once.
+        1 gives strict stop-and-wait behavior.
+      setpoint_deadband: A 'G' command is dropped if its integer setpoint differs from the last one
+        transmitted on that channel by no more than this. 0 drops only exact repeats.
+      min_command_expiry_seconds, max_command_expiry_seconds: Bounds on the command expiry derived
+        from measured round-trip latency.
     """
+    assert max_commands_in_flight >= 1, (
+        'Invalid max_commands_in_flight: %d' % max_commands_in_flight)
     self.num_channels = num_channels
     self.serial_port = serial_port
     self.simulate = not serial_port
     self.reactor = reactor
-    # List of tuples (command line, callback)
+    self.max_commands_in_flight = max_commands_in_flight
+    self.setpoint_deadband = setpoint_deadband
+    self.min_command_expiry_seconds = min_command_expiry_seconds
+    self.max_command_expiry_seconds = max_command_expiry_seconds
+    self.command_expiry_seconds = COMMAND_EXPIRY_SECONDS
+    # Round-trip latencies, in seconds, from transmitting a command line to receiving its last
+    # reply.
+    self.latencies = collections.deque(maxlen=LATENCY_WINDOW_SIZE)
+    self.replies_since_expiry_update = 0
+    self.expired_count = 0
+    # Number of commands dropped because a later command's reply arrived before theirs.
+    self.lost_reply_count = 0
+    # Replies received before this time may be late replies to an expired command, which would be
+    # matched to a later command and look much faster than they were. Their latency isn't recorded.
+    self.latency_holdoff_time = 0
+    # Commands which have not been transmitted yet. List of tuples (command, callback), where
+    # command is either a command line or a _SetpointSlot.
     self.command_queue = collections.deque()
-    # The last line seen was the head of the command queue. The next line we see should be the
-    # response to that command.
-    self.pending_response = False
-    self.delayed_expiry_call = None
+    # Maps channel to the _SetpointSlot in command_queue for that channel, if any.
+    self.setpoint_slots = {}
+    # Commands which are only transmitted while command_queue is empty, such as telemetry queries.
+    self.low_priority_command_queue = collections.deque()
+    # _InFlightCommand instances in the order they were transmitted.
+    self.in_flight = collections.deque()
+    # Map channel to the last integer setpoint transmitted, and to the last one the controller
+    # accepted. When a setpoint's command expires, the last accepted setpoint is taken to be the
+    # last one transmitted instead, so that the expired setpoint can be sent again.
+    self.last_sent_setpoints = {}
+    self.last_acknowledged_setpoints = {}
+    # Number of setpoints per channel which were dropped by the deadband, or replaced by a newer
+    # setpoint before being transmitted.
+    self.suppressed_setpoint_counts = collections.Counter()
+    self.coalesced_setpoint_counts = collections.Counter()
+    # Transmission is held back while batch_depth is positive. See begin_batch.
+    self.batch_depth = 0
+    # The _SetpointSlot which setpoints given during the current batch are added to.
+    self.batch_slot = None
     if not self.simulate:
       serialport.SerialPort(self, serial_port, reactor, baudrate='115200')
 
-  def send_next_command_(self):
-    command = self.command_queue[0][0]
+  def send_queued_commands_(self):
+    """Transmits queued commands until the in-flight window is full."""
+    if self.batch_depth:
+      return
+    while len(self.in_flight) < self.max_commands_in_flight:
+      if self.command_queue:
+        command, callback = self.command_queue.popleft()
+      elif self.low_priority_command_queue:
+        command, callback = self.low_priority_command_queue.popleft()
+      else:
+        return
+      setpoints = None
+      if isinstance(command, _SetpointSlot):
+        setpoints = sorted(command.setpoints.iteritems())
+        for channel, setpoint in setpoints:
+          del self.setpoint_slots[channel]
+          self.last_sent_setpoints[channel] = setpoint
+        command = command.command()
+      self.transmit_(command, callback, setpoints)
+
+  def transmit_(self, command, callback, setpoints=None):
+    in_flight_command = _InFlightCommand(command, callback, setpoints)
+    in_flight_command.send_time = self.reactor.seconds()
+    self.in_flight.append(in_flight_command)
     if not self.simulate:
       logging.debug('Controller %s sending: %s', self.serial_port, command)
       basic.LineOnlyReceiver.sendLine(self, command)
     else:
-      self.reactor.callLater(SIMULATION_DELAY_SECONDS, self.lineReceived, command)
-      self.reactor.callLater(SIMULATION_DELAY_SECONDS, self.lineReceived, '+')
-    self.delayed_expiry_call = self.reactor.callLater(COMMAND_EXPIRY_SECONDS, self.on_expiry_)
-
-  def on_expiry_(self):
-    # TODO DRY
-    logging.debug('onexpiry')
-    self.pending_response = False
-    self.delayed_expiry_call = None
-    command, callback = self.command_queue.popleft()
-    logging.debug('Controller %s Command %s EXPIRED', self.serial_port, command)
-    if callback:
-      callback('EXPIRED')  # TODO better way to handle this
-    if self.command_queue:
-      self.send_next_command_()
+      self.reactor.callLater(SIMULATION_DELAY_SECONDS, self.simulate_reply_, command)
+    in_flight_command.expiry_call = self.reactor.callLater(
+        self.command_expiry_seconds, self.on_expiry_, in_flight_command)
+
+  def simulate_reply_(self, command):
+    # Deliver the echo and the replies from a single delayed call so they can't be reordered.
+    self.lineReceived(command)
+    for subcommand in command.split(COMMAND_SEPARATOR):
+      if subcommand[:1] in ('?', '~'):
+        # Queries reply with the query name and a value.
+        self.lineReceived('%s=0' % subcommand.split()[0][1:].upper())
+      else:
+        self.lineReceived('+')
+
+  def on_expiry_(self, in_flight_command):
+    in_flight_command.expiry_call = None
+    self.expired_count += 1
+    logging.debug('Controller %s Command %s EXPIRED', self.serial_port, in_flight_command.command)
+    self.back_off_expiry_()
+    self.drop_in_flight_command_(in_flight_command)
+    self.send_queued_commands_()
+
+  def on_lost_reply_(self, in_flight_command):
+    """Gives up on a command whose reply was lost, since a later command's reply has arrived."""
+    in_flight_command.expiry_call.cancel()
+    in_flight_command.expiry_call = None
+    self.lost_reply_count += 1
+    logging.debug('Controller %s Command %s reply lost',
+                  self.serial_port, in_flight_command.command)
+    self.drop_in_flight_command_(in_flight_command)
+
+  def drop_in_flight_command_(self, in_flight_command):
+    """Removes a command which will not be replied to, and tells its callback so."""
+    self.in_flight.remove(in_flight_command)
+    for channel, setpoint in in_flight_command.setpoints or ():
+      # Unless a newer setpoint has been sent since, the motor may not have received this one.
+      # Fall back to the last setpoint it accepted, so that any other setpoint is sent again.
+      if self.last_sent_setpoints.get(channel) == setpoint:
+        if channel in self.last_acknowledged_setpoints:
+          self.last_sent_setpoints[channel] = self.last_acknowledged_setpoints[channel]
+        else:
+          del self.last_sent_setpoints[channel]
+    if in_flight_command.callback:
+      in_flight_command.callback('EXPIRED')  # TODO better way to handle this
 
   def lineReceived(self, line):
     """Called whenever a line is received. Overrides basic.LineOnlyReceiver.lineReceived."""
     if not line:
       return
-    if self.pending_response:
-      self.pending_response = False
-      self.delayed_expiry_call.cancel()
-      self.delayed_expiry_call = None
-      command, callback = self.command_queue.popleft()
-      logging.debug('Controller %s Command %s Response %s', self.serial_port, command, line)
-      if callback:
-        callback(line)
-      if self.command_queue:
-        self.send_next_command_()
-    elif self.command_queue and line == self.command_queue[0][0]:
-      logging.debug('Controller %s awaiting response for %s',
-                    self.serial_port, self.command_queue[0][0])
-      self.pending_response = True
-    else:
-      logging.debug('Controller %s read unexpected line: %s', self.serial_port, line)
+    # With more than one command in flight, the echo of a later command may arrive before the
+    # replies to an earlier one. Replies never look like command lines, so check for echoes first.
+    for in_flight_command in self.in_flight:
+      if in_flight_command.match_echo(line):
+        logging.debug('Controller %s awaiting response for %s', self.serial_port, line)
+        return
+    # Replies arrive in transmission order, so a reply belongs to the oldest echoed command which
+    # could have sent it. Any older command awaiting a different reply has lost it, and is dropped
+    # now rather than shifting every later reply onto the previous command. Acknowledgements from
+    # different commands look the same, so a lost one is only noticed when a different reply
+    # arrives or the command expires.
+    skipped_commands = []
+    for in_flight_command in self.in_flight:
+      if not in_flight_command.echoed():
+        continue
+      if in_flight_command.expects_reply(line):
+        for skipped_command in skipped_commands:
+          self.on_lost_reply_(skipped_command)
+        if in_flight_command.add_reply(line):
+          self.on_reply_(in_flight_command)
+        else:
+          self.send_queued_commands_()
+        return
+      skipped_commands.append(in_flight_command)
+    logging.debug('Controller %s read unexpected line: %s', self.serial_port, line)
+
+  def on_reply_(self, in_flight_command):
+    in_flight_command.expiry_call.cancel()
+    in_flight_command.expiry_call = None
+    self.in_flight.remove(in_flight_command)
+    now = self.reactor.seconds()
+    if now >= self.latency_holdoff_time:
+      self.record_latency_(now - in_flight_command.send_time)
+    reply = COMMAND_SEPARATOR.join(in_flight_command.replies)
+    for (channel, setpoint), setpoint_reply in zip(
+        in_flight_command.setpoints or (), in_flight_command.replies):
+      if setpoint_reply == '+':
+        self.last_acknowledged_setpoints[channel] = setpoint
+    logging.debug('Controller %s Command %s Response %s',
+                  self.serial_port, in_flight_command.command, reply)
+    if in_flight_command.callback:
+      in_flight_command.callback(reply)
+    self.send_queued_commands_()
+
+  def record_latency_(self, latency):
+    self.latencies.append(latency)
+    self.replies_since_expiry_update += 1
+    if (len(self.latencies) >= LATENCY_MIN_SAMPLES and
+        self.replies_since_expiry_update >= LATENCY_UPDATE_INTERVAL):
+      self.replies_since_expiry_update = 0
+      expiry = _percentile(sorted(self.latencies), 0.99) * LATENCY_EXPIRY_MULTIPLIER
+      self.command_expiry_seconds = min(
+          max(expiry, self.min_command_expiry_seconds), self.max_command_expiry_seconds)
+
+  def back_off_expiry_(self):
+    """Doubles the command expiry after a command expires, up to max_command_expiry_seconds.
+
+    The expired command's latency is only known to be at least the old expiry. That censored
+    sample replaces the window, so the expiry isn't shrunk straight back by the shorter latencies
+    measured before, and then has to be earned again from new replies.
+    """
+    censored_latency = self.command_expiry_seconds
+    self.command_expiry_seconds = min(
+        max(2 * censored_latency, self.min_command_expiry_seconds),
+        self.max_command_expiry_seconds)
+    self.latencies.clear()
+    self.latencies.append(censored_latency)
+    self.replies_since_expiry_update = 0
+    self.latency_holdoff_time = self.reactor.seconds() + self.command_expiry_seconds
 
   def connectionFailed(self):
     # TODO(robgaunt): error handling
@@ -96,10 +318,13 @@ class MotorController(basic.LineOnlyReceiver):
     logging.info('Controller %s: connection made', self.serial_port)
 
   # Public API
-  def send_command(self, command, callback=None):
-    self.command_queue.append((command, callback))
-    if len(self.command_queue) == 1:
-      self.send_next_command_()
+  def send_command(self, command, callback=None, low_priority=False):
+    """Queues a command line. Low priority commands wait until no other commands are queued."""
+    if low_priority:
+      self.low_priority_command_queue.append((command, callback))
+    else:
+      self.command_queue.append((command, callback))
+    self.send_queued_commands_()
 
   def go(self, channel, value):
     """Sends a 'G' (Go To Speed) command to motor.
@@ -108,23 +333,82 @@ class MotorController(basic.LineOnlyReceiver):
       channel: An integer between 1 and self.num_channels.
       value: A floating point value between -1 and 1.
     """
-    self._validate_channel(channel)
-    self._validate_value(value)
-    command = '!G %d %d' % (channel, value * 1000)
-    for i, (existing_command, unused_callback) in enumerate(self.command_queue):
-      # go commands don't take callback, so there is no concern about nuking someone else's
-      # callback.
-      # Note that position i = 0 represents a command which has already been sent and is awaiting
-      # a response.
-      command_prefix = '!G %d' % channel
-      if i and existing_command.startswith(command_prefix):
-        # Just replace it.
-        logging.debug('Replacing command %s with %s', existing_command, command)
-        self.command_queue[i] = (command, None)
-        return
+    self.go_multiple({channel: value})
+
+  def go_multiple(self, channel_values):
+    """Sends 'G' commands to several motors on a single command line.
+
+    Queued setpoints are coalesced: if a channel already has a setpoint waiting to be transmitted,
+    its value is replaced in place. Commands which have already been transmitted are never touched.
+    Otherwise, setpoints within setpoint_deadband of the last one transmitted are dropped, since
+    they would not move the motor.
 
-    # Didn't find an existing !G command to replace, so send a new one.
-    self.send_command(command)
+    Args:
+      channel_values: A dict mapping channel to value, as for go().
+    """
+    slot = None
+    new_setpoints = {}
+    for channel, value in channel_values.iteritems():
+      self._validate_channel(channel)
+      self._validate_value(value)
+      setpoint = int(value * SETPOINT_SCALE)
+      existing_slot = self.setpoint_slots.get(channel)
+      if existing_slot:
+        logging.debug('Replacing setpoint %d with %d on channel %d',
+                      existing_slot.setpoints[channel], setpoint, channel)
+        existing_slot.setpoints[channel] = setpoint
+        self.coalesced_setpoint_counts[channel] += 1
+        slot = slot or existing_slot
+      elif (channel in self.last_sent_setpoints and
+            abs(setpoint - self.last_sent_setpoints[channel]) <= self.setpoint_deadband):
+        self.suppressed_setpoint_counts[channel] += 1
+      else:
+        new_setpoints[channel] = setpoint
+    if not new_setpoints:
+      return
+    # Channels without a queued setpoint join one that is already queued, so they are sent together.
+    if not slot:
+      # Within a batch, every channel joins the same command line.
+      slot = self.batch_slot
+    if not slot:
+      slot = _SetpointSlot()
+      # go commands don't take callback.
+      self.command_queue.append((slot, None))
+      if self.batch_depth:
+        self.batch_slot = slot
+    for channel, setpoint in new_setpoints.iteritems():
+      slot.setpoints[channel] = setpoint
+      self.setpoint_slots[channel] = slot
+    self.send_queued_commands_()
+
+  def begin_batch(self):
+    """Holds back transmission until end_batch, so setpoints given in between go out together.
+
+    All setpoints given during a batch are sent on one command line. Batches may be nested, and
+    commands are transmitted when the outermost batch ends.
+    """
+    self.batch_depth += 1
+
+  def end_batch(self):
+    assert self.batch_depth > 0, 'end_batch called without begin_batch'
+    self.batch_depth -= 1
+    if not self.batch_depth:
+      self.batch_slot = None
+      self.send_queued_commands_()
+
+  def get_stats(self):
+    """Returns a dict of statistics about commands sent to this controller."""
+    latencies = sorted(self.latencies)
+    return {
+        'latency_samples': len(latencies),
+        'latency_p50_seconds': _percentile(latencies, 0.5) if latencies else None,
+        'latency_p99_seconds': _percentile(latencies, 0.99) if latencies else None,
+        'command_expiry_seconds': self.command_expiry_seconds,
+        'expired_count': self.expired_count,
+        'lost_reply_count': self.lost_reply_count,
+        'suppressed_setpoint_counts': dict(self.suppressed_setpoint_counts),
+        'coalesced_setpoint_counts': dict(self.coalesced_setpoint_counts),
+    }
 
   def write_variable(self, variable, value, callback=None):
     """Writes a variable to user flash. This variable will be persisted across restarts."""
@@ -140,3 +424,23 @@ class MotorController(basic.LineOnlyReceiver):
 
   def _validate_channel(self, channel):
     assert channel >= 1 and channel <= self.num_channels, 'Invalid channel: %d' % channel
+
+
+def _reply_matches(subcommand, reply):
+  """Returns True if reply could be the controller's reply to a single command."""
+  if reply == '-':
+    # Any command may be rejected.
+    return True
+  name = subcommand.split()[0] if subcommand.strip() else ''
+  if name[:1] in ('?', '~'):
+    # Queries such as '?C 1' and '~ee 3' reply with the upper case name and a value: 'C=10'.
+    return reply.startswith(name[1:].upper() + '=')
+  if name[:1] in ('!', '^', '%'):
+    # Commands, configuration writes and maintenance commands are acknowledged.
+    return reply == '+'
+  return True
+
+
+def _percentile(sorted_values, fraction):
+  """Returns the value at the given fraction (between 0 and 1) of a non-empty sorted list."""
+  return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
@@ -0,0 +1,348 @@
+"""Tests for motor_controller."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import unittest
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+import motor_controller
+from motor_controller import MotorController
+
+
+class SerialControllerTestCase(unittest.TestCase):
+  """Runs a MotorController against a fake serial transport, without simulated replies."""
+
+  def setUp(self):
+    self.clock = task.Clock()
+
+  def create_controller(self, **kwargs):
+    self.controller = MotorController(self.clock, '', 2, **kwargs)
+    self.controller.simulate = False
+    self.transport = proto_helpers.StringTransport()
+    self.controller.makeConnection(self.transport)
+
+  def sent_lines(self):
+    """Returns the lines transmitted since the last call."""
+    lines = self.transport.value().split(MotorController.delimiter)[:-1]
+    self.transport.clear()
+    return lines
+
+  def receive(self, *lines):
+    for line in lines:
+      self.controller.dataReceived(line + MotorController.delimiter)
+
+
+class PercentileTest(unittest.TestCase):
+
+  def test_single_value(self):
+    self.assertEqual(7, motor_controller._percentile([7], 0.5))
+    self.assertEqual(7, motor_controller._percentile([7], 0.99))
+
+  def test_fractions(self):
+    values = range(100)
+    self.assertEqual(0, motor_controller._percentile(values, 0))
+    self.assertEqual(50, motor_controller._percentile(values, 0.5))
+    self.assertEqual(99, motor_controller._percentile(values, 0.99))
+
+  def test_fraction_one_is_last_value(self):
+    self.assertEqual(9, motor_controller._percentile(range(10), 1.0))
+
+
+class CommandExpiryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = task.Clock()
+    # Simulated, so replies arrive SIMULATION_DELAY_SECONDS after each command is sent.
+    self.controller = MotorController(self.clock, '', 2)
+
+  def silence_controller(self):
+    self.controller.simulate_reply_ = lambda command: None
+
+  def test_initial_expiry(self):
+    self.assertEqual(motor_controller.COMMAND_EXPIRY_SECONDS,
+                     self.controller.command_expiry_seconds)
+
+  def test_expiry_adapts_to_measured_latency(self):
+    for _ in xrange(motor_controller.LATENCY_MIN_SAMPLES):
+      self.controller.send_command('?V')
+      self.clock.advance(motor_controller.SIMULATION_DELAY_SECONDS)
+    self.assertAlmostEqual(
+        motor_controller.SIMULATION_DELAY_SECONDS * motor_controller.LATENCY_EXPIRY_MULTIPLIER,
+        self.controller.command_expiry_seconds)
+    self.assertEqual(0, self.controller.expired_count)
+
+  def test_expiry_is_bounded_below(self):
+    self.controller.min_command_expiry_seconds = 0.3
+    for _ in xrange(motor_controller.LATENCY_MIN_SAMPLES):
+      self.controller.send_command('?V')
+      self.clock.advance(motor_controller.SIMULATION_DELAY_SECONDS)
+    self.assertEqual(0.3, self.controller.command_expiry_seconds)
+
+  def test_expiry_backs_off_up_to_maximum(self):
+    self.silence_controller()
+    expected_expiries = [0.3, 0.5, 0.5]
+    for count, expected_expiry in enumerate(expected_expiries, 1):
+      self.controller.send_command('?V')
+      self.clock.advance(self.controller.command_expiry_seconds)
+      self.assertEqual(count, self.controller.expired_count)
+      self.assertAlmostEqual(expected_expiry, self.controller.command_expiry_seconds)
+
+  def test_expiry_is_not_shrunk_by_earlier_latencies(self):
+    for _ in xrange(motor_controller.LATENCY_MIN_SAMPLES):
+      self.controller.send_command('?V')
+      self.clock.advance(motor_controller.SIMULATION_DELAY_SECONDS)
+    self.silence_controller()
+    self.controller.send_command('?V')
+    self.clock.advance(self.controller.command_expiry_seconds)
+    self.assertAlmostEqual(0.4, self.controller.command_expiry_seconds)
+    # Only the censored latency of the expired command is left to compute the expiry from.
+    self.assertEqual(1, len(self.controller.latencies))
+
+  def test_late_reply_latency_is_not_recorded(self):
+    self.silence_controller()
+    self.controller.send_command('?V')
+    self.clock.advance(motor_controller.COMMAND_EXPIRY_SECONDS)
+    self.controller.send_command('?V')
+    # The late echo and reply to the expired command are matched to the identical second command.
+    self.clock.advance(0.01)
+    self.controller.lineReceived('?V')
+    self.controller.lineReceived('V=0')
+    self.assertFalse(self.controller.in_flight)
+    self.assertEqual([motor_controller.COMMAND_EXPIRY_SECONDS], list(self.controller.latencies))
+
+  def test_get_stats(self):
+    self.controller.send_command('?V')
+    self.clock.advance(motor_controller.SIMULATION_DELAY_SECONDS)
+    stats = self.controller.get_stats()
+    self.assertEqual(1, stats['latency_samples'])
+    self.assertAlmostEqual(motor_controller.SIMULATION_DELAY_SECONDS,
+                           stats['latency_p50_seconds'])
+    self.assertEqual(0, stats['expired_count'])
+
+
+class PipeliningTest(SerialControllerTestCase):
+
+  def setUp(self):
+    SerialControllerTestCase.setUp(self)
+    self.create_controller(max_commands_in_flight=2)
+    self.replies = []
+
+  def send(self, command):
+    self.controller.send_command(command, callback=lambda reply: self.replies.append(reply))
+
+  def test_window_limits_commands_in_flight(self):
+    for command in ('?C', '?A', '?T'):
+      self.send(command)
+    self.assertEqual(['?C', '?A'], self.sent_lines())
+    self.receive('?C', 'C=1')
+    self.assertEqual(['?T'], self.sent_lines())
+    self.assertEqual(['C=1'], self.replies)
+
+  def test_echo_of_later_command_before_reply(self):
+    self.send('?C')
+    self.send('~ee 1')
+    self.receive('?C', '~ee 1', 'C=5', 'EE=7')
+    self.assertEqual(['C=5', 'EE=7'], self.replies)
+    self.assertFalse(self.controller.in_flight)
+
+  def test_replies_to_one_line_on_separate_lines(self):
+    self.send('?C_?A')
+    self.receive('?C_?A', 'C=1', 'A=2')
+    self.assertEqual(['C=1_A=2'], self.replies)
+
+  def test_reply_of_wrong_kind_is_ignored(self):
+    self.send('?C')
+    self.receive('?C', '+', 'A=1')
+    self.assertEqual([], self.replies)
+    self.receive('C=3')
+    self.assertEqual(['C=3'], self.replies)
+
+  def test_rejected_command(self):
+    self.send('~ee 1')
+    self.receive('~ee 1', '-')
+    self.assertEqual(['-'], self.replies)
+
+  def test_lost_query_reply(self):
+    self.send('~ee 1')
+    self.send('!G 1 5')
+    self.receive('~ee 1', '!G 1 5', '+')
+    self.assertEqual(['EXPIRED', '+'], self.replies)
+    self.assertEqual(1, self.controller.lost_reply_count)
+    self.assertFalse(self.controller.in_flight)
+    # A lost reply says nothing about latency, so the expiry doesn't back off.
+    self.assertEqual(motor_controller.COMMAND_EXPIRY_SECONDS,
+                     self.controller.command_expiry_seconds)
+    self.assertFalse(self.clock.getDelayedCalls())
+
+  def test_lost_acknowledgement(self):
+    self.send('!G 1 5')
+    self.send('?C')
+    self.receive('!G 1 5', '?C', 'C=3')
+    self.assertEqual(['EXPIRED', 'C=3'], self.replies)
+    self.send('?A')
+    self.send('?T')
+    self.receive('?A', '?T', 'A=1', 'T=2')
+    self.assertEqual(['EXPIRED', 'C=3', 'A=1', 'T=2'], self.replies)
+
+  def test_lost_reply_frees_window(self):
+    self.send('?C')
+    self.send('?A')
+    self.send('?T')
+    self.assertEqual(['?C', '?A'], self.sent_lines())
+    self.receive('?C', '?A', 'A=1')
+    self.assertEqual(['?T'], self.sent_lines())
+
+  def test_read_variable_in_simulation(self):
+    controller = MotorController(self.clock, '', 2)
+    values = []
+    controller.read_variable(3, values.append)
+    self.clock.advance(motor_controller.SIMULATION_DELAY_SECONDS)
+    self.assertEqual([0], values)
+
+
+class SetpointSlotTest(SerialControllerTestCase):
+
+  def setUp(self):
+    SerialControllerTestCase.setUp(self)
+    self.create_controller()
+
+  def test_latest_setpoint_is_sent(self):
+    self.controller.send_command('?V')
+    for value in (0.1, 0.2, 0.3):
+      self.controller.go(1, value)
+    self.receive('?V', 'V=240')
+    self.assertEqual(['?V', '!G 1 300'], self.sent_lines())
+    self.assertEqual({1: 2}, self.controller.get_stats()['coalesced_setpoint_counts'])
+
+  def test_slot_keeps_its_place_in_the_queue(self):
+    self.controller.send_command('?V')
+    self.controller.go(1, 0.1)
+    self.controller.send_command('?T')
+    self.controller.go(1, 0.2)
+    self.receive('?V', 'V=240')
+    self.assertEqual(['?V', '!G 1 200'], self.sent_lines())
+    self.receive('!G 1 200', '+')
+    self.assertEqual(['?T'], self.sent_lines())
+
+  def test_transmitted_setpoint_is_untouched(self):
+    self.controller.go(1, 0.1)
+    self.controller.go(1, 0.2)
+    self.assertEqual(['!G 1 100'], self.sent_lines())
+    self.assertEqual('!G 1 100', self.controller.in_flight[0].command)
+    self.receive('!G 1 100', '+')
+    self.assertEqual(['!G 1 200'], self.sent_lines())
+
+  def test_stale_slot_is_not_sent_again(self):
+    self.controller.go(1, 0.1)
+    self.receive('!G 1 100', '+')
+    self.assertEqual(['!G 1 100'], self.sent_lines())
+    self.assertFalse(self.controller.setpoint_slots)
+    self.controller.send_command('?V')
+    self.receive('?V', 'V=240')
+    self.assertEqual(['?V'], self.sent_lines())
+    self.assertFalse(self.controller.command_queue)
+
+
+class GoMultipleTest(SerialControllerTestCase):
+
+  def setUp(self):
+    SerialControllerTestCase.setUp(self)
+    self.create_controller()
+
+  def test_channels_are_sent_on_one_line(self):
+    self.controller.go_multiple({2: -0.5, 1: 0.25})
+    self.assertEqual(['!G 1 250_!G 2 -500'], self.sent_lines())
+
+  def test_each_channel_gets_its_own_reply(self):
+    self.controller.go_multiple({1: 0.1, 2: 0.2})
+    self.receive('!G 1 100_!G 2 200', '+', '-')
+    self.assertEqual({1: 100}, self.controller.last_acknowledged_setpoints)
+    self.controller.go_multiple({1: 0.3, 2: 0.4})
+    # The controller may also echo the commands one at a time, and reply on one line.
+    self.receive('!G 1 300', '!G 2 400', '-_+')
+    self.assertEqual({1: 100, 2: 400}, self.controller.last_acknowledged_setpoints)
+    self.assertFalse(self.controller.in_flight)
+
+  def test_callback_gets_every_reply(self):
+    replies = []
+    self.controller.send_command('?C_~ee 1', callback=replies.append)
+    self.receive('?C_~ee 1', 'C=5', 'EE=7')
+    self.assertEqual(['C=5_EE=7'], replies)
+
+  def test_pair_is_coalesced(self):
+    self.controller.send_command('?V')
+    self.controller.go_multiple({1: 0.1, 2: 0.2})
+    self.controller.go_multiple({1: 0.3, 2: 0.4})
+    self.receive('?V', 'V=240')
+    self.assertEqual(['?V', '!G 1 300_!G 2 400'], self.sent_lines())
+
+  def test_channel_joins_queued_setpoint(self):
+    self.controller.send_command('?V')
+    self.controller.go(1, 0.1)
+    self.controller.go_multiple({1: 0.3, 2: 0.4})
+    self.receive('?V', 'V=240')
+    self.assertEqual(['?V', '!G 1 300_!G 2 400'], self.sent_lines())
+
+  def test_batch(self):
+    self.controller.begin_batch()
+    self.controller.go(1, 0.1)
+    self.controller.go(2, 0.2)
+    self.assertEqual([], self.sent_lines())
+    self.controller.end_batch()
+    self.assertEqual(['!G 1 100_!G 2 200'], self.sent_lines())
+
+
+class SetpointDeadbandTest(SerialControllerTestCase):
+
+  def setUp(self):
+    SerialControllerTestCase.setUp(self)
+    self.create_controller(setpoint_deadband=5)
+
+  def test_setpoint_inside_deadband_is_not_sent(self):
+    self.controller.go(1, 0.1)
+    self.receive('!G 1 100', '+')
+    self.controller.go(1, 0.104)
+    self.controller.go(1, 0.095)
+    self.assertEqual(['!G 1 100'], self.sent_lines())
+    self.assertFalse(self.controller.command_queue)
+    self.assertEqual({1: 2}, self.controller.get_stats()['suppressed_setpoint_counts'])
+    self.controller.go(1, 0.106)
+    self.assertEqual(['!G 1 106'], self.sent_lines())
+
+  def test_deadband_is_per_channel(self):
+    self.controller.go(1, 0.1)
+    self.receive('!G 1 100', '+')
+    self.controller.go(2, 0.1)
+    self.assertEqual(['!G 1 100', '!G 2 100'], self.sent_lines())
+
+  def test_expired_setpoint_rolls_back_to_last_acknowledged(self):
+    self.controller.go(1, 0.1)
+    self.receive('!G 1 100', '+')
+    self.controller.go(1, 0.2)
+    self.clock.advance(self.controller.command_expiry_seconds)
+    self.assertEqual(1, self.controller.expired_count)
+    self.assertEqual(100, self.controller.last_sent_setpoints[1])
+    # The expired setpoint may never have reached the motor, so it isn't suppressed.
+    self.controller.go(1, 0.2)
+    self.assertEqual(['!G 1 100', '!G 1 200', '!G 1 200'], self.sent_lines())
+
+  def test_expired_first_setpoint_is_forgotten(self):
+    self.controller.go(1, 0.1)
+    self.clock.advance(self.controller.command_expiry_seconds)
+    self.assertNotIn(1, self.controller.last_sent_setpoints)
+    self.controller.go(1, 0.1)
+    self.assertEqual(['!G 1 100', '!G 1 100'], self.sent_lines())
+
+  def test_expiry_keeps_newer_setpoint(self):
+    self.create_controller(setpoint_deadband=5, max_commands_in_flight=2)
+    self.controller.go(1, 0.1)
+    self.clock.advance(0.05)
+    self.controller.go(1, 0.2)
+    self.clock.advance(self.controller.command_expiry_seconds - 0.05)
+    self.assertEqual(1, self.controller.expired_count)
+    self.assertEqual(200, self.controller.last_sent_setpoints[1])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+"""Periodically polls a motor controller for telemetry such as encoder position and current."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import collections
+import logging
+
+from twisted.internet import task
+
+from motor_controller import COMMAND_SEPARATOR
+
+# Runtime queries sent on each poll. Without a channel argument, the controller replies with the
+# values for all channels, separated by colons.
+ENCODER_COUNT_QUERY = '?C'
+MOTOR_AMPS_QUERY = '?A'
+TEMPERATURE_QUERY = '?T'
+FAULT_FLAGS_QUERY = '?FF'
+TELEMETRY_QUERIES = (ENCODER_COUNT_QUERY, MOTOR_AMPS_QUERY, TEMPERATURE_QUERY, FAULT_FLAGS_QUERY)
+# While setpoint commands are waiting for the serial link, polls are skipped for an increasing
+# number of intervals, up to this many.
+MAX_BACKOFF_INTERVALS = 16
+
+
+class TelemetryParseException(Exception):
+  pass
+
+
+class TelemetrySample(object):
+  def __init__(self, time, encoder_counts, motor_amps, temperatures, fault_flags):
+    self.time = time
+    # Lists with one value per channel (or, for temperatures, per sensor).
+    self.encoder_counts = encoder_counts
+    self.motor_amps = motor_amps
+    self.temperatures = temperatures
+    self.fault_flags = fault_flags
+
+  def __str__(self):
+    return 'TelemetrySample[time=%.3f encoder=%s amps=%s temperature=%s faults=%d]' % (
+        self.time, self.encoder_counts, self.motor_amps, self.temperatures, self.fault_flags)
+
+
+class MotorTelemetry(object):
+  """Polls a MotorController for telemetry and keeps the most recent samples.
+
+  All queries for a poll are sent on a single command line at low priority, so they never delay
+  setpoint commands. Samples are kept in a fixed size ring buffer. The latest sample is logged
+  periodically, and a warning is logged whenever the fault flags change.
+  """
+
+  def __init__(self, reactor, motor_controller, name, interval_seconds=0.5, buffer_size=1000,
+               log_interval_seconds=60):
+    """Initializes a MotorTelemetry and starts polling.
+
+    Args:
+      reactor: The twisted.internet.reactor module.
+      motor_controller: An instance of motor_controller.MotorController.
+      name: The name of the searchlight the motor controller drives, for logging.
+      interval_seconds: The time between polls while the serial link is not busy.
+      buffer_size: The number of samples to keep.
+      log_interval_seconds: The time between logs of the latest sample.
+    """
+    self.reactor = reactor
+    self.motor_controller = motor_controller
+    self.name = name
+    self.samples = collections.deque(maxlen=buffer_size)
+    self.poll_command = COMMAND_SEPARATOR.join(TELEMETRY_QUERIES)
+    self.poll_pending = False
+    # Number of intervals to wait between polls, and number left to wait before the next one.
+    self.backoff_intervals = 1
+    self.intervals_to_skip = 0
+    self.skipped_poll_count = 0
+    self.failed_poll_count = 0
+    self.task_ = task.LoopingCall(self.poll_)
+    self.task_.clock = reactor
+    self.task_.start(interval_seconds)
+    self.log_task_ = task.LoopingCall(self.log_latest_sample_)
+    self.log_task_.clock = reactor
+    self.log_task_.start(log_interval_seconds, now=False)
+
+  def stop(self):
+    self.task_.stop()
+    self.log_task_.stop()
+
+  def get_latest_sample(self):
+    return self.samples[-1] if self.samples else None
+
+  def poll_(self):
+    if self.intervals_to_skip:
+      self.intervals_to_skip -= 1
+      return
+    if self.poll_pending or self.motor_controller.command_queue:
+      # Either the last poll hasn't been answered, or setpoints are waiting for the link. Back off.
+      self.skipped_poll_count += 1
+      self.backoff_intervals = min(2 * self.backoff_intervals, MAX_BACKOFF_INTERVALS)
+      self.intervals_to_skip = self.backoff_intervals - 1
+      return
+    self.backoff_intervals = 1
+    self.poll_pending = True
+    self.motor_controller.send_command(
+        self.poll_command, callback=self.on_poll_reply_, low_priority=True)
+
+  def on_poll_reply_(self, reply):
+    self.poll_pending = False
+    try:
+      sample = self.parse_reply_(reply)
+    except TelemetryParseException:
+      self.failed_poll_count += 1
+      logging.debug('Controller %s: invalid telemetry reply %s',
+                    self.motor_controller.serial_port, reply)
+      return
+    previous_sample = self.get_latest_sample()
+    if sample.fault_flags != (previous_sample.fault_flags if previous_sample else 0):
+      logging.warning('Searchlight %s: motor controller fault flags changed to %d',
+                      self.name, sample.fault_flags)
+    self.samples.append(sample)
+
+  def log_latest_sample_(self):
+    logging.info('Searchlight %s: %s (%d polls skipped, %d failed)', self.name,
+                 self.get_latest_sample(), self.skipped_poll_count, self.failed_poll_count)
+
+  def parse_reply_(self, reply):
+    replies = reply.split(COMMAND_SEPARATOR)
+    if len(replies) != len(TELEMETRY_QUERIES):
+      raise TelemetryParseException('Expected %d replies' % len(TELEMETRY_QUERIES))
+    values = []
+    for query, query_reply in zip(TELEMETRY_QUERIES, replies):
+      name, _, raw_values = query_reply.partition('=')
+      if name != query[1:]:
+        raise TelemetryParseException('Unexpected reply %s to %s' % (query_reply, query))
+      try:
+        values.append([int(value) for value in raw_values.split(':')])
+      except ValueError:
+        raise TelemetryParseException('Invalid values in %s' % query_reply)
+    encoder_counts, motor_amps, temperatures, fault_flags = values
+    # Motor current is reported in tenths of an amp.
+    return TelemetrySample(self.reactor.seconds(), encoder_counts,
+                           [amps / 10.0 for amps in motor_amps], temperatures, fault_flags[0])
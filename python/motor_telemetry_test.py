@@ -0,0 +1,126 @@
+"""Tests for motor_telemetry."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import unittest
+
+from twisted.internet import task
+
+import motor_telemetry
+from motor_telemetry import MotorTelemetry
+from motor_telemetry import TelemetryParseException
+
+INTERVAL_SECONDS = 0.5
+REPLY = 'C=100:-200_A=15:80_T=30:31_FF=0'
+
+
+class FakeMotorController(object):
+
+  def __init__(self):
+    self.serial_port = 'fake'
+    self.command_queue = []
+    # List of (command, callback, low_priority).
+    self.commands = []
+
+  def send_command(self, command, callback=None, low_priority=False):
+    self.commands.append((command, callback, low_priority))
+
+  def reply(self, reply):
+    unused_command, callback, unused_low_priority = self.commands[-1]
+    callback(reply)
+
+
+class MotorTelemetryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.motor_controller = FakeMotorController()
+
+  def create_telemetry(self, **kwargs):
+    self.telemetry = MotorTelemetry(
+        self.clock, self.motor_controller, 'test', interval_seconds=INTERVAL_SECONDS, **kwargs)
+    self.addCleanup(self.telemetry.stop)
+
+  def poll_times(self, intervals):
+    """Returns the times, in intervals, at which polls were sent, replying to each at once."""
+    first_command = len(self.motor_controller.commands)
+    times = []
+    for interval in xrange(intervals):
+      if len(self.motor_controller.commands) - first_command > len(times):
+        times.append(interval)
+        self.motor_controller.reply(REPLY)
+      self.clock.advance(INTERVAL_SECONDS)
+    return times
+
+  def test_polls_at_low_priority_on_one_line(self):
+    self.create_telemetry()
+    self.assertEqual([('?C_?A_?T_?FF', self.telemetry.on_poll_reply_, True)],
+                     self.motor_controller.commands)
+
+  def test_parses_reply(self):
+    self.create_telemetry()
+    self.clock.advance(1)
+    self.motor_controller.reply(REPLY)
+    sample = self.telemetry.get_latest_sample()
+    self.assertEqual(1, sample.time)
+    self.assertEqual([100, -200], sample.encoder_counts)
+    self.assertEqual([1.5, 8.0], sample.motor_amps)
+    self.assertEqual([30, 31], sample.temperatures)
+    self.assertEqual(0, sample.fault_flags)
+
+  def test_invalid_replies(self):
+    self.create_telemetry()
+    for reply in ('EXPIRED', 'C=1_A=1_T=1', 'C=1_A=1_T=1_V=1', 'C=1_A=x_T=1_FF=0',
+                  'C=1_A=1_T=1_FF=0_+'):
+      self.assertRaises(TelemetryParseException, self.telemetry.parse_reply_, reply)
+      self.motor_controller.reply(reply)
+    self.assertEqual(None, self.telemetry.get_latest_sample())
+    self.assertEqual(5, self.telemetry.failed_poll_count)
+
+  def test_ring_buffer_wraps(self):
+    self.create_telemetry(buffer_size=3)
+    for index in xrange(5):
+      self.clock.advance(INTERVAL_SECONDS)
+      self.motor_controller.reply('C=%d_A=0_T=0_FF=0' % index)
+    self.assertEqual([[2], [3], [4]], [sample.encoder_counts for sample in self.telemetry.samples])
+    self.assertEqual([4], self.telemetry.get_latest_sample().encoder_counts)
+
+  def test_polls_every_interval_while_idle(self):
+    self.create_telemetry()
+    self.motor_controller.reply(REPLY)
+    self.assertEqual(range(1, 6), self.poll_times(6))
+
+  def test_backs_off_while_setpoints_are_queued(self):
+    self.create_telemetry()
+    self.motor_controller.reply(REPLY)
+    self.motor_controller.command_queue.append('!G 1 100')
+    self.clock.pump([INTERVAL_SECONDS] * 40)
+    self.assertEqual(1, len(self.motor_controller.commands))
+    # Polls were tried 1, 2, 4, 8 and 16 intervals apart.
+    self.assertEqual(5, self.telemetry.skipped_poll_count)
+    self.assertEqual(motor_telemetry.MAX_BACKOFF_INTERVALS, self.telemetry.backoff_intervals)
+    # The next poll is sent once the current backoff has passed, and then every interval again.
+    self.motor_controller.command_queue.pop()
+    self.assertEqual(range(7, 15), self.poll_times(15))
+
+  def test_backs_off_while_poll_is_unanswered(self):
+    self.create_telemetry()
+    self.clock.pump([INTERVAL_SECONDS] * 3)
+    self.assertEqual(1, len(self.motor_controller.commands))
+    self.assertEqual(2, self.telemetry.skipped_poll_count)
+
+  def test_warns_when_fault_flags_change(self):
+    self.create_telemetry()
+    warnings = []
+    original_warning = motor_telemetry.logging.warning
+    motor_telemetry.logging.warning = lambda *args: warnings.append(args[-1])
+    try:
+      for fault_flags in (0, 4, 4, 0):
+        self.motor_controller.reply('C=0_A=0_T=0_FF=%d' % fault_flags)
+    finally:
+      motor_telemetry.logging.warning = original_warning
+    self.assertEqual([4, 0], warnings)
+
+
+if __name__ == '__main__':
+  unittest.main()
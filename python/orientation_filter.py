@@ -0,0 +1,92 @@
+"""Smooths controller orientations, and estimates how fast they are changing.
+
+Uses the 1 Euro filter (Casiez, Roussel and Vogel, CHI 2012): a low-pass filter whose cutoff
+frequency rises with speed. Slow movements are smoothed heavily, which removes hand jitter while
+aiming steadily, and fast movements are smoothed lightly, which keeps lag low during gestures.
+"""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import math
+
+
+def _smoothing_factor(cutoff_hz, dt):
+  tau = 1 / (2 * math.pi * cutoff_hz)
+  return 1 / (1 + tau / dt)
+
+
+class OneEuroFilter(object):
+  """Filters a single value. Also estimates its rate of change."""
+
+  def __init__(self, min_cutoff_hz=1.0, beta=0.0, derivative_cutoff_hz=1.0):
+    """Initializes a OneEuroFilter.
+
+    Args:
+      min_cutoff_hz: The cutoff frequency when the value is not changing. Lower removes more
+        jitter.
+      beta: How much the cutoff frequency rises with speed, in Hz per unit per second. Higher
+        reduces lag during fast movements.
+      derivative_cutoff_hz: The cutoff frequency for the rate of change estimate.
+    """
+    self.min_cutoff_hz = min_cutoff_hz
+    self.beta = beta
+    self.derivative_cutoff_hz = derivative_cutoff_hz
+    self.reset()
+
+  def reset(self):
+    self.value = None
+    self.velocity = 0
+    self.last_sample = None
+    self.last_time = None
+
+  def filter(self, value, timestamp):
+    """Returns the filtered value, given a new sample taken at timestamp (in seconds)."""
+    if self.last_time is None or timestamp <= self.last_time:
+      if self.last_time is None:
+        self.value = value
+      self.last_sample = value
+      self.last_time = timestamp
+      return self.value
+    dt = timestamp - self.last_time
+    # The rate of change is taken from successive samples rather than from the filtered value,
+    # which lags behind them, so that it can be used for prediction.
+    velocity = (value - self.last_sample) / dt
+    self.last_sample = value
+    self.last_time = timestamp
+    self.velocity += _smoothing_factor(self.derivative_cutoff_hz, dt) * (velocity - self.velocity)
+    cutoff_hz = self.min_cutoff_hz + self.beta * abs(self.velocity)
+    self.value += _smoothing_factor(cutoff_hz, dt) * (value - self.value)
+    return self.value
+
+
+class OrientationFilter(object):
+  """Filters azimuth and elevation angles, in radians."""
+
+  def __init__(self, **filter_args):
+    """Initializes an OrientationFilter.
+
+    Args:
+      filter_args: Keyword arguments for the OneEuroFilter used for each angle.
+    """
+    self.azimuth_filter = OneEuroFilter(**filter_args)
+    self.elevation_filter = OneEuroFilter(**filter_args)
+
+  def reset(self):
+    self.azimuth_filter.reset()
+    self.elevation_filter.reset()
+
+  def filter(self, azimuth, elevation, timestamp):
+    """Returns a tuple (azimuth, elevation, azimuth velocity, elevation velocity).
+
+    Velocities are in radians per second.
+    """
+    previous_azimuth = self.azimuth_filter.value
+    if previous_azimuth is not None:
+      # Azimuth wraps around at +/- pi. Filter the nearest equivalent angle, so that crossing
+      # the wrap doesn't look like a fast swing all the way round.
+      azimuth = previous_azimuth + math.atan2(
+          math.sin(azimuth - previous_azimuth), math.cos(azimuth - previous_azimuth))
+    filtered_azimuth = self.azimuth_filter.filter(azimuth, timestamp)
+    filtered_elevation = self.elevation_filter.filter(elevation, timestamp)
+    return (math.atan2(math.sin(filtered_azimuth), math.cos(filtered_azimuth)),
+            filtered_elevation, self.azimuth_filter.velocity, self.elevation_filter.velocity)
@@ -0,0 +1,94 @@
+"""Tests for orientation_filter."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import math
+import random
+import unittest
+
+from orientation_filter import OneEuroFilter
+from orientation_filter import OrientationFilter
+
+# The PSMove reports orientation at about this interval.
+SAMPLE_SECONDS = 0.01
+
+
+class OneEuroFilterTest(unittest.TestCase):
+
+  def test_first_sample_passes_through(self):
+    self.assertEqual(0.5, OneEuroFilter().filter(0.5, 0))
+
+  def test_constant_input(self):
+    one_euro_filter = OneEuroFilter()
+    for index in xrange(100):
+      self.assertAlmostEqual(0.5, one_euro_filter.filter(0.5, index * SAMPLE_SECONDS))
+    self.assertAlmostEqual(0, one_euro_filter.velocity)
+
+  def test_smooths_jitter(self):
+    one_euro_filter = OneEuroFilter(min_cutoff_hz=1.0)
+    rng = random.Random(0)
+    outputs = []
+    for index in xrange(500):
+      outputs.append(one_euro_filter.filter(rng.uniform(-0.01, 0.01), index * SAMPLE_SECONDS))
+    # Ignore the first second, while the filter settles. The input spans 0.02.
+    settled = outputs[100:]
+    self.assertTrue(max(settled) - min(settled) < 0.006, max(settled) - min(settled))
+
+  def test_ramp_velocity(self):
+    one_euro_filter = OneEuroFilter(beta=0.5)
+    for index in xrange(300):
+      one_euro_filter.filter(1.0 * index * SAMPLE_SECONDS, index * SAMPLE_SECONDS)
+    self.assertAlmostEqual(1.0, one_euro_filter.velocity, places=3)
+
+  def test_beta_reduces_lag(self):
+    lags = []
+    for beta in (0, 1.0):
+      one_euro_filter = OneEuroFilter(beta=beta)
+      for index in xrange(300):
+        value = one_euro_filter.filter(1.0 * index * SAMPLE_SECONDS, index * SAMPLE_SECONDS)
+      lags.append(1.0 * index * SAMPLE_SECONDS - value)
+    self.assertTrue(lags[1] < 0.75 * lags[0], lags)
+
+  def test_repeated_timestamp_is_ignored(self):
+    one_euro_filter = OneEuroFilter()
+    one_euro_filter.filter(0, 0)
+    self.assertEqual(0, one_euro_filter.filter(1, 0))
+    self.assertEqual(0, one_euro_filter.velocity)
+
+  def test_reset(self):
+    one_euro_filter = OneEuroFilter()
+    one_euro_filter.filter(0, 0)
+    one_euro_filter.filter(1, SAMPLE_SECONDS)
+    one_euro_filter.reset()
+    self.assertEqual(5, one_euro_filter.filter(5, 1))
+    self.assertEqual(0, one_euro_filter.velocity)
+
+
+class OrientationFilterTest(unittest.TestCase):
+
+  def test_azimuth_wraps(self):
+    orientation_filter = OrientationFilter(beta=0.5)
+    # Turn steadily through +/- pi at 1 radian per second.
+    azimuth = math.pi - 1
+    for index in xrange(200):
+      wrapped_azimuth = math.atan2(math.sin(azimuth), math.cos(azimuth))
+      filtered_azimuth, unused_elevation, azimuth_velocity, unused_elevation_velocity = (
+          orientation_filter.filter(wrapped_azimuth, 0, index * SAMPLE_SECONDS))
+      azimuth += SAMPLE_SECONDS
+    self.assertTrue(-math.pi <= filtered_azimuth <= math.pi)
+    # The last sample was at pi + 0.99, or -pi + 0.99. The filter lags by about 0.1 radians, but
+    # doesn't swing back round towards pi.
+    self.assertAlmostEqual(-math.pi + 0.99, filtered_azimuth, delta=0.15)
+    self.assertAlmostEqual(1.0, azimuth_velocity, places=2)
+
+  def test_elevation(self):
+    orientation_filter = OrientationFilter()
+    for index in xrange(100):
+      unused_azimuth, elevation, unused_azimuth_velocity, elevation_velocity = (
+          orientation_filter.filter(0, 0.3, index * SAMPLE_SECONDS))
+    self.assertAlmostEqual(0.3, elevation)
+    self.assertAlmostEqual(0, elevation_velocity)
+
+
+if __name__ == '__main__':
+  unittest.main()
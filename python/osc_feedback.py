@@ -0,0 +1,184 @@
+"""Sends searchlight state back to OSC clients, so TouchOSC controls show where the lights are.
+
+For each searchlight, the publisher sends the commanded motor positions as raw_azimuth and
+raw_elevation, and the stored limits as azimuth_lower_limit, azimuth_upper_limit and
+elevation_limit. Values are scaled the same way the searchlight's OSC handlers scale the values
+they receive, so each control moves to the position that would command the current state.
+
+Clients are either listed in the config, or any host which sent us OSC recently. State is sampled
+once per tick, and only values which changed since they were last sent to a client are sent to it,
+no more often than once per client interval. A client's changed values are sent together in one
+bundle. This keeps the feedback traffic small, so that it doesn't compete with control messages on
+the shared WiFi.
+"""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import logging
+import socket
+
+from twisted.internet import protocol
+from twisted.internet import task
+from txosc import osc
+
+from motor_controller import SETPOINT_SCALE
+from searchlight import AZIMUTH_CHANNEL
+from searchlight import ELEVATION_CHANNEL
+
+# TouchOSC listens on this port by default.
+DEFAULT_FEEDBACK_PORT = 9000
+# Values which differ from those last sent by less than this are not sent again.
+FEEDBACK_EPSILON = 0.001
+# Bundles are split so that each fits in a single Ethernet frame, with room for the IP and UDP
+# headers.
+MAX_DATAGRAM_BYTES = 1400
+# The size of a bundle's header, and of the size prefix of each element.
+BUNDLE_HEADER_BYTES = 16
+BUNDLE_ELEMENT_HEADER_BYTES = 4
+
+
+def _fraction(value, lower_bound, upper_bound):
+  """Inverse of clamp_and_scale from (0, 1) to (lower_bound, upper_bound)."""
+  if upper_bound == lower_bound:
+    return 0
+  return min(max(float(value - lower_bound) / (upper_bound - lower_bound), 0), 1)
+
+
+def _is_network_client(client):
+  """Returns whether client is the (host, port) of a real sender.
+
+  Datagrams which were not received from the network, such as replayed or benchmark datagrams,
+  are passed on with a pseudo-client whose port is 0.
+  """
+  host, port = client
+  if port <= 0:
+    return False
+  try:
+    socket.inet_aton(host)
+  except socket.error:
+    return False
+  return True
+
+
+def searchlight_feedback_values(searchlight):
+  """Returns a dict mapping OSC address to the current value for a searchlight's controls."""
+  config = searchlight.config
+  values = {
+      '/%s/azimuth_lower_limit' % searchlight.name: _fraction(config.azimuth_lower_bound, -1, 1),
+      '/%s/azimuth_upper_limit' % searchlight.name: _fraction(config.azimuth_upper_bound, -1, 1),
+      '/%s/elevation_limit' % searchlight.name: _fraction(config.elevation_lower_bound, -1, 1),
+  }
+  setpoints = searchlight.motor_controller.last_sent_setpoints
+  if AZIMUTH_CHANNEL in setpoints:
+    values['/%s/raw_azimuth' % searchlight.name] = _fraction(
+        float(setpoints[AZIMUTH_CHANNEL]) / SETPOINT_SCALE,
+        config.azimuth_lower_bound, config.azimuth_upper_bound)
+  if ELEVATION_CHANNEL in setpoints:
+    values['/%s/raw_elevation' % searchlight.name] = _fraction(
+        float(setpoints[ELEVATION_CHANNEL]) / SETPOINT_SCALE,
+        config.elevation_lower_bound, config.elevation_upper_bound)
+  return values
+
+
+class _FeedbackClient(object):
+
+  def __init__(self, address, registered):
+    self.address = address
+    self.registered = registered
+    self.last_seen_time = None
+    self.last_send_time = None
+    # Maps OSC address to the value last sent to this client.
+    self.sent_values = {}
+
+
+class FeedbackPublisher(object):
+  """Periodically sends changed searchlight state to OSC clients over UDP."""
+
+  def __init__(self, reactor, osc_handler, searchlights, port=DEFAULT_FEEDBACK_PORT, clients=None,
+               tick_seconds=0.1, client_interval_seconds=0.2, client_timeout_seconds=60):
+    """Initializes a FeedbackPublisher.
+
+    Args:
+      reactor: The twisted.internet.reactor module.
+      osc_handler: The osc_server.OscDatagramHandler for incoming OSC. Hosts it receives from are
+        sent feedback until they have been silent for client_timeout_seconds.
+      searchlights: A list of searchlight.Searchlight instances to report on.
+      port: The port to send feedback to on hosts which sent us OSC.
+      clients: A list of (host, port) pairs which are always sent feedback.
+      tick_seconds: How often state is sampled.
+      client_interval_seconds: The minimum time between sends to any one client.
+      client_timeout_seconds: How long a host which sent us OSC is sent feedback for.
+    """
+    self.reactor = reactor
+    self.searchlights = searchlights
+    self.port = port
+    self.tick_seconds = tick_seconds
+    self.client_interval_seconds = client_interval_seconds
+    self.client_timeout_seconds = client_timeout_seconds
+    # Maps (host, port) to _FeedbackClient.
+    self.clients = {}
+    for host, client_port in clients or []:
+      self.clients[(host, client_port)] = _FeedbackClient((host, client_port), registered=True)
+    self.sent_message_count = 0
+    self.sent_datagram_count = 0
+    self.sender = protocol.DatagramProtocol()
+    reactor.listenUDP(0, self.sender)
+    osc_handler.add_client_callback(self.on_client_seen_)
+    self.task_ = task.LoopingCall(self.tick_)
+    self.task_.clock = reactor
+    self.task_.start(tick_seconds)
+
+  def on_client_seen_(self, client):
+    if not _is_network_client(client):
+      return
+    address = (client[0], self.port)
+    feedback_client = self.clients.get(address)
+    if not feedback_client:
+      logging.info('Sending OSC feedback to %s:%d', *address)
+      feedback_client = self.clients[address] = _FeedbackClient(address, registered=False)
+    feedback_client.last_seen_time = self.reactor.seconds()
+
+  def tick_(self):
+    now = self.reactor.seconds()
+    values = None
+    for address, client in self.clients.items():
+      if (not client.registered and
+          now - client.last_seen_time > self.client_timeout_seconds):
+        logging.info('Stopped sending OSC feedback to %s:%d', *address)
+        del self.clients[address]
+        continue
+      # Allow half a tick of slack, so that a late tick doesn't delay the next send by a whole tick.
+      if (client.last_send_time is not None and
+          now - client.last_send_time < self.client_interval_seconds - self.tick_seconds / 2.0):
+        continue
+      if values is None:
+        # Sampled at most once per tick, however many clients there are.
+        values = {}
+        for searchlight in self.searchlights:
+          values.update(searchlight_feedback_values(searchlight))
+      self.send_changed_values_(client, values, now)
+
+  def send_changed_values_(self, client, values, now):
+    messages = []
+    bundle_bytes = BUNDLE_HEADER_BYTES
+    for osc_address, value in sorted(values.iteritems()):
+      sent_value = client.sent_values.get(osc_address)
+      if sent_value is not None and abs(value - sent_value) < FEEDBACK_EPSILON:
+        continue
+      message = osc.Message(osc_address, float(value))
+      message_bytes = BUNDLE_ELEMENT_HEADER_BYTES + len(message.toBinary())
+      if messages and bundle_bytes + message_bytes > MAX_DATAGRAM_BYTES:
+        self.send_bundle_(client, messages)
+        messages = []
+        bundle_bytes = BUNDLE_HEADER_BYTES
+      messages.append(message)
+      bundle_bytes += message_bytes
+      client.sent_values[osc_address] = value
+    if messages:
+      self.send_bundle_(client, messages)
+      client.last_send_time = now
+
+  def send_bundle_(self, client, messages):
+    self.sender.transport.write(osc.Bundle(messages).toBinary(), client.address)
+    self.sent_message_count += len(messages)
+    self.sent_datagram_count += 1
@@ -0,0 +1,187 @@
+"""Tests for osc_feedback."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import unittest
+
+from twisted.internet import task
+from txosc import osc
+
+import osc_feedback
+from osc_feedback import FeedbackPublisher
+from osc_recording import REPLAY_CLIENT
+from searchlight import AZIMUTH_CHANNEL
+from searchlight import ELEVATION_CHANNEL
+from searchlight_config import SearchlightConfig
+
+CLIENT = ('10.0.0.2', 9000)
+TICK_SECONDS = 0.1
+
+
+class FakeReactor(task.Clock):
+
+  def listenUDP(self, port, udp_protocol):
+    self.transport = FakeDatagramTransport()
+    udp_protocol.makeConnection(self.transport)
+
+
+class FakeDatagramTransport(object):
+
+  def __init__(self):
+    # List of (data, address).
+    self.datagrams = []
+
+  def write(self, data, address):
+    self.datagrams.append((data, address))
+
+
+class FakeOscHandler(object):
+
+  def add_client_callback(self, callback):
+    self.client_callback = callback
+
+
+class FakeMotorController(object):
+
+  def __init__(self):
+    self.last_sent_setpoints = {}
+
+
+class FakeSearchlight(object):
+
+  def __init__(self, name):
+    self.name = name
+    self.config = SearchlightConfig()
+    self.config.azimuth_lower_bound = -1
+    self.config.azimuth_upper_bound = 1
+    self.config.elevation_lower_bound = -1
+    self.config.elevation_upper_bound = 1
+    self.motor_controller = FakeMotorController()
+
+
+class FeedbackPublisherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.reactor = FakeReactor()
+    self.osc_handler = FakeOscHandler()
+    self.searchlight = FakeSearchlight('1')
+
+  def create_publisher(self, searchlights=None, clients=(CLIENT,)):
+    self.publisher = FeedbackPublisher(
+        self.reactor, self.osc_handler, searchlights or [self.searchlight], clients=clients,
+        tick_seconds=TICK_SECONDS, client_interval_seconds=0.2, client_timeout_seconds=60)
+    self.addCleanup(self.publisher.task_.stop)
+
+  def sent(self):
+    """Returns (address, {OSC address: value}) for each datagram sent since the last call."""
+    sent = []
+    for data, address in self.reactor.transport.datagrams:
+      bundle = osc._elementFromBinary(data)
+      self.assertIsInstance(bundle, osc.Bundle)
+      sent.append((address, dict(
+          (message.address, message.getValues()[0]) for message in bundle.getMessages())))
+    self.reactor.transport.datagrams = []
+    return sent
+
+  def test_sends_all_values_at_first(self):
+    self.searchlight.motor_controller.last_sent_setpoints = {
+        AZIMUTH_CHANNEL: 500, ELEVATION_CHANNEL: -500}
+    self.searchlight.config.elevation_lower_bound = 0
+    self.create_publisher()
+    self.assertEqual([(CLIENT, {
+        '/1/azimuth_lower_limit': 0.0,
+        '/1/azimuth_upper_limit': 1.0,
+        '/1/elevation_limit': 0.5,
+        '/1/raw_azimuth': 0.75,
+        '/1/raw_elevation': 0.0,
+    })], self.sent())
+
+  def test_sends_only_changed_values(self):
+    self.create_publisher()
+    self.sent()
+    self.reactor.advance(1)
+    self.assertEqual([], self.sent())
+    self.searchlight.motor_controller.last_sent_setpoints[AZIMUTH_CHANNEL] = -250
+    self.searchlight.config.azimuth_upper_bound = 0.5
+    self.reactor.advance(1)
+    self.assertEqual([(CLIENT, {'/1/raw_azimuth': 0.5, '/1/azimuth_upper_limit': 0.75})],
+                     self.sent())
+
+  def test_tiny_changes_are_not_sent(self):
+    self.searchlight.motor_controller.last_sent_setpoints[AZIMUTH_CHANNEL] = 0
+    self.create_publisher()
+    self.sent()
+    self.searchlight.motor_controller.last_sent_setpoints[AZIMUTH_CHANNEL] = 1
+    self.reactor.advance(1)
+    self.assertEqual([], self.sent())
+
+  def test_client_interval(self):
+    self.create_publisher()
+    self.sent()
+    send_times = []
+    for tick in xrange(1, 7):
+      self.searchlight.motor_controller.last_sent_setpoints[AZIMUTH_CHANNEL] = tick * 100
+      self.reactor.advance(TICK_SECONDS)
+      if self.sent():
+        send_times.append(tick)
+    self.assertEqual([2, 4, 6], send_times)
+
+  def test_late_tick_does_not_delay_next_send(self):
+    self.create_publisher()
+    self.sent()
+    self.reactor.advance(0.205)
+    self.searchlight.motor_controller.last_sent_setpoints[AZIMUTH_CHANNEL] = 100
+    self.publisher.tick_()
+    self.assertTrue(self.sent())
+    self.reactor.advance(0.195)
+    self.searchlight.motor_controller.last_sent_setpoints[AZIMUTH_CHANNEL] = 200
+    self.publisher.tick_()
+    self.assertTrue(self.sent())
+
+  def test_bundles_are_split(self):
+    searchlights = [FakeSearchlight(str(index)) for index in xrange(100)]
+    self.create_publisher(searchlights)
+    datagrams = self.reactor.transport.datagrams
+    self.assertTrue(len(datagrams) > 1)
+    for data, unused_address in datagrams:
+      self.assertTrue(len(data) <= osc_feedback.MAX_DATAGRAM_BYTES, len(data))
+    values = {}
+    for unused_address, datagram_values in self.sent():
+      values.update(datagram_values)
+    self.assertEqual(300, len(values))
+    self.assertEqual(300, self.publisher.sent_message_count)
+    self.assertEqual(len(datagrams), self.publisher.sent_datagram_count)
+
+  def test_clients_which_sent_osc(self):
+    self.create_publisher(clients=())
+    self.osc_handler.client_callback(('10.0.0.3', 5555))
+    self.reactor.advance(TICK_SECONDS)
+    self.assertEqual([('10.0.0.3', osc_feedback.DEFAULT_FEEDBACK_PORT)],
+                     [address for address, unused_values in self.sent()])
+
+  def test_pseudo_clients_are_skipped(self):
+    self.create_publisher(clients=())
+    for client in (REPLAY_CLIENT, ('benchmark', 0), ('10.0.0.3', 0), ('not a host', 5555)):
+      self.osc_handler.client_callback(client)
+    self.reactor.advance(TICK_SECONDS)
+    self.assertEqual({}, self.publisher.clients)
+    self.assertEqual([], self.sent())
+
+  def test_silent_clients_time_out(self):
+    self.create_publisher(clients=())
+    self.osc_handler.client_callback(('10.0.0.3', 5555))
+    self.reactor.advance(30)
+    self.osc_handler.client_callback(('10.0.0.3', 5556))
+    self.reactor.pump([TICK_SECONDS] * 599)
+    self.assertEqual(1, len(self.publisher.clients))
+    self.reactor.pump([TICK_SECONDS] * 2)
+    self.assertEqual({}, self.publisher.clients)
+
+  def test_registered_clients_do_not_time_out(self):
+    self.create_publisher()
+    self.reactor.pump([1] * 100)
+    self.assertEqual([CLIENT], self.publisher.clients.keys())
+
+
+if __name__ == '__main__':
+  unittest.main()
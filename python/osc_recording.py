@@ -0,0 +1,130 @@
+"""Records raw OSC datagrams to a compact append-only file, and replays them with their timing.
+
+A recording file starts with a header (FILE_MAGIC and a version number). The header is followed by
+one record per datagram: the arrival time as a little-endian double (seconds since the epoch), the
+datagram length as a little-endian unsigned int, then the datagram bytes. Records are only ever
+appended, and the file can be read back through mmap without parsing it into memory first.
+"""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import logging
+import mmap
+import os
+import struct
+import time
+
+from twisted.internet import task
+
+FILE_MAGIC = 'FLOSCREC'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('<8sI')
+RECORD_HEADER = struct.Struct('<dI')
+# Buffered records are flushed to disk at least this often.
+FLUSH_INTERVAL_SECONDS = 1.0
+# The client address passed with replayed datagrams.
+REPLAY_CLIENT = ('replay', 0)
+
+
+class RecordingFormatException(Exception):
+  pass
+
+
+class OscRecorder(object):
+  """Appends datagrams to a recording file."""
+
+  def __init__(self, reactor, path):
+    self.path = path
+    self.file = open(path, 'ab')
+    if not self.file.tell():
+      self.file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+    self.flush_task_ = task.LoopingCall(self.file.flush)
+    self.flush_task_.start(FLUSH_INTERVAL_SECONDS, now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+  def record(self, data, arrival_time=None):
+    if arrival_time is None:
+      arrival_time = time.time()
+    self.file.write(RECORD_HEADER.pack(arrival_time, len(data)))
+    self.file.write(data)
+
+  def close(self):
+    if self.flush_task_.running:
+      self.flush_task_.stop()
+    self.file.close()
+
+
+def read_recording(path):
+  """Yields (arrival time, datagram) for each record in a recording file."""
+  with open(path, 'rb') as f:
+    if not os.fstat(f.fileno()).st_size:
+      raise RecordingFormatException('%s is empty' % path)
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      if len(buf) < FILE_HEADER.size:
+        raise RecordingFormatException('%s is too short' % path)
+      magic, version = FILE_HEADER.unpack_from(buf, 0)
+      if magic != FILE_MAGIC or version != FILE_VERSION:
+        raise RecordingFormatException('%s is not a version %d OSC recording' % (
+            path, FILE_VERSION))
+      offset = FILE_HEADER.size
+      while offset + RECORD_HEADER.size <= len(buf):
+        arrival_time, length = RECORD_HEADER.unpack_from(buf, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(buf):
+          logging.warning('Truncated record at end of %s', path)
+          return
+        yield arrival_time, buf[offset:offset + length]
+        offset += length
+    finally:
+      buf.close()
+
+
+class OscReplayer(object):
+  """Feeds the datagrams from a recording to a function, reproducing their inter-arrival times."""
+
+  def __init__(self, reactor, path, datagram_callback, speed=1.0, finished_callback=None):
+    """Initializes an OscReplayer. Call start() to begin the replay.
+
+    Args:
+      reactor: The twisted.internet.reactor module.
+      path: The recording file to replay.
+      datagram_callback: A function called with each datagram and REPLAY_CLIENT, such as the
+        datagramReceived method of an osc_server.OscDatagramHandler.
+      speed: A multiplier for the replay speed. 2 replays twice as fast as recorded.
+      finished_callback: If set, called without arguments once every datagram has been replayed.
+    """
+    assert speed > 0, 'Invalid replay speed: %s' % speed
+    self.reactor = reactor
+    self.path = path
+    self.datagram_callback = datagram_callback
+    self.speed = speed
+    self.finished_callback = finished_callback
+    self.records = None
+    self.start_time = None
+    self.first_arrival_time = None
+    self.replayed_count = 0
+
+  def start(self):
+    logging.info('Replaying OSC recording %s at speed %s', self.path, self.speed)
+    self.records = read_recording(self.path)
+    self.start_time = self.reactor.seconds()
+    self.schedule_next_(None)
+
+  def schedule_next_(self, data):
+    # Datagrams are scheduled one at a time, so long recordings don't fill the reactor's queue.
+    if data is not None:
+      self.replayed_count += 1
+      self.datagram_callback(data, REPLAY_CLIENT)
+    try:
+      arrival_time, next_data = next(self.records)
+    except StopIteration:
+      logging.info('Finished replaying %d datagrams from %s', self.replayed_count, self.path)
+      if self.finished_callback:
+        self.finished_callback()
+      return
+    if self.first_arrival_time is None:
+      self.first_arrival_time = arrival_time
+    due_time = self.start_time + (arrival_time - self.first_arrival_time) / self.speed
+    self.reactor.callLater(max(0, due_time - self.reactor.seconds()), self.schedule_next_,
+                           next_data)
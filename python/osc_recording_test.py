@@ -0,0 +1,92 @@
+"""Tests for osc_recording."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import task
+
+import osc_recording
+from osc_recording import OscRecorder
+from osc_recording import OscReplayer
+from osc_recording import read_recording
+from osc_recording import RecordingFormatException
+
+
+class FakeReactor(task.Clock):
+
+  def addSystemEventTrigger(self, phase, event_type, callback):
+    pass
+
+
+class RecordingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'recording')
+    self.reactor = FakeReactor()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def record(self, records):
+    recorder = OscRecorder(self.reactor, self.path)
+    for arrival_time, data in records:
+      recorder.record(data, arrival_time)
+    recorder.close()
+
+  def test_round_trip(self):
+    records = [(1.0, '/1/raw_azimuth\x00\x00,f\x00\x00\x3f\x00\x00\x00'), (1.5, ''), (2.25, 'x')]
+    self.record(records)
+    self.assertEqual(records, list(read_recording(self.path)))
+
+  def test_appends_to_existing_recording(self):
+    self.record([(1.0, 'a')])
+    self.record([(2.0, 'b')])
+    self.assertEqual([(1.0, 'a'), (2.0, 'b')], list(read_recording(self.path)))
+
+  def test_largest_slip_frame(self):
+    data = 'x' * 65536
+    self.record([(1.0, data)])
+    self.assertEqual([(1.0, data)], list(read_recording(self.path)))
+
+  def test_truncated_record_is_skipped(self):
+    self.record([(1.0, 'abc'), (2.0, 'defg')])
+    with open(self.path, 'r+b') as f:
+      f.truncate(os.path.getsize(self.path) - 1)
+    self.assertEqual([(1.0, 'abc')], list(read_recording(self.path)))
+
+  def test_bad_magic(self):
+    with open(self.path, 'wb') as f:
+      f.write(osc_recording.FILE_HEADER.pack('NOTOSC!!', osc_recording.FILE_VERSION))
+    self.assertRaises(RecordingFormatException, list, read_recording(self.path))
+
+  def test_unknown_version(self):
+    with open(self.path, 'wb') as f:
+      f.write(osc_recording.FILE_HEADER.pack(osc_recording.FILE_MAGIC, 99))
+    self.assertRaises(RecordingFormatException, list, read_recording(self.path))
+
+  def test_empty_file(self):
+    open(self.path, 'wb').close()
+    self.assertRaises(RecordingFormatException, list, read_recording(self.path))
+
+  def test_replay_timing(self):
+    self.record([(100.0, 'a'), (100.5, 'b'), (102.0, 'c')])
+    replayed = []
+    finished = []
+    replayer = OscReplayer(
+        self.reactor, self.path,
+        lambda data, client: replayed.append((self.reactor.seconds(), data, client)),
+        speed=2.0, finished_callback=lambda: finished.append(True))
+    replayer.start()
+    self.reactor.pump([0] + [0.25] * 4)
+    client = osc_recording.REPLAY_CLIENT
+    self.assertEqual([(0, 'a', client), (0.25, 'b', client), (1.0, 'c', client)], replayed)
+    self.assertEqual([True], finished)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+
+"""Executable script which replays an OSC recording over the network.
+
+Recordings are made with searchlight_main.py --record_osc_file. The datagrams are sent to the given
+address with the same timing they were recorded with, optionally sped up or slowed down.
+
+Example usage:
+  ./osc_replay_main.py --recording show.oscrec --address 224.0.0.1 --port 8888 --speed 2
+"""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import argparse
+
+from twisted.internet import protocol
+from twisted.internet import reactor
+
+from osc_recording import OscReplayer
+import logging_common
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Replays an OSC recording over UDP.')
+  parser.add_argument('--recording', type=str, required=True,
+                      help='The recording file to replay.')
+  parser.add_argument('--address', type=str, default='224.0.0.1',
+                      help='Address to send datagrams to. May be a multicast group.')
+  parser.add_argument('--port', type=int, default=8888)
+  parser.add_argument('--speed', type=float, default=1.0,
+                      help='Replay speed multiplier. 2 replays twice as fast as recorded.')
+  logging_common.add_logging_args(parser)
+  args = parser.parse_args()
+
+  logging_common.configure_logging_from_args(args)
+
+  sender = protocol.DatagramProtocol()
+  reactor.listenUDP(0, sender)
+  replayer = OscReplayer(
+      reactor, args.recording,
+      lambda data, unused_client: sender.transport.write(data, (args.address, args.port)),
+      speed=args.speed, finished_callback=reactor.stop)
+  reactor.callWhenRunning(replayer.start)
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main()
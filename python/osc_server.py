@@ -1,11 +1,53 @@
 __author__ = 'Rob Gaunt (robgaunt@gmail.com)'
 
 import base64
+import collections
+import struct
 
+from twisted.internet import protocol
 from txosc import async
 from txosc import osc
 import logging
 
+from osc_recording import REPLAY_CLIENT
+
+# Addresses of the form /all/<command> are sent to every searchlight.
+GROUP_NAME_ALL = 'all'
+
+# Precompiled argument formats for the message shapes our clients send, keyed by the type tag
+# string including its NUL padding. Other messages are parsed by txosc.
+_FAST_ARGUMENT_FORMATS = {
+    ',f\x00\x00': struct.Struct('>f'),
+    ',ff\x00': struct.Struct('>ff'),
+}
+_FAST_TYPE_TAG_LENGTH = 4
+# Maps raw address bytes, as received, to the resolved address or None if they can't be resolved.
+# Bounded, since the raw bytes come from the network.
+_address_cache = {}
+_ADDRESS_CACHE_SIZE = 1024
+
+_BUNDLE_HEADER = '#bundle\x00'
+_TIMETAG = struct.Struct('>II')
+# OSC timetags count seconds since 1900, rather than since the Unix epoch.
+NTP_EPOCH_OFFSET_SECONDS = 2208988800
+# Bundles timetagged further ahead than this are assumed to come from a sender whose clock is
+# wrong, and are dispatched immediately rather than held.
+MAX_BUNDLE_DELAY_SECONDS = 10.0
+
+# Special bytes used to frame OSC packets on a stream. See SlipStreamServerProtocol.
+SLIP_END = '\xc0'
+SLIP_ESC = '\xdb'
+SLIP_ESC_END = '\xdc'
+SLIP_ESC_ESC = '\xdd'
+# Streams which send more than this without ending a frame are disconnected.
+MAX_SLIP_FRAME_BYTES = 65536
+
+LISTENER_TRANSPORT_MULTICAST = 'multicast'
+LISTENER_TRANSPORT_UDP = 'udp'
+LISTENER_TRANSPORT_TCP_SLIP = 'tcp_slip'
+LISTENER_TRANSPORTS = (
+    LISTENER_TRANSPORT_MULTICAST, LISTENER_TRANSPORT_UDP, LISTENER_TRANSPORT_TCP_SLIP)
+
 
 def _try_fixing_invalid_osc_data(data):
   parts = data.split(',', 1)
@@ -23,6 +65,56 @@ def _try_fixing_invalid_osc_data(data):
     pass  # Couldn't base64 decode, give up.
 
 
+def _resolve_address(raw_address):
+  """Returns the address for the raw (plain or base64 encoded) bytes preceding the type tag."""
+  if raw_address.startswith('/'):
+    address = raw_address.rstrip('\x00')
+    if len(raw_address) % 4 or len(address) == len(raw_address):
+      return None
+    return address
+  # See _try_fixing_invalid_osc_data.
+  try:
+    address = base64.b64decode(raw_address).split('\x00', 1)[0]
+  except TypeError:
+    return None
+  return address if address.startswith('/') else None
+
+
+def _fast_decode(data):
+  """Decodes common messages without txosc.
+
+  Returns:
+    A tuple (address, values), or None if the message is not one of the shapes in
+    _FAST_ARGUMENT_FORMATS and should be parsed with txosc.
+  """
+  type_tag_start = data.find(',')
+  if type_tag_start <= 0:
+    return None
+  argument_start = type_tag_start + _FAST_TYPE_TAG_LENGTH
+  argument_format = _FAST_ARGUMENT_FORMATS.get(data[type_tag_start:argument_start])
+  if not argument_format or len(data) != argument_start + argument_format.size:
+    return None
+  raw_address = data[:type_tag_start]
+  try:
+    address = _address_cache[raw_address]
+  except KeyError:
+    if len(_address_cache) >= _ADDRESS_CACHE_SIZE:
+      _address_cache.clear()
+    address = _address_cache[raw_address] = _resolve_address(raw_address)
+  if not address:
+    return None
+  return address, argument_format.unpack_from(data, argument_start)
+
+
+def _bundle_time(data):
+  """Returns the Unix time at which a bundle is due, or None if it is due immediately."""
+  seconds, fraction = _TIMETAG.unpack_from(data, len(_BUNDLE_HEADER))
+  # A timetag of 1 (seconds 0, fraction 1) means immediately.
+  if not seconds and fraction <= 1:
+    return None
+  return seconds - NTP_EPOCH_OFFSET_SECONDS + fraction / 2.0 ** 32
+
+
 def _patched_elementFromBinary(data):
   if data[0] == "/":
     element, data = osc.Message.fromBinary(data)
@@ -37,14 +129,279 @@ def _patched_elementFromBinary(data):
   return element
 
 
-class MulticastDatagramServerProtocol(async.MulticastDatagramServerProtocol):
-  """A special OSC protocol which uses a different _elementFromBinary to handle bad message names.
-  This works around a compatibility issue where new versions of the touch OSC editor base64
-  encode all message names, but old versions of the client don't unencode them before sending,
-  causing a parse error in txosc.
+class OscDispatcher(object):
+  """Dispatches OSC messages through a precompiled table of addresses.
+
+  Searchlights register callbacks by searchlight name and command. When the dispatcher is compiled,
+  each command is expanded into an address for every searchlight, for "all" searchlights, and for
+  every named group of searchlights, so dispatching a message is a single dictionary lookup. The
+  message arguments are decoded once and passed to each callback as positional arguments.
+
+  All the messages in a bundle are dispatched together, between the begin and end bundle callbacks,
+  so that motor controllers can send the resulting commands as one frame.
+
+  This can be used in place of a txosc.dispatch.Receiver.
   """
 
-  def datagramReceived(self, data, (host, port)):
+  def __init__(self, groups=None):
+    """Initializes an OscDispatcher.
+
+    Args:
+      groups: A dict mapping group name to a list of searchlight names. Messages sent to
+        /<group name>/<command> go to every searchlight in the group.
+    """
+    self.groups = groups or {}
+    assert GROUP_NAME_ALL not in self.groups, 'Group name %s is reserved' % GROUP_NAME_ALL
+    # Maps command to a list of (searchlight name, callback).
+    self.command_callbacks = collections.defaultdict(list)
+    # Maps address to a list of callbacks. These replace any callbacks the address would otherwise
+    # be expanded to.
+    self.address_callbacks = collections.defaultdict(list)
+    # Maps address to a tuple of callbacks. Built by compile().
+    self.table = None
+    # Functions called without arguments before and after dispatching the messages in a bundle.
+    self.begin_bundle_callbacks = []
+    self.end_bundle_callbacks = []
+
+  def add_searchlight_callback(self, searchlight_name, command, callback):
+    assert searchlight_name != GROUP_NAME_ALL and searchlight_name not in self.groups, (
+        'Searchlight name %s is also a group name' % searchlight_name)
+    self.command_callbacks[command].append((searchlight_name, callback))
+    self.table = None
+
+  def add_callback(self, address, callback):
+    """Registers a callback for an exact address, overriding any searchlight callbacks."""
+    self.address_callbacks[address].append(callback)
+    self.table = None
+
+  def add_bundle_callbacks(self, begin_callback, end_callback):
+    """Registers functions called before and after the messages in each bundle are dispatched."""
+    self.begin_bundle_callbacks.append(begin_callback)
+    self.end_bundle_callbacks.append(end_callback)
+
+  def compile(self):
+    """Builds the address table. Called automatically if callbacks changed since the last call."""
+    table = collections.defaultdict(list)
+    searchlight_names = set()
+    for command, callbacks in self.command_callbacks.iteritems():
+      for searchlight_name, callback in callbacks:
+        searchlight_names.add(searchlight_name)
+        table['/%s/%s' % (searchlight_name, command)].append(callback)
+        table['/%s/%s' % (GROUP_NAME_ALL, command)].append(callback)
+      for group_name, members in self.groups.iteritems():
+        table['/%s/%s' % (group_name, command)].extend(
+            callback for searchlight_name, callback in callbacks if searchlight_name in members)
+    for group_name, members in self.groups.iteritems():
+      unknown_members = set(members) - searchlight_names
+      if unknown_members:
+        logging.error('OSC group %s has unknown searchlights: %s',
+                      group_name, ', '.join(sorted(unknown_members)))
+    table.update(self.address_callbacks)
+    self.table = dict((address, tuple(callbacks)) for address, callbacks in table.iteritems())
+
+  def dispatch(self, element, client):
+    """Dispatches an OSC message or bundle. Compatible with txosc.dispatch.Receiver.dispatch."""
+    if isinstance(element, osc.Bundle):
+      for callback in self.begin_bundle_callbacks:
+        callback()
+      try:
+        self.dispatch_bundle_elements_(element, client)
+      finally:
+        for callback in self.end_bundle_callbacks:
+          callback()
+    else:
+      self.dispatch_values(element.address, element.getValues(), client)
+
+  def dispatch_bundle_elements_(self, bundle, client):
+    # Nested bundles are dispatched along with the outermost one.
+    for element in bundle.elements:
+      if isinstance(element, osc.Bundle):
+        self.dispatch_bundle_elements_(element, client)
+      else:
+        self.dispatch_values(element.address, element.getValues(), client)
+
+  def dispatch_values(self, address, values, client):
+    if self.table is None:
+      self.compile()
+    callbacks = self.table.get(address)
+    if not callbacks:
+      logging.debug('Ignoring OSC message %s %s from %s', address, values, client)
+      return
+    logging.debug('Received OSC message %s %s from %s', address, values, client)
+    for callback in callbacks:
+      callback(*values)
+
+
+class OscDatagramHandler(object):
+  """Decodes OSC datagrams from any of the listeners and dispatches them.
+
+  This uses a different _elementFromBinary to handle bad message names. This works around a
+  compatibility issue where new versions of the touch OSC editor base64 encode all message names,
+  but old versions of the client don't unencode them before sending, causing a parse error in
+  txosc.
+
+  Messages with one or two float arguments, which is almost everything our clients send, are
+  decoded by _fast_decode and passed straight to the receiver's dispatch_values, so the receiver
+  must be an OscDispatcher.
+
+  Messages are not dispatched as they arrive. They are held until every datagram already waiting
+  on the sockets has been read, and a message is dropped if a newer one arrives for the same address
+  in the meantime. Under a flood of input, only the latest value for each address is processed, so
+  the searchlights keep up with the operator instead of falling behind. Bundles are never dropped.
+
+  Bundles timetagged in the future are held until they are due, so senders can send frames ahead
+  of time to absorb network jitter. This relies on the sender's clock agreeing with ours.
+
+  If a recorder (an osc_recording.OscRecorder) is given, every datagram received is recorded,
+  except those being replayed from a recording.
+  """
+
+  def __init__(self, reactor, receiver, recorder=None):
+    self.reactor = reactor
+    self.receiver = receiver
+    self.recorder = recorder
+    # Maps address (or a unique key, for bundles) to a tuple (function, args) which dispatches the
+    # newest element received, in order of arrival.
+    self.pending = collections.OrderedDict()
+    self.drain_call = None
+    self.received_count = 0
+    # The number of messages dropped because a newer message for the same address arrived first.
+    self.dropped_count = 0
+    # Functions called with the (host, port) of each datagram received.
+    self.client_callbacks = []
+
+  def add_client_callback(self, callback):
+    self.client_callbacks.append(callback)
+
+  def datagramReceived(self, data, client):
+    if self.recorder and client != REPLAY_CLIENT:
+      self.recorder.record(data)
+    self.received_count += 1
+    for callback in self.client_callbacks:
+      callback(client)
+    decoded = _fast_decode(data)
+    if decoded:
+      address, values = decoded
+      self.enqueue_(address, self.receiver.dispatch_values, (address, values, client))
+      return
     element = _patched_elementFromBinary(data)
-    self.receiver.dispatch(element, (host, port))
+    if isinstance(element, osc.Bundle):
+      due_time = _bundle_time(data)
+      if due_time is not None:
+        delay = due_time - self.reactor.seconds()
+        if delay > MAX_BUNDLE_DELAY_SECONDS:
+          logging.warning('Bundle from %s is due in %.1f seconds, dispatching it now', client,
+                          delay)
+        elif delay > 0:
+          self.reactor.callLater(delay, self.receiver.dispatch, element, client)
+          return
+      self.enqueue_(object(), self.receiver.dispatch, (element, client))
+    else:
+      self.enqueue_(element.address, self.receiver.dispatch, (element, client))
+
+  def enqueue_(self, key, function, args):
+    if self.pending.pop(key, None):
+      self.dropped_count += 1
+      logging.debug('Dropping superseded OSC message %s', key)
+    self.pending[key] = (function, args)
+    # The reactor reads every datagram waiting on the socket before running delayed calls.
+    if not self.drain_call:
+      self.drain_call = self.reactor.callLater(0, self.drain_)
+
+  def drain_(self):
+    self.drain_call = None
+    pending, self.pending = self.pending, collections.OrderedDict()
+    for function, args in pending.itervalues():
+      try:
+        function(*args)
+      except Exception:
+        # Don't let one bad message stop the rest of the batch.
+        logging.exception('Error dispatching OSC message %s', args[0])
+
+
+class MulticastDatagramServerProtocol(async.MulticastDatagramServerProtocol):
+  """Receives OSC datagrams sent to a multicast group."""
+
+  def __init__(self, handler, multicast_addr):
+    async.MulticastDatagramServerProtocol.__init__(self, handler.receiver, multicast_addr)
+    self.handler = handler
+
+  def datagramReceived(self, data, (host, port)):
+    self.handler.datagramReceived(data, (host, port))
+
 
+class DatagramServerProtocol(async.DatagramServerProtocol):
+  """Receives OSC datagrams sent directly to us, which is more reliable than multicast over WiFi."""
+
+  def __init__(self, handler):
+    async.DatagramServerProtocol.__init__(self, handler.receiver)
+    self.handler = handler
+
+  def datagramReceived(self, data, (host, port)):
+    self.handler.datagramReceived(data, (host, port))
+
+
+class SlipStreamServerProtocol(protocol.Protocol):
+  """Receives OSC packets over a stream, framed with SLIP (RFC 1055) as specified by OSC 1.1."""
+
+  def __init__(self, handler):
+    self.handler = handler
+    self.buffer = ''
+
+  def connectionMade(self):
+    peer = self.transport.getPeer()
+    self.client = (peer.host, peer.port)
+    logging.info('OSC stream connection from %s:%d', *self.client)
+
+  def connectionLost(self, reason):
+    logging.info('OSC stream connection from %s:%d closed', *self.client)
+
+  def dataReceived(self, data):
+    frames = (self.buffer + data).split(SLIP_END)
+    self.buffer = frames.pop()
+    if len(self.buffer) > MAX_SLIP_FRAME_BYTES:
+      logging.error('OSC stream from %s:%d sent an oversized frame, disconnecting', *self.client)
+      self.transport.loseConnection()
+      return
+    for frame in frames:
+      # Senders may begin as well as end each packet with SLIP_END, giving empty frames.
+      if not frame:
+        continue
+      frame = frame.replace(SLIP_ESC + SLIP_ESC_END, SLIP_END).replace(
+          SLIP_ESC + SLIP_ESC_ESC, SLIP_ESC)
+      try:
+        self.handler.datagramReceived(frame, self.client)
+      except Exception:
+        # Don't let one bad packet close the connection.
+        logging.exception('Error handling OSC packet from %s:%d', *self.client)
+
+
+class SlipStreamServerFactory(protocol.ServerFactory):
+
+  def __init__(self, handler):
+    self.handler = handler
+
+  def buildProtocol(self, addr):
+    return SlipStreamServerProtocol(self.handler)
+
+
+def listen(reactor, handler, transport, port, address=''):
+  """Starts an OSC listener which passes what it receives to an OscDatagramHandler.
+
+  Args:
+    reactor: The twisted.internet.reactor module.
+    handler: An OscDatagramHandler, which may be shared by several listeners.
+    transport: One of LISTENER_TRANSPORTS.
+    port: The port to listen on.
+    address: The multicast group to join for multicast listeners. Otherwise, the interface to
+      listen on, or empty for all interfaces.
+  """
+  assert transport in LISTENER_TRANSPORTS, 'Invalid OSC listener transport %s' % transport
+  logging.info('Listening for OSC over %s on %s:%d', transport, address, port)
+  if transport == LISTENER_TRANSPORT_MULTICAST:
+    return reactor.listenMulticast(
+        port, MulticastDatagramServerProtocol(handler, address), listenMultiple=True)
+  elif transport == LISTENER_TRANSPORT_UDP:
+    return reactor.listenUDP(port, DatagramServerProtocol(handler), interface=address)
+  else:
+    return reactor.listenTCP(port, SlipStreamServerFactory(handler), interface=address)
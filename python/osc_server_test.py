@@ -0,0 +1,360 @@
+"""Tests for osc_server."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import base64
+import struct
+import unittest
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+from txosc import osc
+
+import osc_server
+from osc_recording import REPLAY_CLIENT
+from osc_server import SLIP_END
+from osc_server import SLIP_ESC
+from osc_server import SLIP_ESC_END
+from osc_server import SLIP_ESC_ESC
+
+CLIENT = ('10.0.0.2', 9000)
+
+
+def encode_message(address, type_tag, arguments):
+  """Returns an OSC message, with the address and type tag padded and arguments already packed."""
+  address += '\x00' * (4 - len(address) % 4)
+  type_tag += '\x00' * (4 - len(type_tag) % 4)
+  return address + type_tag + arguments
+
+
+class FastDecodeTest(unittest.TestCase):
+
+  def test_one_float(self):
+    data = encode_message('/1/raw_azimuth', ',f', struct.pack('>f', 0.25))
+    self.assertEqual(('/1/raw_azimuth', (0.25,)), osc_server._fast_decode(data))
+
+  def test_two_floats(self):
+    data = encode_message('/1/draw_grid', ',ff', struct.pack('>ff', 0.25, 0.75))
+    self.assertEqual(('/1/draw_grid', (0.25, 0.75)), osc_server._fast_decode(data))
+
+  def test_address_length_multiple_of_four(self):
+    # The address is still followed by four bytes of NUL padding.
+    data = encode_message('/1/abcdefgh', ',f', struct.pack('>f', 1.0))
+    self.assertEqual(('/1/abcdefgh', (1.0,)), osc_server._fast_decode(data))
+
+  def test_base64_address(self):
+    # Some TouchOSC clients send base64 encoded addresses.
+    data = encode_message(base64.b64encode('/1/draw_grid'), ',ff', struct.pack('>ff', 0.5, 0.5))
+    self.assertEqual(('/1/draw_grid', (0.5, 0.5)), osc_server._fast_decode(data))
+
+  def test_matches_txosc(self):
+    for message in (osc.Message('/1/raw_elevation', 0.125),
+                    osc.Message('/all/draw_grid_yx', 0.5, 1.0)):
+      address, values = osc_server._fast_decode(message.toBinary())
+      self.assertEqual(message.address, address)
+      self.assertEqual(tuple(message.getValues()), values)
+
+  def test_unsupported_messages(self):
+    unsupported = [
+        encode_message('/1/limit_reset', ',i', struct.pack('>i', 1)),
+        encode_message('/1/pattern', ',sf', 'sweep\x00\x00\x00' + struct.pack('>f', 1.0)),
+        encode_message('/1/xyz', ',fff', struct.pack('>fff', 0, 0, 0)),
+        encode_message('/1/limit_reset', ',', ''),
+        # Truncated or extended arguments.
+        encode_message('/1/raw_azimuth', ',f', '\x00\x00'),
+        encode_message('/1/raw_azimuth', ',f', struct.pack('>ff', 0, 0)),
+        # Unpadded address.
+        '/1/raw_azimuth,f\x00\x00' + struct.pack('>f', 0),
+        # Neither a plain address nor a base64 encoded one.
+        encode_message('bm90IGFuIGFkZHJlc3M=', ',f', struct.pack('>f', 0)),
+        encode_message('!!!', ',f', struct.pack('>f', 0)),
+        'no type tag',
+    ]
+    for data in unsupported:
+      self.assertEqual(None, osc_server._fast_decode(data), repr(data))
+
+  def test_address_cache_is_bounded(self):
+    for index in xrange(osc_server._ADDRESS_CACHE_SIZE + 10):
+      osc_server._fast_decode(encode_message('/%d/x' % index, ',f', struct.pack('>f', 0)))
+    self.assertTrue(len(osc_server._address_cache) <= osc_server._ADDRESS_CACHE_SIZE)
+
+
+class OscDispatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.calls = []
+    self.dispatcher = osc_server.OscDispatcher({'left': ['1', '2'], 'right': ['3']})
+    for name in ('1', '2', '3'):
+      self.dispatcher.add_searchlight_callback(name, 'raw_azimuth', self.callback(name))
+
+  def callback(self, name):
+    return lambda *values: self.calls.append((name,) + values)
+
+  def test_searchlight_address(self):
+    self.dispatcher.dispatch_values('/2/raw_azimuth', (0.5,), CLIENT)
+    self.assertEqual([('2', 0.5)], self.calls)
+
+  def test_all_address(self):
+    self.dispatcher.dispatch_values('/all/raw_azimuth', (0.5,), CLIENT)
+    self.assertEqual([('1', 0.5), ('2', 0.5), ('3', 0.5)], sorted(self.calls))
+
+  def test_group_address(self):
+    self.dispatcher.dispatch_values('/left/raw_azimuth', (0.5,), CLIENT)
+    self.assertEqual([('1', 0.5), ('2', 0.5)], sorted(self.calls))
+
+  def test_unknown_address_is_ignored(self):
+    self.dispatcher.dispatch_values('/4/raw_azimuth', (0.5,), CLIENT)
+    self.dispatcher.dispatch_values('/1/raw_elevation', (0.5,), CLIENT)
+    self.assertEqual([], self.calls)
+
+  def test_address_callback_overrides_expansion(self):
+    self.dispatcher.add_callback('/all/raw_azimuth', self.callback('all'))
+    self.dispatcher.dispatch_values('/all/raw_azimuth', (0.5,), CLIENT)
+    self.assertEqual([('all', 0.5)], self.calls)
+
+  def test_callbacks_added_after_compile(self):
+    self.dispatcher.compile()
+    self.dispatcher.add_searchlight_callback('1', 'raw_elevation', self.callback('1'))
+    self.dispatcher.dispatch_values('/1/raw_elevation', (0.25,), CLIENT)
+    self.assertEqual([('1', 0.25)], self.calls)
+
+  def test_bundle_is_dispatched_between_bundle_callbacks(self):
+    self.dispatcher.add_bundle_callbacks(
+        lambda: self.calls.append('begin'), lambda: self.calls.append('end'))
+    bundle = osc.Bundle([osc.Message('/1/raw_azimuth', 0.5),
+                         osc.Bundle([osc.Message('/3/raw_azimuth', 0.25)])])
+    self.dispatcher.dispatch(bundle, CLIENT)
+    self.assertEqual(['begin', ('1', 0.5), ('3', 0.25), 'end'], self.calls)
+
+  def test_group_name_clashing_with_searchlight(self):
+    self.assertRaises(AssertionError, self.dispatcher.add_searchlight_callback,
+                      'left', 'raw_azimuth', self.callback('left'))
+    self.assertRaises(AssertionError, osc_server.OscDispatcher, {'all': ['1']})
+
+
+class FakeRecorder(object):
+
+  def __init__(self):
+    self.datagrams = []
+
+  def record(self, data):
+    self.datagrams.append(data)
+
+
+class OscDatagramHandlerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.dispatcher = osc_server.OscDispatcher()
+    self.values = []
+    self.dispatcher.add_callback('/1/raw_azimuth', lambda *values: self.values.append(values))
+    self.recorder = FakeRecorder()
+    self.handler = osc_server.OscDatagramHandler(self.clock, self.dispatcher, self.recorder)
+
+  def test_records_received_datagrams(self):
+    data = encode_message('/1/raw_azimuth', ',f', '\x3f\x00\x00\x00')
+    self.handler.datagramReceived(data, CLIENT)
+    self.clock.advance(0)
+    self.assertEqual([data], self.recorder.datagrams)
+    self.assertEqual([(0.5,)], self.values)
+
+  def test_does_not_record_replayed_datagrams(self):
+    data = encode_message('/1/raw_azimuth', ',f', '\x3f\x00\x00\x00')
+    self.handler.datagramReceived(data, REPLAY_CLIENT)
+    self.clock.advance(0)
+    self.assertEqual([], self.recorder.datagrams)
+    self.assertEqual([(0.5,)], self.values)
+
+  def test_only_newest_message_per_address_is_dispatched(self):
+    for value in (0.25, 0.5, 0.75):
+      self.handler.datagramReceived(osc.Message('/1/raw_azimuth', value).toBinary(), CLIENT)
+    self.assertEqual([], self.values)
+    self.clock.advance(0)
+    self.assertEqual([(0.75,)], self.values)
+    self.assertEqual(3, self.handler.received_count)
+    self.assertEqual(2, self.handler.dropped_count)
+
+  def test_addresses_are_dispatched_in_order_of_arrival(self):
+    self.dispatcher.add_callback('/1/raw_elevation', lambda value: self.values.append(-value))
+    for address, value in (('/1/raw_elevation', 0.25), ('/1/raw_azimuth', 0.5),
+                           ('/1/raw_elevation', 0.75)):
+      self.handler.datagramReceived(osc.Message(address, value).toBinary(), CLIENT)
+    self.clock.advance(0)
+    # The newest elevation is dispatched when it arrived, not when the one it replaced did.
+    self.assertEqual([(0.5,), -0.75], self.values)
+    self.assertEqual(1, self.handler.dropped_count)
+
+  def test_messages_after_drain_are_not_dropped(self):
+    for value in (0.25, 0.5):
+      self.handler.datagramReceived(osc.Message('/1/raw_azimuth', value).toBinary(), CLIENT)
+      self.clock.advance(0)
+    self.assertEqual([(0.25,), (0.5,)], self.values)
+    self.assertEqual(0, self.handler.dropped_count)
+
+  def test_txosc_messages_are_dropped_too(self):
+    for value in (1, 2):
+      self.handler.datagramReceived(osc.Message('/1/raw_azimuth', value).toBinary(), CLIENT)
+    self.clock.advance(0)
+    self.assertEqual([(2,)], self.values)
+    self.assertEqual(1, self.handler.dropped_count)
+
+  def test_bundles_are_never_dropped(self):
+    for value in (0.25, 0.5):
+      bundle = osc.Bundle([osc.Message('/1/raw_azimuth', value)])
+      self.handler.datagramReceived(bundle.toBinary(), CLIENT)
+    self.clock.advance(0)
+    self.assertEqual([(0.25,), (0.5,)], self.values)
+    self.assertEqual(0, self.handler.dropped_count)
+
+  def test_bad_message_does_not_stop_the_batch(self):
+    def raise_error(*values):
+      raise ValueError(values)
+    self.dispatcher.add_callback('/1/bad', raise_error)
+    self.handler.datagramReceived(osc.Message('/1/bad', 0.5).toBinary(), CLIENT)
+    self.handler.datagramReceived(osc.Message('/1/raw_azimuth', 0.5).toBinary(), CLIENT)
+    self.clock.advance(0)
+    self.assertEqual([(0.5,)], self.values)
+
+
+def encode_bundle(due_time, *messages):
+  """Returns an OSC bundle of messages, timetagged with a Unix time or None for immediately."""
+  if due_time is None:
+    timetag = struct.pack('>II', 0, 1)
+  else:
+    seconds = due_time + osc_server.NTP_EPOCH_OFFSET_SECONDS
+    timetag = struct.pack('>II', int(seconds), int(seconds % 1 * 2 ** 32))
+  elements = ''.join(
+      struct.pack('>i', len(message.toBinary())) + message.toBinary() for message in messages)
+  return '#bundle\x00' + timetag + elements
+
+
+class BundleTimeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = task.Clock()
+    self.clock.advance(1000)
+    self.dispatcher = osc_server.OscDispatcher()
+    self.values = []
+    self.dispatcher.add_callback('/1/raw_azimuth', lambda *values: self.values.append(values))
+    self.dispatcher.add_bundle_callbacks(
+        lambda: self.values.append('begin'), lambda: self.values.append('end'))
+    self.handler = osc_server.OscDatagramHandler(self.clock, self.dispatcher)
+
+  def receive_bundle(self, due_time):
+    self.handler.datagramReceived(
+        encode_bundle(due_time, osc.Message('/1/raw_azimuth', 0.5)), CLIENT)
+
+  def test_bundle_time(self):
+    self.assertEqual(None, osc_server._bundle_time(encode_bundle(None)))
+    self.assertAlmostEqual(1000.25, osc_server._bundle_time(encode_bundle(1000.25)))
+
+  def test_immediate_bundle(self):
+    self.receive_bundle(None)
+    self.clock.advance(0)
+    self.assertEqual(['begin', (0.5,), 'end'], self.values)
+
+  def test_past_bundle_is_dispatched_at_once(self):
+    self.receive_bundle(999)
+    self.clock.advance(0)
+    self.assertEqual(['begin', (0.5,), 'end'], self.values)
+
+  def test_future_bundle_is_held_until_due(self):
+    self.receive_bundle(1000.5)
+    self.clock.advance(0.49)
+    self.assertEqual([], self.values)
+    self.clock.advance(0.01)
+    self.assertEqual(['begin', (0.5,), 'end'], self.values)
+
+  def test_held_bundle_is_not_superseded(self):
+    self.receive_bundle(1000.5)
+    self.receive_bundle(1001)
+    self.clock.advance(1)
+    self.assertEqual(['begin', (0.5,), 'end'] * 2, self.values)
+    self.assertEqual(0, self.handler.dropped_count)
+
+  def test_bundle_too_far_ahead_is_dispatched_at_once(self):
+    self.receive_bundle(1000 + osc_server.MAX_BUNDLE_DELAY_SECONDS + 1)
+    self.clock.advance(0)
+    self.assertEqual(['begin', (0.5,), 'end'], self.values)
+    self.assertFalse(self.clock.getDelayedCalls())
+
+  def test_longest_delay(self):
+    self.receive_bundle(1000 + osc_server.MAX_BUNDLE_DELAY_SECONDS)
+    self.clock.advance(osc_server.MAX_BUNDLE_DELAY_SECONDS - 0.01)
+    self.assertEqual([], self.values)
+    self.clock.advance(0.01)
+    self.assertEqual(['begin', (0.5,), 'end'], self.values)
+
+
+class FakeHandler(object):
+
+  def __init__(self):
+    self.datagrams = []
+
+  def datagramReceived(self, data, client):
+    self.datagrams.append((data, client))
+
+
+class SlipStreamServerProtocolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.handler = FakeHandler()
+    self.protocol = osc_server.SlipStreamServerProtocol(self.handler)
+    self.transport = proto_helpers.StringTransport()
+    self.protocol.makeConnection(self.transport)
+    peer = self.transport.getPeer()
+    self.client = (peer.host, peer.port)
+
+  def received(self):
+    return [data for data, unused_client in self.handler.datagrams]
+
+  def test_frames(self):
+    self.protocol.dataReceived('abc' + SLIP_END + 'def' + SLIP_END)
+    self.assertEqual([('abc', self.client), ('def', self.client)], self.handler.datagrams)
+
+  def test_leading_end_and_empty_frames_are_ignored(self):
+    self.protocol.dataReceived(SLIP_END + 'abc' + SLIP_END + SLIP_END)
+    self.assertEqual(['abc'], self.received())
+
+  def test_escaped_bytes(self):
+    self.protocol.dataReceived(
+        'a' + SLIP_ESC + SLIP_ESC_END + 'b' + SLIP_ESC + SLIP_ESC_ESC + 'c' + SLIP_END)
+    self.assertEqual(['a' + SLIP_END + 'b' + SLIP_ESC + 'c'], self.received())
+
+  def test_escape_codes_after_escaped_escape(self):
+    # An escaped ESC followed by a literal ESC_END byte must not decode to END.
+    self.protocol.dataReceived(SLIP_ESC + SLIP_ESC_ESC + SLIP_ESC_END + SLIP_END)
+    self.assertEqual([SLIP_ESC + SLIP_ESC_END], self.received())
+
+  def test_frame_split_across_chunks(self):
+    data = 'a' + SLIP_ESC + SLIP_ESC_END + 'b' + SLIP_END
+    for byte in data:
+      self.protocol.dataReceived(byte)
+    self.assertEqual(['a' + SLIP_END + 'b'], self.received())
+
+  def test_oversized_frame_disconnects(self):
+    self.protocol.dataReceived('x' * osc_server.MAX_SLIP_FRAME_BYTES)
+    self.assertFalse(self.transport.disconnecting)
+    self.protocol.dataReceived('x')
+    self.assertTrue(self.transport.disconnecting)
+    self.assertEqual([], self.received())
+
+  def test_largest_frame(self):
+    data = 'x' * osc_server.MAX_SLIP_FRAME_BYTES
+    self.protocol.dataReceived(data + SLIP_END)
+    self.assertEqual([data], self.received())
+    self.assertFalse(self.transport.disconnecting)
+
+  def test_bad_packet_does_not_stop_later_packets(self):
+    def datagram_received(data, client):
+      if data == 'bad':
+        raise ValueError(data)
+      self.handler.datagrams.append((data, client))
+    self.handler.datagramReceived = datagram_received
+    self.protocol.dataReceived('bad' + SLIP_END + 'good' + SLIP_END)
+    self.assertEqual(['good'], self.received())
+    self.assertFalse(self.transport.disconnecting)
+
+
+if __name__ == '__main__':
+  unittest.main()
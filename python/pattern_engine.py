@@ -0,0 +1,130 @@
+"""Generates searchlight trajectories on the server, so clients only need to start and stop them.
+
+Patterns are drawn in draw grid coordinates: x and y between 0 and 1, as sent to the draw_grid
+OSC address. The full path of a pattern is computed once as arrays of azimuth and elevation
+angles, cached, and then played back one point per reactor tick.
+"""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import collections
+import logging
+
+import numpy
+
+from twisted.internet import task
+
+# Keep draw grid y away from zero, where the azimuth angle is undefined.
+MIN_DRAW_GRID_Y = 0.001
+PATTERN_CACHE_SIZE = 32
+
+
+def spirograph(t, r1=0.3, r2=0.11, h=0.12):
+  """A hypotrochoid, as drawn by processing/flashlight_spirograph."""
+  return (0.5 + (r1 - r2) * numpy.cos(t) + h * numpy.cos((r1 - r2) / r2 * t),
+          0.5 + (r1 - r2) * numpy.sin(t) + h * numpy.sin((r1 - r2) / r2 * t))
+
+
+def lissajous(t, a=3, b=2, amplitude=0.4, phase=0.5):
+  return 0.5 + amplitude * numpy.sin(a * t + phase), 0.5 + amplitude * numpy.sin(b * t)
+
+
+def figure_eight(t, amplitude=0.4):
+  return 0.5 + amplitude * numpy.sin(t), 0.5 + amplitude / 2 * numpy.sin(2 * t)
+
+
+def sweep(t, x_min=0.1, x_max=0.9, y=0.5):
+  """Sweeps back and forth along a horizontal line at constant speed."""
+  fraction = numpy.abs((t / numpy.pi) % 2 - 1)
+  return x_min + (x_max - x_min) * fraction, numpy.full_like(t, y)
+
+
+# Maps pattern name to a function of an array of phase angles, plus optional float parameters,
+# returning arrays (x, y) of draw grid coordinates. One revolution of the phase angle, from 0 to
+# 2 * pi * revolutions, is one period of the pattern.
+PATTERNS = {
+    'spirograph': spirograph,
+    'lissajous': lissajous,
+    'figure_eight': figure_eight,
+    'sweep': sweep,
+}
+
+_path_cache = collections.OrderedDict()
+
+
+def draw_grid_to_angles(x, y, elevation_factor):
+  """Vectorized version of Searchlight._osc_draw_grid. Returns arrays (azimuth, elevation)."""
+  x = numpy.clip(x, 0, 1) - 0.5
+  y = numpy.clip(y, MIN_DRAW_GRID_Y, 1)
+  return (numpy.arctan(x / y),
+          numpy.arctan(elevation_factor / numpy.sqrt(x * x + y * y)))
+
+
+def get_pattern_path(name, params, num_points, revolutions, elevation_factor):
+  """Returns arrays (azimuth, elevation) for one period of a pattern, computing it if needed."""
+  key = (name, tuple(params), num_points, revolutions, elevation_factor)
+  path = _path_cache.pop(key, None)
+  if path is None:
+    t = numpy.linspace(0, 2 * numpy.pi * revolutions, num_points, endpoint=False)
+    path = draw_grid_to_angles(*PATTERNS[name](t, *params), elevation_factor=elevation_factor)
+    if len(_path_cache) >= PATTERN_CACHE_SIZE:
+      _path_cache.popitem(last=False)
+  # Most recently used paths are kept at the end.
+  _path_cache[key] = path
+  return path
+
+
+class PatternPlayer(object):
+  """Plays patterns on a searchlight by aiming it on a fixed tick.
+
+  Anything else which moves the searchlight, such as OSC or PSMove input, stops the pattern.
+  """
+
+  def __init__(self, reactor, searchlight, elevation_factor, tick_seconds=0.02):
+    """Initializes a PatternPlayer.
+
+    Args:
+      reactor: The twisted.internet.reactor module.
+      searchlight: The searchlight.Searchlight to aim.
+      elevation_factor: Converts draw grid distance to elevation, as in searchlight.py.
+      tick_seconds: The interval between successive points of a pattern.
+    """
+    self.reactor = reactor
+    self.searchlight = searchlight
+    self.elevation_factor = elevation_factor
+    self.tick_seconds = tick_seconds
+    self.path = None
+    self.index = 0
+    self.task_ = task.LoopingCall(self.tick_)
+    self.task_.clock = reactor
+
+  def start(self, name, period_seconds=20, revolutions=1, *params):
+    """Starts playing a pattern, replacing any pattern already playing.
+
+    Args:
+      name: A key of PATTERNS.
+      period_seconds: The time taken to play the whole path once. It then repeats.
+      revolutions: The number of revolutions of the pattern's phase angle in one period.
+      params: Extra float parameters passed to the pattern function, in order.
+    """
+    if name not in PATTERNS:
+      logging.error('Searchlight %s: unknown pattern %s', self.searchlight.name, name)
+      return
+    num_points = max(1, int(round(period_seconds / self.tick_seconds)))
+    self.path = get_pattern_path(
+        name, params, num_points, revolutions, self.elevation_factor)
+    self.index = 0
+    logging.info('Searchlight %s: starting pattern %s %s', self.searchlight.name, name, params)
+    if not self.task_.running:
+      self.task_.start(self.tick_seconds)
+
+  def stop(self):
+    if self.task_.running:
+      self.task_.stop()
+    self.path = None
+
+  def tick_(self):
+    azimuths, elevations = self.path
+    self.searchlight.set_motor_positions(self.searchlight.motor_positions_for_angle(
+        float(azimuths[self.index]), float(elevations[self.index])), stop_pattern=False)
+    self.index = (self.index + 1) % len(azimuths)
@@ -0,0 +1,160 @@
+"""Tests for pattern_engine."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import unittest
+
+import numpy
+from twisted.internet import task
+
+import pattern_engine
+from pattern_engine import PatternPlayer
+
+ELEVATION_FACTOR = 0.5
+
+
+class FakeSearchlight(object):
+
+  def __init__(self):
+    self.name = 'test'
+    # List of (azimuth, elevation, stop_pattern).
+    self.positions = []
+
+  def motor_positions_for_angle(self, azimuth, elevation):
+    return azimuth, elevation
+
+  def set_motor_positions(self, channel_positions, stop_pattern=True):
+    self.positions.append(channel_positions + (stop_pattern,))
+
+
+class PatternTest(unittest.TestCase):
+
+  def setUp(self):
+    self.t = numpy.linspace(0, 2 * numpy.pi, 100, endpoint=False)
+
+  def assertPeriodic(self, pattern, period, *params):
+    x, y = pattern(self.t, *params)
+    shifted_x, shifted_y = pattern(self.t + period, *params)
+    numpy.testing.assert_allclose(x, shifted_x, atol=1e-9)
+    numpy.testing.assert_allclose(y, shifted_y, atol=1e-9)
+
+  def test_shapes_and_range(self):
+    for name, pattern in pattern_engine.PATTERNS.iteritems():
+      x, y = pattern(self.t)
+      self.assertEqual(self.t.shape, x.shape, name)
+      self.assertEqual(self.t.shape, y.shape, name)
+      self.assertTrue(numpy.all((0 <= x) & (x <= 1)), name)
+      self.assertTrue(numpy.all((0 <= y) & (y <= 1)), name)
+
+  def test_periods(self):
+    for name in ('lissajous', 'figure_eight', 'sweep'):
+      self.assertPeriodic(pattern_engine.PATTERNS[name], 2 * numpy.pi)
+    # The default spirograph's inner circle turns 19/11 times per revolution.
+    self.assertPeriodic(pattern_engine.spirograph, 2 * numpy.pi * 11)
+
+  def test_lissajous_params(self):
+    x, y = pattern_engine.lissajous(self.t, 5, 4, 0.2, 0)
+    numpy.testing.assert_allclose(0.5 + 0.2 * numpy.sin(5 * self.t), x)
+    numpy.testing.assert_allclose(0.5 + 0.2 * numpy.sin(4 * self.t), y)
+
+  def test_sweep(self):
+    x, y = pattern_engine.sweep(numpy.array([0, numpy.pi / 2, numpy.pi, 3 * numpy.pi / 2]))
+    numpy.testing.assert_allclose([0.9, 0.5, 0.1, 0.5], x)
+    numpy.testing.assert_allclose([0.5] * 4, y)
+
+  def test_draw_grid_to_angles(self):
+    azimuth, elevation = pattern_engine.draw_grid_to_angles(
+        numpy.array([0.5, 1.0, 0.0]), numpy.array([0.5, 0.5, 0.0]), ELEVATION_FACTOR)
+    # y is kept above zero, where the azimuth is undefined.
+    numpy.testing.assert_allclose(
+        [0, numpy.pi / 4, numpy.arctan(-0.5 / pattern_engine.MIN_DRAW_GRID_Y)], azimuth)
+    self.assertAlmostEqual(numpy.arctan(1), elevation[0])
+
+
+class PathCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    pattern_engine._path_cache.clear()
+
+  def tearDown(self):
+    pattern_engine._path_cache.clear()
+
+  def get_path(self, name='sweep', params=(), num_points=10):
+    return pattern_engine.get_pattern_path(name, params, num_points, 1, ELEVATION_FACTOR)
+
+  def test_path(self):
+    azimuths, elevations = self.get_path(num_points=4)
+    expected_azimuths, expected_elevations = pattern_engine.draw_grid_to_angles(
+        *pattern_engine.sweep(numpy.arange(4) * numpy.pi / 2), elevation_factor=ELEVATION_FACTOR)
+    numpy.testing.assert_allclose(expected_azimuths, azimuths)
+    numpy.testing.assert_allclose(expected_elevations, elevations)
+
+  def test_cache_hit(self):
+    path = self.get_path()
+    self.assertIs(path, self.get_path())
+    self.assertIsNot(path, self.get_path(num_points=11))
+    self.assertIsNot(path, self.get_path(params=(0.2,)))
+
+  def test_least_recently_used_path_is_evicted(self):
+    first_path = self.get_path(num_points=1)
+    second_path = self.get_path(num_points=2)
+    for num_points in xrange(3, pattern_engine.PATTERN_CACHE_SIZE + 1):
+      self.get_path(num_points=num_points)
+    # Using the first path again makes the second the least recently used.
+    self.assertIs(first_path, self.get_path(num_points=1))
+    self.get_path(num_points=pattern_engine.PATTERN_CACHE_SIZE + 1)
+    self.assertEqual(pattern_engine.PATTERN_CACHE_SIZE, len(pattern_engine._path_cache))
+    self.assertIs(first_path, self.get_path(num_points=1))
+    self.assertIsNot(second_path, self.get_path(num_points=2))
+
+
+class PatternPlayerTest(unittest.TestCase):
+
+  def setUp(self):
+    pattern_engine._path_cache.clear()
+    self.clock = task.Clock()
+    self.searchlight = FakeSearchlight()
+    self.player = PatternPlayer(self.clock, self.searchlight, ELEVATION_FACTOR, tick_seconds=0.25)
+
+  def tearDown(self):
+    self.player.stop()
+    pattern_engine._path_cache.clear()
+
+  def test_start_with_params(self):
+    self.player.start('lissajous', 1.0, 2.0, 5.0, 4.0)
+    self.clock.pump([0.25] * 7)
+    t = numpy.arange(8) * numpy.pi
+    expected_azimuths, expected_elevations = pattern_engine.draw_grid_to_angles(
+        *pattern_engine.lissajous(t, 5.0, 4.0), elevation_factor=ELEVATION_FACTOR)
+    # Four points per period, played twice.
+    expected = zip(expected_azimuths[:4], expected_elevations[:4], [False] * 4) * 2
+    self.assertEqual(8, len(self.searchlight.positions))
+    numpy.testing.assert_allclose(expected, self.searchlight.positions)
+
+  def test_restart_replaces_pattern(self):
+    self.player.start('sweep', 1.0)
+    self.clock.advance(0.25)
+    self.player.start('figure_eight', 1.0)
+    self.clock.advance(0.25)
+    figure_eight_path = pattern_engine.get_pattern_path(
+        'figure_eight', (), 4, 1, ELEVATION_FACTOR)
+    self.assertEqual(3, len(self.searchlight.positions))
+    self.assertAlmostEqual(figure_eight_path[0][0], self.searchlight.positions[-1][0])
+    self.assertEqual(1, self.player.index)
+
+  def test_stop(self):
+    self.player.start('sweep', 1.0)
+    self.player.stop()
+    self.clock.advance(1)
+    self.assertEqual(1, len(self.searchlight.positions))
+    self.assertFalse(self.clock.getDelayedCalls())
+
+  def test_unknown_pattern(self):
+    self.player.start('unknown')
+    self.clock.advance(1)
+    self.assertEqual([], self.searchlight.positions)
+    self.assertFalse(self.player.task_.running)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,19 +1,55 @@
 import logging
 import psmove
+import threading
 
 from twisted.internet import task
 
 import psmove_controller
+from psmove_poller import PSMovePoller
 
-PSMOVE_CONNECT_INTERVAL = 5
+# Moves are scanned for this often while some controller configs are unassigned, so a Move is
+# picked up soon after its PS button is pressed.
+FAST_SCAN_INTERVAL_SECONDS = 1
+# Once every config is assigned, scans only need to notice Moves which have gone away.
+SLOW_SCAN_INTERVAL_SECONDS = 10
+# How long to wait for a scan in progress to finish at shutdown.
+SHUTDOWN_TIMEOUT_SECONDS = 5
+# How often the poll statistics of each connected controller are logged.
+POLL_STATS_LOG_INTERVAL_SECONDS = 60
 
 
 class PSMoveConnectionManager(object):
-  """Manages connecting and disconnecting PSMove controllers."""
+  """Manages connecting and disconnecting PSMove controllers.
 
-  def __init__(self, reactor, controller_configs, name_to_searchlight):
+  Discovery, USB pairing and calibration checks all block on USB or Bluetooth, so they run on a
+  background thread. After each scan, the thread sends the reactor the serials of the Moves it
+  found and any newly connected Moves which are ready to use. Controllers are created and removed
+  on the reactor thread.
+  """
+
+  def __init__(self, reactor, controller_configs, name_to_searchlight, poller_config=None,
+               fast_scan_interval_seconds=FAST_SCAN_INTERVAL_SECONDS,
+               slow_scan_interval_seconds=SLOW_SCAN_INTERVAL_SECONDS,
+               poll_stats_log_interval_seconds=POLL_STATS_LOG_INTERVAL_SECONDS):
+    """Initializes a PSMoveConnectionManager.
+
+    Args:
+      reactor: The twisted.internet.reactor module.
+      controller_configs: A list of dicts, each with the searchlight_names to control and keyword
+        arguments for a PSMoveController.
+      name_to_searchlight: A dict mapping name to searchlight.Searchlight instance.
+      poller_config: Optional keyword arguments for the psmove_poller.PSMovePoller shared by all
+        the controllers.
+      fast_scan_interval_seconds: The interval between scans while some configs are unassigned.
+      slow_scan_interval_seconds: The interval between scans once every config is assigned.
+      poll_stats_log_interval_seconds: The interval between logs of each controller's poll
+        statistics.
+    """
     self.reactor = reactor
+    self.poller = PSMovePoller(reactor, **(poller_config or {}))
     self.name_to_searchlight_ = name_to_searchlight
+    self.fast_scan_interval_seconds = fast_scan_interval_seconds
+    self.slow_scan_interval_seconds = slow_scan_interval_seconds
     # As we connect PSMove controllers, we pop an element off of unconnected_configs_ and move it
     # over to serial_to_config_. As we disconnect them, we do the reverse. This assigns
     # configurations to the controllers in the order that they are connected.
@@ -22,15 +58,58 @@ class PSMoveConnectionManager(object):
     self.serial_to_config_ = {}
     # Maps PSMove serial (as string) to PSMoveController instance.
     self.serial_to_controller_ = {}
+    # The serials in serial_to_controller_, for the discovery thread to read. Replaced rather
+    # than modified, so the thread always sees a consistent set.
+    self.controller_serials_ = frozenset()
     # Set of serials for which we already attempted USB pairing. This is kept so that we don't
-    # attempt to pair any controller more than once.
+    # attempt to pair any controller more than once while it stays plugged in. Only used by the
+    # discovery thread.
     self.paired_usb_serials_ = set()
-    self.task_ = task.LoopingCall(self.connect_loop_)
-    self.task_.start(PSMOVE_CONNECT_INTERVAL)
+    self.running = True
+    self.wakeup = threading.Event()
+    self.thread = threading.Thread(target=self.discovery_loop_thread_, name='psmove discovery')
+    self.thread.daemon = True
+    self.thread.start()
+    self.reactor.addSystemEventTrigger('before', 'shutdown', self.before_shutdown_)
+    self.poll_stats_task_ = task.LoopingCall(self.log_poll_stats_)
+    self.poll_stats_task_.clock = reactor
+    self.poll_stats_task_.start(poll_stats_log_interval_seconds, now=False)
+
+  def before_shutdown_(self):
+    self.running = False
+    self.wakeup.set()
+    self.thread.join(SHUTDOWN_TIMEOUT_SECONDS)
+
+  def discovery_loop_thread_(self):
+    while True:
+      # Clear before scanning rather than after waiting, so that a wake-up which arrives during the
+      # scan or the wait is never lost. running is set before the wake-up at shutdown, so it must
+      # be checked after clearing.
+      self.wakeup.clear()
+      if not self.running:
+        break
+      try:
+        connected_serials, ready_moves = self.scan_()
+      except Exception:
+        logging.exception('Error scanning for PSMoves')
+      else:
+        self.reactor.callFromThread(self.on_scan_, connected_serials, ready_moves)
+      if self.unconnected_configs_:
+        interval = self.fast_scan_interval_seconds
+      else:
+        interval = self.slow_scan_interval_seconds
+      self.wakeup.wait(interval)
 
-  def connect_loop_(self):
+  def scan_(self):
+    """Finds connected Moves. Called on the discovery thread.
+
+    Returns:
+      A tuple (connected serials, ready moves). ready moves is a list of (serial, move) for
+      Bluetooth Moves without a controller which have calibration and orientation enabled.
+    """
     connection_count = psmove.count_connected()
     connected_serials = set()
+    ready_moves = []
     logging.debug('Connected Moves: %d', connection_count)
     for psmove_id in xrange(connection_count):
       move = psmove.PSMove(psmove_id)
@@ -43,13 +122,15 @@ class PSMoveConnectionManager(object):
         self.pair_move_(serial, move)
         del move
       elif (move.connection_type == psmove.Conn_Bluetooth and
-          serial not in self.serial_to_controller_ and
-          self.unconnected_configs_):
-        self.connect_move_(serial, move)
+          serial not in self.controller_serials_ and
+          self.unconnected_configs_ and
+          self.check_move_(serial, move)):
+        ready_moves.append((serial, move))
       else:
         del move
-
-    self.remove_disconnected_controllers_(connected_serials)
+    # Moves which were unplugged are paired again if they are plugged back in.
+    self.paired_usb_serials_ &= connected_serials
+    return connected_serials, ready_moves
 
   def pair_move_(self, serial, move):
     """Pairs a USB Move so that it may be connected via Bluetooth.
@@ -64,33 +145,62 @@ class PSMoveConnectionManager(object):
     move.update_leds()
     self.paired_usb_serials_.add(serial)
 
-  def connect_move_(self, serial, move):
-    """Connects a Bluetooth Move by creating a PSMoveController instance for it."""
+  def check_move_(self, serial, move):
+    """Returns whether a Bluetooth Move is ready to be used by a PSMoveController."""
     move.enable_orientation(True)
     has_calibration = move.has_calibration()
     has_orientation = move.has_orientation()
     if has_calibration and has_orientation:
-      config = self.unconnected_configs_.pop()
-      logging.info('Connecting move: %s config: %s', serial, config)
-      searchlights = [self.name_to_searchlight_[s] for s in config['searchlight_names']]
-      self.serial_to_config_[serial] = config
-      self.serial_to_controller_[serial] = psmove_controller.PSMoveController(
-          self.reactor, move, serial, searchlights, config['color_rgb'])
-    else:
-      logging.error('Unable to connect move: %s - missing calibration (%d) or orientation (%d)',
-                    serial, has_calibration, has_orientation)
-      # Turn LEDs red to signify connection error.
-      move.set_leds(255, 0, 0)
-      move.update_leds()
+      return True
+    logging.error('Unable to connect move: %s - missing calibration (%d) or orientation (%d)',
+                  serial, has_calibration, has_orientation)
+    # Turn LEDs red to signify connection error.
+    move.set_leds(255, 0, 0)
+    move.update_leds()
+    return False
+
+  def on_scan_(self, connected_serials, ready_moves):
+    """Connects and disconnects controllers after a scan. Called on the reactor thread."""
+    for serial, move in ready_moves:
+      if serial not in self.serial_to_controller_ and self.unconnected_configs_:
+        self.connect_move_(serial, move)
+      else:
+        del move
+    self.remove_disconnected_controllers_(connected_serials)
+    self.controller_serials_ = frozenset(self.serial_to_controller_)
+
+  def connect_move_(self, serial, move):
+    """Connects a Bluetooth Move by creating a PSMoveController instance for it."""
+    config = self.unconnected_configs_.pop()
+    logging.info('Connecting move: %s config: %s', serial, config)
+    searchlights = [self.name_to_searchlight_[s] for s in config['searchlight_names']]
+    # The rest of the config is passed on to the controller.
+    controller_args = dict(
+        (key, value) for key, value in config.iteritems() if key != 'searchlight_names')
+    self.serial_to_config_[serial] = config
+    self.serial_to_controller_[serial] = psmove_controller.PSMoveController(
+        self.reactor, self.poller, move, serial, searchlights, **controller_args)
 
   def remove_disconnected_controllers_(self, connected_serials):
     missing_serials = [s for s in self.serial_to_controller_ if s not in connected_serials]
     for serial in missing_serials:
       logging.info('PSMove with serial %s went missing.', serial)
-      self.paired_usb_serials_.discard(serial)
       self.unconnected_configs_.append(self.serial_to_config_.pop(serial))
       controller = self.serial_to_controller_.pop(serial)
       controller.disconnect()
+    if missing_serials:
+      # Look for replacements at the fast rate straight away.
+      self.wakeup.set()
+
+  def get_poll_stats(self):
+    """Returns a dict mapping serial to poll statistics for each connected controller."""
+    return dict((serial, controller.get_poll_stats())
+                for serial, controller in self.serial_to_controller_.iteritems())
+
+  def log_poll_stats_(self):
+    for serial, stats in sorted(self.get_poll_stats().iteritems()):
+      logging.info('PSMove %s: %d polls (%.1f/s), %d reports (%.1f/s)', serial, stats['polls'],
+                   stats['polls_per_second'], stats['reports'], stats['reports_per_second'])
 
   def debug_connection_type_(self, move):
     if move.connection_type == psmove.Conn_USB:
@@ -0,0 +1,286 @@
+"""Tests for psmove_connection_manager."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import Queue
+import threading
+import unittest
+
+from twisted.internet import task
+
+try:
+  import psmove_connection_manager
+except ImportError:
+  # The psmove bindings are built from the PS Move API, and may not be installed.
+  psmove_connection_manager = None
+
+# How long to wait for the discovery thread before failing a test.
+TIMEOUT_SECONDS = 5
+# Long enough that a scan only happens in a test when the discovery thread is woken up.
+NEVER_SECONDS = 60
+
+CONN_USB = 0
+CONN_BLUETOOTH = 1
+
+
+class FakeReactor(task.Clock):
+
+  def __init__(self):
+    task.Clock.__init__(self)
+    self.shutdown_triggers = []
+    # Functions passed to callFromThread, for the test to run on its own thread.
+    self.thread_calls = Queue.Queue()
+
+  def addSystemEventTrigger(self, phase, event_type, callable):
+    self.shutdown_triggers.append(callable)
+
+  def callFromThread(self, function, *args):
+    self.thread_calls.put((function, args))
+
+  def run_thread_call(self):
+    function, args = self.thread_calls.get(timeout=TIMEOUT_SECONDS)
+    function(*args)
+
+  def shutdown(self):
+    for trigger in reversed(self.shutdown_triggers):
+      trigger()
+
+
+class FakeMove(object):
+
+  def __init__(self, serial, connection_type, has_calibration=True):
+    self.serial = serial
+    self.connection_type = connection_type
+    self.calibration = has_calibration
+    self.paired = False
+    self.orientation_enabled = False
+    self.leds = None
+
+  def get_serial(self):
+    return self.serial
+
+  def pair(self):
+    self.paired = True
+
+  def set_leds(self, r, g, b):
+    self.leds = (r, g, b)
+
+  def update_leds(self):
+    pass
+
+  def enable_orientation(self, enabled):
+    self.orientation_enabled = enabled
+
+  def has_calibration(self):
+    return self.calibration
+
+  def has_orientation(self):
+    return self.orientation_enabled
+
+
+class FakePsmoveModule(object):
+  """Stands in for the psmove module, with the Moves the test has connected."""
+  Conn_USB = CONN_USB
+  Conn_Bluetooth = CONN_BLUETOOTH
+
+  def __init__(self):
+    self.moves = []
+    # Receives None as each scan starts.
+    self.scans = Queue.Queue()
+    # Scans wait for this, so a test can keep one in progress.
+    self.scan_gate = threading.Event()
+    self.scan_gate.set()
+
+  def count_connected(self):
+    self.scans.put(None)
+    self.scan_gate.wait()
+    return len(self.moves)
+
+  def PSMove(self, psmove_id):
+    return self.moves[psmove_id]
+
+
+class FakePSMoveController(object):
+
+  def __init__(self, reactor, poller, move, serial, searchlights, **kwargs):
+    self.move = move
+    self.serial = serial
+    self.searchlights = searchlights
+    self.kwargs = kwargs
+    self.disconnected = False
+
+  def disconnect(self):
+    self.disconnected = True
+
+
+class FakePsmoveControllerModule(object):
+  PSMoveController = FakePSMoveController
+
+
+@unittest.skipIf(psmove_connection_manager is None, 'psmove is not installed')
+class PSMoveConnectionManagerTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.psmove = FakePsmoveModule()
+    self.original_modules = (
+        psmove_connection_manager.psmove, psmove_connection_manager.psmove_controller)
+    psmove_connection_manager.psmove = self.psmove
+    psmove_connection_manager.psmove_controller = FakePsmoveControllerModule()
+    self.reactor = FakeReactor()
+    self.configs = [
+        {'searchlight_names': ['1'], 'color_rgb': (255, 0, 0)},
+        {'searchlight_names': ['2'], 'color_rgb': (0, 0, 255)},
+    ]
+    self.name_to_searchlight = {'1': object(), '2': object()}
+
+  def tearDown(self):
+    self.reactor.shutdown()
+    psmove_connection_manager.psmove, psmove_connection_manager.psmove_controller = (
+        self.original_modules)
+
+  def create_manager(self):
+    return psmove_connection_manager.PSMoveConnectionManager(
+        self.reactor, self.configs, self.name_to_searchlight,
+        fast_scan_interval_seconds=NEVER_SECONDS, slow_scan_interval_seconds=NEVER_SECONDS)
+
+  def wait_for_scan(self):
+    self.psmove.scans.get(timeout=TIMEOUT_SECONDS)
+
+
+class ScanTest(PSMoveConnectionManagerTestCase):
+  """Calls the discovery thread's methods directly, once the thread has stopped."""
+
+  def setUp(self):
+    PSMoveConnectionManagerTestCase.setUp(self)
+    self.manager = self.create_manager()
+    self.manager.before_shutdown_()
+    self.assertFalse(self.manager.thread.is_alive())
+
+  def test_pairs_usb_move_once(self):
+    move = FakeMove('usb', CONN_USB)
+    self.psmove.moves = [move]
+    self.assertEqual((set(['usb']), []), self.manager.scan_())
+    self.assertTrue(move.paired)
+    self.assertEqual((0, 255, 0), move.leds)
+    move.paired = False
+    self.manager.scan_()
+    self.assertFalse(move.paired)
+
+  def test_pairs_usb_move_again_when_plugged_back_in(self):
+    move = FakeMove('usb', CONN_USB)
+    self.psmove.moves = [move]
+    self.manager.scan_()
+    self.psmove.moves = []
+    self.assertEqual((set(), []), self.manager.scan_())
+    move.paired = False
+    self.psmove.moves = [move]
+    self.manager.scan_()
+    self.assertTrue(move.paired)
+
+  def test_ready_bluetooth_move(self):
+    move = FakeMove('bt', CONN_BLUETOOTH)
+    self.psmove.moves = [move]
+    self.assertEqual((set(['bt']), [('bt', move)]), self.manager.scan_())
+    self.assertTrue(move.orientation_enabled)
+
+  def test_bluetooth_move_without_calibration(self):
+    move = FakeMove('bt', CONN_BLUETOOTH, has_calibration=False)
+    self.psmove.moves = [move]
+    self.assertEqual((set(['bt']), []), self.manager.scan_())
+    self.assertEqual((255, 0, 0), move.leds)
+
+  def test_connected_move_is_not_ready_again(self):
+    move = FakeMove('bt', CONN_BLUETOOTH)
+    self.psmove.moves = [move]
+    self.manager.on_scan_(*self.manager.scan_())
+    self.assertEqual((set(['bt']), []), self.manager.scan_())
+
+  def test_no_ready_moves_once_every_config_is_assigned(self):
+    self.psmove.moves = [FakeMove('bt1', CONN_BLUETOOTH), FakeMove('bt2', CONN_BLUETOOTH)]
+    self.manager.on_scan_(*self.manager.scan_())
+    move = FakeMove('bt3', CONN_BLUETOOTH)
+    self.psmove.moves.append(move)
+    self.assertEqual((set(['bt1', 'bt2', 'bt3']), []), self.manager.scan_())
+    self.assertFalse(move.orientation_enabled)
+
+  def test_connects_ready_moves(self):
+    moves = [FakeMove('bt1', CONN_BLUETOOTH), FakeMove('bt2', CONN_BLUETOOTH)]
+    self.manager.on_scan_(set(['bt1', 'bt2']), [('bt1', moves[0]), ('bt2', moves[1])])
+    self.assertEqual([], self.manager.unconnected_configs_)
+    self.assertEqual(frozenset(['bt1', 'bt2']), self.manager.controller_serials_)
+    controllers = [self.manager.serial_to_controller_[serial] for serial in ('bt1', 'bt2')]
+    self.assertEqual(moves, [controller.move for controller in controllers])
+    self.assertEqual(
+        [{'color_rgb': (0, 0, 255)}, {'color_rgb': (255, 0, 0)}],
+        [controller.kwargs for controller in controllers])
+    self.assertEqual(
+        [[self.name_to_searchlight['2']], [self.name_to_searchlight['1']]],
+        [controller.searchlights for controller in controllers])
+
+  def test_ignores_ready_moves_beyond_configs(self):
+    moves = [FakeMove('bt%d' % index, CONN_BLUETOOTH) for index in xrange(3)]
+    self.manager.on_scan_(
+        set(move.serial for move in moves), [(move.serial, move) for move in moves])
+    self.assertEqual(frozenset(['bt0', 'bt1']), self.manager.controller_serials_)
+
+  def test_removes_missing_controller(self):
+    move = FakeMove('bt', CONN_BLUETOOTH)
+    self.manager.on_scan_(set(['bt']), [('bt', move)])
+    controller = self.manager.serial_to_controller_['bt']
+    self.manager.wakeup.clear()
+    self.manager.on_scan_(set(), [])
+    self.assertTrue(controller.disconnected)
+    self.assertEqual({}, self.manager.serial_to_controller_)
+    self.assertEqual(frozenset(), self.manager.controller_serials_)
+    self.assertEqual(2, len(self.manager.unconnected_configs_))
+    # The discovery thread is woken up to look for a replacement.
+    self.assertTrue(self.manager.wakeup.is_set())
+
+
+class DiscoveryThreadTest(PSMoveConnectionManagerTestCase):
+
+  def test_reports_scan_to_reactor(self):
+    self.psmove.moves = [FakeMove('bt', CONN_BLUETOOTH)]
+    manager = self.create_manager()
+    self.reactor.run_thread_call()
+    self.assertEqual(frozenset(['bt']), manager.controller_serials_)
+
+  def test_wakeup_starts_scan(self):
+    manager = self.create_manager()
+    self.wait_for_scan()
+    manager.wakeup.set()
+    self.wait_for_scan()
+
+  def test_wakeup_during_scan_is_not_lost(self):
+    manager = self.create_manager()
+    self.wait_for_scan()
+    self.psmove.scan_gate.clear()
+    manager.wakeup.set()
+    self.wait_for_scan()
+    # The second scan is in progress. Wake the thread again, as the reactor does when a
+    # controller goes missing, then let the scan finish.
+    manager.wakeup.set()
+    self.psmove.scan_gate.set()
+    self.wait_for_scan()
+
+  def test_removing_controller_starts_scan(self):
+    self.psmove.moves = [FakeMove('bt', CONN_BLUETOOTH)]
+    manager = self.create_manager()
+    self.wait_for_scan()
+    self.reactor.run_thread_call()
+    self.psmove.moves = []
+    manager.wakeup.set()
+    self.wait_for_scan()
+    self.reactor.run_thread_call()
+    self.assertEqual(frozenset(), manager.controller_serials_)
+    self.wait_for_scan()
+
+  def test_shutdown_wakes_thread(self):
+    manager = self.create_manager()
+    self.wait_for_scan()
+    manager.before_shutdown_()
+    self.assertFalse(manager.thread.is_alive())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,54 +2,111 @@ import logging
 import math
 import psmove
 import time
-import threading
 
-from twisted.internet import task
+from orientation_filter import OrientationFilter
 
-PSMOVE_CONTROL_LOOP_INTERVAL = 0
 RADIANS_TO_DEGREES = 57.2957795
 DEGREES_TO_RADIANS = 1 / RADIANS_TO_DEGREES
+# Searchlights are aimed from the latest orientation at most this often.
+DEFAULT_UPDATE_INTERVAL_SECONDS = 0.02
+# How often the command latency used for prediction is refreshed from the motor controllers.
+LATENCY_REFRESH_SECONDS = 1.0
 
 
 class PSMoveController(object):
   """Acts as an interface between a PSMove controller and searchlights."""
-  def __init__(self, reactor, move, serial, searchlights, color_rgb):
+  def __init__(self, reactor, poller, move, serial, searchlights, color_rgb,
+               update_interval_seconds=DEFAULT_UPDATE_INTERVAL_SECONDS, orientation_filter=None,
+               max_prediction_seconds=0):
     """Creates a PSMove controller.
 
     Args:
       reactor: The twisted.internet.reactor module.
+      poller: The psmove_poller.PSMovePoller which polls this controller.
       move: A PSMove instance.
       serial: The serial number of the move, as a string.
       searchlights: A list of searchlight.Searchlight instances that this controls.
       color_rgb: A tuple (red, green, blue) of color values to use for the LEDs on this controller.
+      update_interval_seconds: The minimum interval between aiming the searchlights. Orientations
+        polled in between replace one another, and only the latest is used.
+      orientation_filter: If set, keyword arguments for an orientation_filter.OrientationFilter
+        which smooths the orientation of this controller.
+      max_prediction_seconds: If positive, and orientation_filter is set, the searchlights are
+        aimed where the controller is expected to point when the motor commands take effect. This
+        is extrapolated from the filtered angular velocity over the measured command latency, but
+        never further ahead than this. Prediction assumes setpoints are streamed straight to the
+        motor controllers. It does not account for the lag of a searchlight's motion engine, so
+        it shouldn't be used with searchlights which have one.
     """
     self.reactor = reactor
+    self.poller = poller
     self.move = move
     self.serial = serial
     self.searchlights = searchlights
+    self.update_interval_seconds = update_interval_seconds
+    self.orientation_filter = None
+    if orientation_filter is not None:
+      self.orientation_filter = OrientationFilter(**orientation_filter)
+    self.max_prediction_seconds = max_prediction_seconds
+    if max_prediction_seconds > 0:
+      for searchlight in searchlights:
+        if searchlight.motion_engine:
+          logging.warning('PSMove %s predicts ahead for searchlight %s, but its motion engine '
+                          'adds lag which prediction does not account for.',
+                          serial, searchlight.name)
+    # The median command round trip of the searchlights' motor controllers, refreshed every
+    # LATENCY_REFRESH_SECONDS.
+    self.command_latency_seconds = 0
+    self.latency_refresh_time = 0
+    # The poller thread hands orientations to the reactor thread through latest_angles, which holds
+    # the most recent (azimuth, elevation, azimuth velocity, elevation velocity, sample time) not
+    # yet applied, or None. Replacing it is atomic, so no
+    # lock is needed. update_pending is True from when the poller thread asks the reactor to apply
+    # it until the reactor does so, so at most one update is queued on the reactor at a time.
+    self.latest_angles = None
+    self.update_pending = False
+    self.last_update_time = 0
+    # The number of polls, and how many of them returned a new sensor report, since
+    # stats_start_time.
+    self.poll_count = 0
+    self.report_count = 0
+    self.stats_start_time = time.time()
     self.set_orientation_enabled_(False)
     self.reactor.addSystemEventTrigger('before', 'shutdown', self.before_shutdown_)
-    self.running = True
-    self.thread = threading.Thread(target=self.control_loop_thread_)
-    self.thread.start()
+    self.poller.add_controller(self)
 
   def disconnect(self):
-    self.running = False
-    self.thread.join()
+    self.poller.remove_controller(self)
     del self.move
     self.move = None
 
-  def control_loop_thread_(self):
-    while self.running:
-      self.control_loop_()
-
-  def control_loop_(self):
-    """Main control loop which gets orientation and sends commands."""
+  def get_poll_stats(self):
+    """Returns a dict of poll statistics since the last call."""
+    # The counters are incremented on the poller thread, which holds the lock while polling.
+    with self.poller.lock:
+      now = time.time()
+      poll_count, self.poll_count = self.poll_count, 0
+      report_count, self.report_count = self.report_count, 0
+      elapsed = now - self.stats_start_time
+      self.stats_start_time = now
+    return {
+        'polls': poll_count,
+        'reports': report_count,
+        'polls_per_second': poll_count / elapsed if elapsed else 0,
+        'reports_per_second': report_count / elapsed if elapsed else 0,
+    }
+
+  def poll(self):
+    """Gets orientation and sends commands. Called by the poller thread."""
+    self.poll_count += 1
     if self.move.poll():
+      self.report_count += 1
       pressed, released = self.move.get_button_events()
       if pressed & psmove.Btn_START:
         logging.info('Resetting PSMove %s orientation.', self.serial)
         self.move.reset_orientation()
+        if self.orientation_filter:
+          self.orientation_filter.reset()
         self.set_orientation_enabled_(True)
 
       if pressed & psmove.Btn_SELECT:
@@ -58,18 +115,18 @@ class PSMoveController(object):
       if self.orientation_enabled:
         self.update_searchlight_from_orientation_()
 
-    # This must be called periodically to keep the LEDs on, even if we do not change the values.
-    self.update_leds_()
-
   def before_shutdown_(self):
     if self.move:
       self.disconnect()
 
   def set_orientation_enabled_(self, orientation_enabled):
     self.orientation_enabled = orientation_enabled
-    self.update_leds_()
+    self.update_leds()
 
-  def update_leds_(self):
+  def update_leds(self):
+    """Sets the LED color. This must be called periodically to keep the LEDs on, even if we do not
+    change the values. Called by the poller thread.
+    """
     # For some unknown reason, if you always tell the move to change to a single color, it doesn't
     # work. (Even if you turn off rate limiting). It seems that you need to make gradual changes
     # to the color over time to make it stick. That doesn't seem right, so I must be missing
@@ -104,13 +161,51 @@ class PSMoveController(object):
                              1 - 2 * qx * qx - 2 * qz * qz)
     # print 'az %.2f el %.2f roll %.2f' % (
     #     azimuth * 57.2957795, elevation * 57.2957795, roll * 57.2957795)
+    sample_time = time.time()
+    azimuth_velocity = elevation_velocity = 0
+    if self.orientation_filter:
+      azimuth, elevation, azimuth_velocity, elevation_velocity = self.orientation_filter.filter(
+          azimuth, elevation, sample_time)
+    # The slot must be written before update_pending is checked. See apply_latest_angles_.
+    self.latest_angles = (azimuth, elevation, azimuth_velocity, elevation_velocity, sample_time)
+    if not self.update_pending:
+      self.update_pending = True
+      self.reactor.callFromThread(self.schedule_update_)
+
+  def schedule_update_(self):
+    delay = self.last_update_time + self.update_interval_seconds - self.reactor.seconds()
+    self.reactor.callLater(max(delay, 0), self.apply_latest_angles_)
+
+  def apply_latest_angles_(self):
+    # Clear update_pending before taking the angles: orientations which arrive after this either
+    # are taken now, or schedule another update.
+    self.update_pending = False
+    self.last_update_time = self.reactor.seconds()
+    angles, self.latest_angles = self.latest_angles, None
+    if not angles:
+      return
+    azimuth, elevation, azimuth_velocity, elevation_velocity, sample_time = angles
+    if self.orientation_filter and self.max_prediction_seconds > 0:
+      lookahead = min(self.get_command_latency_() + self.last_update_time - sample_time,
+                      self.max_prediction_seconds)
+      azimuth += azimuth_velocity * lookahead
+      elevation += elevation_velocity * lookahead
     min_elevation = -1
     for searchlight in self.searchlights:
       min_elevation = max(min_elevation, searchlight.config.elevation_lower_bound)
     min_elevation = clamp_and_scale(min_elevation, -1, 1, 0, 90 * DEGREES_TO_RADIANS)
     if elevation < min_elevation:
       elevation = min_elevation
-    self.reactor.callFromThread(self.target_angle, azimuth, elevation)
+    self.target_angle(azimuth, elevation)
+
+  def get_command_latency_(self):
+    now = self.reactor.seconds()
+    if now - self.latency_refresh_time >= LATENCY_REFRESH_SECONDS:
+      self.latency_refresh_time = now
+      latencies = [searchlight.motor_controller.get_stats()['latency_p50_seconds']
+                   for searchlight in self.searchlights]
+      self.command_latency_seconds = max([0] + [l for l in latencies if l is not None])
+    return self.command_latency_seconds
 
   def target_angle(self, azimuth, elevation):
     for searchlight in self.searchlights:
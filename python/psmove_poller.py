@@ -0,0 +1,80 @@
+"""Polls every connected PSMove controller from a single thread at a fixed rate."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import logging
+import threading
+import time
+
+# The Move sends sensor reports at about this interval over Bluetooth, so polling faster than this
+# finds nothing new.
+DEFAULT_POLL_INTERVAL_SECONDS = 0.005
+# The LEDs must be refreshed periodically to stay on, but don't need to be refreshed on every poll.
+DEFAULT_LED_INTERVAL_SECONDS = 0.1
+
+
+class PSMovePoller(object):
+  """Services all PSMoveControllers from one thread.
+
+  Each pass over the controllers polls every Move once, and refreshes the LEDs of every Move if
+  led_interval_seconds has passed since they were last refreshed. Passes start every
+  poll_interval_seconds, and the thread sleeps in between rather than spinning.
+  """
+
+  def __init__(self, reactor, poll_interval_seconds=DEFAULT_POLL_INTERVAL_SECONDS,
+               led_interval_seconds=DEFAULT_LED_INTERVAL_SECONDS):
+    """Initializes a PSMovePoller and starts its thread.
+
+    Args:
+      reactor: The twisted.internet.reactor module.
+      poll_interval_seconds: The interval between successive polls of each controller.
+      led_interval_seconds: The interval between successive LED refreshes of each controller.
+    """
+    self.poll_interval_seconds = poll_interval_seconds
+    self.led_interval_seconds = led_interval_seconds
+    # Held while the thread services the controllers, so that a controller is never removed (and
+    # its Move deleted) in the middle of a poll.
+    self.lock = threading.Lock()
+    self.controllers = []
+    self.running = True
+    self.thread = threading.Thread(target=self.poll_loop_thread_, name='psmove poller')
+    self.thread.daemon = True
+    self.thread.start()
+    reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+  def add_controller(self, controller):
+    with self.lock:
+      self.controllers.append(controller)
+
+  def remove_controller(self, controller):
+    """Stops polling a controller. Once this returns, the controller's Move is no longer used."""
+    with self.lock:
+      self.controllers.remove(controller)
+
+  def stop(self):
+    self.running = False
+    self.thread.join()
+
+  def poll_loop_thread_(self):
+    next_poll_time = time.time()
+    next_led_time = next_poll_time
+    while self.running:
+      with self.lock:
+        update_leds = next_poll_time >= next_led_time
+        for controller in self.controllers:
+          try:
+            controller.poll()
+            if update_leds:
+              controller.update_leds()
+          except Exception:
+            logging.exception('Error polling PSMove %s', controller.serial)
+      if update_leds:
+        next_led_time += self.led_interval_seconds
+      next_poll_time += self.poll_interval_seconds
+      now = time.time()
+      if next_poll_time > now:
+        time.sleep(next_poll_time - now)
+      else:
+        # Fell behind, perhaps because the machine was busy. Don't try to catch up with a burst.
+        next_poll_time = now
+        next_led_time = max(next_led_time, now)
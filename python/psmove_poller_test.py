@@ -0,0 +1,96 @@
+"""Tests for psmove_poller."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import time
+import unittest
+
+from psmove_poller import PSMovePoller
+
+# How long to wait for the poller thread before failing a test.
+TIMEOUT_SECONDS = 5
+
+
+class FakeReactor(object):
+
+  def __init__(self):
+    self.shutdown_triggers = []
+
+  def addSystemEventTrigger(self, phase, event_type, callable):
+    self.shutdown_triggers.append(callable)
+
+
+class FakeController(object):
+
+  def __init__(self, serial, poll_errors=0):
+    self.serial = serial
+    self.polls = 0
+    self.led_updates = 0
+    # The number of polls which raise an exception before polls start succeeding.
+    self.poll_errors = poll_errors
+
+  def poll(self):
+    self.polls += 1
+    if self.polls <= self.poll_errors:
+      raise IOError('Move went away')
+
+  def update_leds(self):
+    self.led_updates += 1
+
+
+class PSMovePollerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.reactor = FakeReactor()
+    self.poller = PSMovePoller(self.reactor, poll_interval_seconds=0.001, led_interval_seconds=0.1)
+
+  def tearDown(self):
+    if self.poller.thread.is_alive():
+      self.poller.stop()
+
+  def wait_for_polls(self, controller, polls):
+    deadline = time.time() + TIMEOUT_SECONDS
+    while controller.polls < polls:
+      self.assertLess(time.time(), deadline, 'Controller %s was not polled' % controller.serial)
+      time.sleep(0.001)
+
+  def test_polls_every_controller(self):
+    controllers = [FakeController('a'), FakeController('b')]
+    for controller in controllers:
+      self.poller.add_controller(controller)
+    for controller in controllers:
+      self.wait_for_polls(controller, 10)
+
+  def test_updates_leds_less_often_than_polling(self):
+    controller = FakeController('a')
+    self.poller.add_controller(controller)
+    self.wait_for_polls(controller, 50)
+    with self.poller.lock:
+      self.assertGreaterEqual(controller.led_updates, 1)
+      self.assertLessEqual(controller.led_updates, controller.polls / 2)
+
+  def test_error_does_not_stop_polling(self):
+    failing_controller = FakeController('a', poll_errors=3)
+    controller = FakeController('b')
+    self.poller.add_controller(failing_controller)
+    self.poller.add_controller(controller)
+    self.wait_for_polls(failing_controller, 10)
+    self.wait_for_polls(controller, 10)
+
+  def test_removed_controller_is_not_polled(self):
+    controller = FakeController('a')
+    self.poller.add_controller(controller)
+    self.wait_for_polls(controller, 5)
+    self.poller.remove_controller(controller)
+    polls = controller.polls
+    time.sleep(0.05)
+    self.assertEqual(polls, controller.polls)
+
+  def test_stops_at_shutdown(self):
+    self.assertEqual([self.poller.stop], self.reactor.shutdown_triggers)
+    self.reactor.shutdown_triggers[0]()
+    self.assertFalse(self.poller.thread.is_alive())
+
+
+if __name__ == '__main__':
+  unittest.main()
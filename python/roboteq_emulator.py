@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+"""Executable script which emulates a Roboteq motor controller on a pseudo-terminal.
+
+The emulator prints the path of the pseudo-terminal it opened (and optionally symlinks it to a
+fixed path). Point a searchlight's motor_controller serial_port at that path to exercise the real
+serial code path of MotorController without any hardware.
+
+Example usage:
+  ./roboteq_emulator.py --link /tmp/roboteq1 --reply_latency_ms 2 --drop_probability 0.01
+"""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import argparse
+import logging
+import os
+import random
+import tty
+
+from twisted.internet import abstract
+from twisted.internet import fdesc
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.protocols import basic
+
+import logging_common
+from motor_controller import COMMAND_SEPARATOR
+from motor_controller import SETPOINT_SCALE
+
+# Each byte on the serial line is a start bit, 8 data bits and a stop bit.
+BITS_PER_BYTE = 10
+# Simulated motor current, in tenths of an amp, while a motor is idle or moving.
+IDLE_MOTOR_AMPS = 5
+MOVING_MOTOR_AMPS = 80
+HEATSINK_TEMPERATURE = 30
+BATTERY_DECIVOLTS = 240
+
+
+class PtyTransport(abstract.FileDescriptor):
+  """A twisted transport which reads and writes the master side of a pseudo-terminal."""
+
+  def __init__(self, protocol, fd, reactor):
+    abstract.FileDescriptor.__init__(self, reactor)
+    self.fd = fd
+    fdesc.setNonBlocking(fd)
+    self.protocol = protocol
+    # FileDescriptor.write silently drops data unless the transport is connected.
+    self.connected = 1
+    self.protocol.makeConnection(self)
+    self.startReading()
+
+  def fileno(self):
+    return self.fd
+
+  def doRead(self):
+    return fdesc.readFromFD(self.fd, self.protocol.dataReceived)
+
+  def writeSomeData(self, data):
+    return fdesc.writeToFD(self.fd, data)
+
+
+class EmulatedMotor(object):
+  """A motor which slews towards its 'G' setpoint at a fixed rate."""
+
+  def __init__(self, reactor, slew_rate):
+    self.reactor = reactor
+    self.slew_rate = slew_rate
+    self.target = 0
+    self.position = 0.0
+    self.last_update_time = reactor.seconds()
+
+  def update_(self):
+    now = self.reactor.seconds()
+    max_step = self.slew_rate * (now - self.last_update_time)
+    self.last_update_time = now
+    error = self.target - self.position
+    if abs(error) <= max_step:
+      self.position = float(self.target)
+    else:
+      self.position += max_step if error > 0 else -max_step
+
+  def set_target(self, target):
+    self.update_()
+    self.target = target
+
+  def get_position(self):
+    self.update_()
+    return int(self.position)
+
+  def get_amps(self):
+    self.update_()
+    return MOVING_MOTOR_AMPS if int(self.position) != self.target else IDLE_MOTOR_AMPS
+
+
+class RoboteqEmulator(basic.LineOnlyReceiver):
+  """Speaks the Roboteq line protocol understood by motor_controller.MotorController.
+
+  Every received line is echoed back, followed by one reply per '_'-separated command. Bytes in
+  both directions are delayed as if they travelled over a serial line at baud_rate.
+  """
+
+  delimiter = '\r'
+
+  def __init__(self, reactor, num_channels, baud_rate, reply_latency, drop_probability,
+               garble_probability, slew_rate):
+    """Initializes a RoboteqEmulator.
+
+    Args:
+      reactor: The twisted.internet.reactor module.
+      num_channels: The number of emulated motors.
+      baud_rate: The emulated serial line speed, in bits per second.
+      reply_latency: Seconds the controller takes to process each command.
+      drop_probability: The probability that any single reply is never sent.
+      garble_probability: The probability that any single reply is corrupted.
+      slew_rate: The speed of the emulated motors, in setpoint units per second.
+    """
+    self.reactor = reactor
+    self.motors = [EmulatedMotor(reactor, slew_rate) for unused_i in xrange(num_channels)]
+    self.seconds_per_byte = float(BITS_PER_BYTE) / baud_rate
+    self.reply_latency = reply_latency
+    self.drop_probability = drop_probability
+    self.garble_probability = garble_probability
+    # Maps user flash variable to value.
+    self.user_variables = {}
+    # Times at which the emulated serial line becomes idle in each direction, and at which the
+    # controller finishes executing the commands it has received. Commands are executed one at a
+    # time, so replies always go out in order.
+    self.input_idle_time = 0
+    self.output_idle_time = 0
+    self.processing_idle_time = 0
+    self.lines_received = 0
+    self.replies_dropped = 0
+    self.replies_garbled = 0
+
+  def connectionMade(self):
+    logging.info('Emulator: connection made')
+
+  def lineReceived(self, line):
+    """Called whenever a line is received. Overrides basic.LineOnlyReceiver.lineReceived."""
+    if not line:
+      return
+    self.lines_received += 1
+    # The controller can't see the line until all of its bytes have arrived.
+    now = self.reactor.seconds()
+    self.input_idle_time = (
+        max(now, self.input_idle_time) + (len(line) + 1) * self.seconds_per_byte)
+    self.reactor.callLater(self.input_idle_time - now, self.process_line_, line)
+
+  def process_line_(self, line):
+    logging.debug('Emulator received: %s', line)
+    self.write_line_(line)
+    now = self.reactor.seconds()
+    for command in line.split(COMMAND_SEPARATOR):
+      self.processing_idle_time = max(now, self.processing_idle_time) + self.reply_latency
+      reply = self.execute_command_(command.strip())
+      if random.random() < self.drop_probability:
+        logging.debug('Emulator dropping reply %s to %s', reply, command)
+        self.replies_dropped += 1
+        continue
+      if random.random() < self.garble_probability:
+        reply = self.garble_(reply)
+        self.replies_garbled += 1
+      self.reactor.callLater(self.processing_idle_time - now, self.write_line_, reply)
+
+  def write_line_(self, line):
+    data = line + self.delimiter
+    now = self.reactor.seconds()
+    self.output_idle_time = max(now, self.output_idle_time) + len(data) * self.seconds_per_byte
+    self.reactor.callLater(self.output_idle_time - now, self.transport.write, data)
+
+  def garble_(self, reply):
+    i = random.randrange(len(reply))
+    return reply[:i] + chr(random.randrange(33, 127)) + reply[i + 1:]
+
+  def execute_command_(self, command):
+    """Returns the reply to a single command."""
+    parts = command.split()
+    if not parts:
+      return '-'
+    try:
+      name, args = parts[0], [int(arg) for arg in parts[1:]]
+    except ValueError:
+      return '-'
+    if name == '!G' and len(args) == 2 and self.valid_channel_(args[0]):
+      self.motors[args[0] - 1].set_target(max(-SETPOINT_SCALE, min(SETPOINT_SCALE, args[1])))
+      return '+'
+    elif name == '^EE' and len(args) == 2:
+      self.user_variables[args[0]] = args[1]
+      return '+'
+    elif name == '%eesav' and not args:
+      return '+'
+    elif name == '~ee' and len(args) == 1:
+      return 'EE=%d' % self.user_variables.get(args[0], 0)
+    elif name == '?C':
+      return self.query_motors_('C', args, lambda motor: motor.get_position())
+    elif name == '?A':
+      return self.query_motors_('A', args, lambda motor: motor.get_amps())
+    elif name == '?T':
+      return self.query_motors_('T', args, lambda motor: HEATSINK_TEMPERATURE)
+    elif name == '?V' and not args:
+      return 'V=%d' % BATTERY_DECIVOLTS
+    elif name == '?FF' and not args:
+      return 'FF=0'
+    return '-'
+
+  def query_motors_(self, name, args, get_value):
+    """Replies to a runtime query for one channel, or for all channels if none is given."""
+    if not args:
+      motors = self.motors
+    elif len(args) == 1 and self.valid_channel_(args[0]):
+      motors = [self.motors[args[0] - 1]]
+    else:
+      return '-'
+    return '%s=%s' % (name, ':'.join(str(get_value(motor)) for motor in motors))
+
+  def valid_channel_(self, channel):
+    return 1 <= channel <= len(self.motors)
+
+  def log_stats_(self):
+    logging.info('Emulator: %d lines received, %d replies dropped, %d replies garbled, '
+                 'positions %s', self.lines_received, self.replies_dropped, self.replies_garbled,
+                 [motor.get_position() for motor in self.motors])
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Emulates a Roboteq motor controller on a pseudo-terminal.')
+  parser.add_argument('--link', type=str,
+                      help='If set, symlinks the pseudo-terminal device to this path.')
+  parser.add_argument('--num_channels', type=int, default=2)
+  parser.add_argument('--baud_rate', type=int, default=115200)
+  parser.add_argument('--reply_latency_ms', type=float, default=1,
+                      help='Time taken to process each command.')
+  parser.add_argument('--drop_probability', type=float, default=0,
+                      help='Probability that a reply is never sent.')
+  parser.add_argument('--garble_probability', type=float, default=0,
+                      help='Probability that a reply is corrupted.')
+  parser.add_argument('--slew_rate', type=float, default=500,
+                      help='Motor speed, in setpoint units (out of 1000) per second.')
+  parser.add_argument('--stats_interval', type=float, default=10,
+                      help='Seconds between logging statistics. 0 disables.')
+  logging_common.add_logging_args(parser)
+  args = parser.parse_args()
+
+  logging_common.configure_logging_from_args(args)
+
+  master_fd, slave_fd = os.openpty()
+  # Stop the line discipline from translating carriage returns or echoing. The slave end is kept
+  # open so that the master doesn't see a hangup while no client is connected.
+  tty.setraw(slave_fd)
+  slave_path = os.ttyname(slave_fd)
+  if args.link:
+    if os.path.lexists(args.link):
+      os.remove(args.link)
+    os.symlink(slave_path, args.link)
+  logging.info('Emulating Roboteq controller on %s', args.link or slave_path)
+  print args.link or slave_path
+
+  emulator = RoboteqEmulator(
+      reactor, args.num_channels, args.baud_rate, args.reply_latency_ms / 1000.0,
+      args.drop_probability, args.garble_probability, args.slew_rate)
+  PtyTransport(emulator, master_fd, reactor)
+  if args.stats_interval:
+    task.LoopingCall(emulator.log_stats_).start(args.stats_interval)
+
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main()
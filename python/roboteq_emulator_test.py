@@ -0,0 +1,144 @@
+"""Tests for roboteq_emulator."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import os
+import tty
+import unittest
+
+from twisted.internet import task
+
+from motor_controller import MotorController
+from motor_telemetry import MotorTelemetry
+import roboteq_emulator
+from roboteq_emulator import PtyTransport
+from roboteq_emulator import RoboteqEmulator
+
+
+class FakeReactor(task.Clock):
+  """A task.Clock which also records the file descriptors it is asked to watch."""
+
+  def __init__(self):
+    task.Clock.__init__(self)
+    self.readers = set()
+    self.writers = set()
+
+  def addReader(self, reader):
+    self.readers.add(reader)
+
+  def removeReader(self, reader):
+    self.readers.discard(reader)
+
+  def addWriter(self, writer):
+    self.writers.add(writer)
+
+  def removeWriter(self, writer):
+    self.writers.discard(writer)
+
+
+class LoopbackTransport(object):
+  """Delivers everything written to it straight to another protocol."""
+
+  disconnecting = False
+
+  def __init__(self, peer):
+    self.peer = peer
+
+  def write(self, data):
+    self.peer.dataReceived(data)
+
+  def writeSequence(self, data):
+    self.write(''.join(data))
+
+
+def create_emulator(reactor, **kwargs):
+  args = dict(num_channels=2, baud_rate=115200, reply_latency=0.001, drop_probability=0,
+              garble_probability=0, slew_rate=500)
+  args.update(kwargs)
+  return RoboteqEmulator(reactor, **args)
+
+
+class PtyTransportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.master_fd, self.slave_fd = os.openpty()
+    tty.setraw(self.slave_fd)
+    self.reactor = FakeReactor()
+
+  def tearDown(self):
+    os.close(self.master_fd)
+    os.close(self.slave_fd)
+
+  def test_write_reaches_pty(self):
+    emulator = create_emulator(self.reactor)
+    transport = PtyTransport(emulator, self.master_fd, self.reactor)
+    self.assertIn(transport, self.reactor.readers)
+    emulator.lineReceived('?V')
+    self.reactor.pump([0.001] * 10)
+    self.assertIn(transport, self.reactor.writers)
+    transport.doWrite()
+    self.assertEqual('?V\r' + 'V=%d\r' % roboteq_emulator.BATTERY_DECIVOLTS,
+                     os.read(self.slave_fd, 1024))
+
+  def test_read_from_pty(self):
+    emulator = create_emulator(self.reactor)
+    transport = PtyTransport(emulator, self.master_fd, self.reactor)
+    os.write(self.slave_fd, '!G 1 100\r')
+    transport.doRead()
+    self.assertEqual(1, emulator.lines_received)
+
+
+class RoundTripTest(unittest.TestCase):
+  """Drives a MotorController against the emulator."""
+
+  def setUp(self):
+    self.clock = task.Clock()
+
+  def connect(self, controller, emulator):
+    controller.simulate = False
+    emulator.makeConnection(LoopbackTransport(controller))
+    controller.makeConnection(LoopbackTransport(emulator))
+
+  def test_setpoints_and_variables(self):
+    controller = MotorController(self.clock, '', 2, max_commands_in_flight=2)
+    emulator = create_emulator(self.clock)
+    self.connect(controller, emulator)
+    values = []
+    controller.go_multiple({1: 0.5, 2: -0.25})
+    controller.write_variable(3, 42)
+    controller.read_variable(3, values.append)
+    self.clock.pump([0.001] * 100)
+    self.assertEqual([42], values)
+    self.assertEqual({1: 500, 2: -250}, controller.last_acknowledged_setpoints)
+    self.assertEqual(0, controller.expired_count)
+    self.assertFalse(controller.in_flight)
+    self.assertEqual(4, emulator.lines_received)
+    self.clock.advance(10)
+    self.assertEqual([500, -250], [motor.get_position() for motor in emulator.motors])
+
+  def test_telemetry(self):
+    controller = MotorController(self.clock, '', 2)
+    emulator = create_emulator(self.clock)
+    self.connect(controller, emulator)
+    controller.go_multiple({1: 0.2, 2: 0.1})
+    telemetry = MotorTelemetry(self.clock, controller, 'test', interval_seconds=0.1)
+    self.clock.pump([0.01] * 100)
+    sample = telemetry.get_latest_sample()
+    self.assertEqual([200, 100], sample.encoder_counts)
+    self.assertEqual([roboteq_emulator.IDLE_MOTOR_AMPS / 10.0] * 2, sample.motor_amps)
+    self.assertEqual(0, sample.fault_flags)
+    self.assertEqual(0, telemetry.failed_poll_count)
+    telemetry.stop()
+
+  def test_dropped_replies_expire(self):
+    controller = MotorController(self.clock, '', 2, max_commands_in_flight=2)
+    emulator = create_emulator(self.clock, drop_probability=1)
+    self.connect(controller, emulator)
+    replies = []
+    controller.send_command('?V', callback=replies.append)
+    self.clock.pump([0.01] * 100)
+    self.assertEqual(['EXPIRED'], replies)
+
+
+if __name__ == '__main__':
+  unittest.main()
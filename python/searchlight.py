@@ -4,11 +4,15 @@ __author__ = 'Rob Gaunt (robgaunt@gmail.com)'
 import logging
 import math
 
+from motion_engine import MotionEngine
+from pattern_engine import PatternPlayer
+
 SEARCHLIGHT_NAME_ALL = "all"
 RADIANS_TO_DEGREES = 57.2957795
 DEGREES_TO_RADIANS = 1 / RADIANS_TO_DEGREES
 MAX_ELEVATION = 2000
 RADIUS_OF_EARTH_METERS = 6373000  # At 40 degrees latitude.
+METERS_PER_DEGREE_LATITUDE = RADIUS_OF_EARTH_METERS * DEGREES_TO_RADIANS
 
 # The motor controller channel which controls azimuth or elevation angle.
 AZIMUTH_CHANNEL = 1
@@ -60,38 +64,54 @@ def clamp_and_scale(value, min_value, max_value, scaled_min, scaled_max):
 class Searchlight(object):
   """Serves as the wiring between the OSC server and motor controller.
 
-  This registers OSC addresses with a txosc Receiver, and translates OSC commands to motor
+  This registers OSC commands with an osc_server.OscDispatcher, and translates OSC commands to motor
   controller commands.
 
-  All OSC addresses are of the form /<searchlight name>/<command>. Each searchlight registers for
-  addresses using both its name and the name "all". This makes it possible to send OSC commands
-  either to individual searchlights, or to all searchlights at the same time.
+  All OSC addresses are of the form /<searchlight name>/<command>. The dispatcher also routes
+  /all/<command> and /<group name>/<command> to each searchlight in the group. This makes it
+  possible to send OSC commands to individual searchlights, groups of them, or all of them at once.
   """
 
   def __init__(
-      self, motor_controller, osc_receiver, config_store, name, positioning_mode,
+      self, reactor, motor_controller, osc_dispatcher, config_store, name, positioning_mode,
       position=None, zero_position=None, target_grid=None, draw_grid=None,
-      direct_positioning=None, mirror_positioning=None):
+      direct_positioning=None, mirror_positioning=None, motion=None, patterns=None,
+      motion_scheduler=None):
     """Initializes a Searchlight.
 
     Args:
+      reactor: The twisted.internet.reactor module.
       motor_controller: An instance of motor_controller.MotorController.
-      osc_receiver: An instance of txosc.dispatch.Receiver.
-      config_store: An instance of searchlight_config.SearchlightConfigStore.
+      osc_dispatcher: An instance of osc_server.OscDispatcher.
+      config_store: An instance of searchlight_config.SearchlightConfigStore or
+        searchlight_config.WriteBehindConfigStore.
       name: The name of this searchlight. Used to identify which OSC endpoints it responds to.
       position: A latitude, longitude pair (in floating-point degrees) representing the position
         of the searchlight.
       zero_position: The position at which the searchlight points when the motor is at position
         zero.
       target_grid: A grid defined by upper_left, upper_right, lower_left positions.
+      motion: If set, keyword arguments for a motion_engine.MotionEngine which streams motor
+        positions at a fixed rate. Otherwise positions are sent to the motor controller directly.
+      patterns: Optional keyword arguments for the pattern_engine.PatternPlayer which plays
+        patterns started with the pattern OSC address.
+      motion_scheduler: An optional motion_engine.MotionScheduler shared by the motion engines of
+        searchlights which should move together.
     """
     assert name != SEARCHLIGHT_NAME_ALL, 'Name %s is reserved' % SEARCHLIGHT_NAME_ALL
     self.name = name
     self.motor_controller = motor_controller
-    self.osc_receiver = osc_receiver
+    self.osc_dispatcher = osc_dispatcher
+    self.motion_engine = None
+    if motion:
+      self.motion_engine = MotionEngine(
+          reactor, motor_controller, scheduler=motion_scheduler, **motion)
 
     self.config_store = config_store
     self.config = self.config_store.get_or_create_config_by_name(self.name)
+    self.pattern_player = PatternPlayer(reactor, self, ELEVATION_FACTOR, **(patterns or {}))
+    # The choreography.ShowScheduler which can move this searchlight, if any. Set by the scheduler.
+    self.show_scheduler = None
 
     # Add standard OSC callbacks.
     self.add_osc_callback('raw_elevation', self.osc_raw_elevation)
@@ -100,7 +120,8 @@ class Searchlight(object):
     self.add_osc_callback('azimuth_lower_limit', self.osc_azimuth_lower_limit)
     self.add_osc_callback('azimuth_upper_limit', self.osc_azimuth_upper_limit)
     self.add_osc_callback('limit_reset', self.osc_limit_reset)
-    self.osc_receiver.setFallback(self.osc_ignore)
+    self.add_osc_callback('pattern', self.osc_pattern)
+    self.add_osc_callback('pattern_stop', self.osc_pattern_stop)
 
     assert positioning_mode in SUPPORTED_POSITIONING_MODES, 'Invalid mode %s' % positioning_mode
     self.positioning_mode = positioning_mode
@@ -114,7 +135,16 @@ class Searchlight(object):
     if zero_position:
       self.zpos_lat, self.zpos_lon = zero_position
     if position and zero_position:
-      self.distance_to_zero = haversine(self.pos_lat, self.pos_lon, self.zpos_lat, self.zpos_lon)
+      # Targets are projected onto a flat east-north plane centered on the searchlight, which is
+      # accurate over the few kilometers a searchlight can reach.
+      self.meters_per_degree_lon = METERS_PER_DEGREE_LATITUDE * math.cos(
+          self.pos_lat * DEGREES_TO_RADIANS)
+      zero_east, zero_north = self.to_east_north_(self.zpos_lat, self.zpos_lon)
+      zero_distance = math.hypot(zero_east, zero_north)
+      assert zero_distance, 'position and zero_position must differ.'
+      # Unit vector pointing from the searchlight towards zero_position.
+      self.zero_east = zero_east / zero_distance
+      self.zero_north = zero_north / zero_distance
 
     # target_grid is needed if you want to map the OSC target grid to a real location, so we only
     # add the appropriate OSC callbacks if it is specified.
@@ -132,25 +162,30 @@ class Searchlight(object):
       # TouchOSC is a bit weird in that its grid control sends (y, x) instead of (x, y).
       self.add_osc_callback('draw_grid_yx', self.osc_draw_grid_yx)
 
+  def to_east_north_(self, latitude, longitude):
+    """Returns the position in meters east and north of the searchlight."""
+    return ((longitude - self.pos_lon) * self.meters_per_degree_lon,
+            (latitude - self.pos_lat) * METERS_PER_DEGREE_LATITUDE)
+
   def target_position(self, latitude, longitude, altitude):
     """Aims the searchlight to target given position, specified by coordinates and altitude."""
     assert self.pos_lat and self.zpos_lat, (
         'Must know position and zero_position to compute angles to target.')
-    a = haversine(self.zpos_lat, self.zpos_lon, latitude, longitude)
-    b = self.distance_to_zero
-    c = haversine(latitude, longitude, self.pos_lat, self.pos_lon)
-    # Calculate sign of rotation angle by determining whether target is to the left or right of a
-    # line drawn from position to zero_position.
-    rotation_sign = latitude - self.pos_lat - (longitude - self.pos_lon) * (
-        (self.zpos_lat - self.pos_lat) / (self.zpos_lon - self.pos_lon))
-    # Law of Cosines
-    rotation_angle = math.copysign(
-        math.acos((b ** 2 + c ** 2 - a ** 2) / (2 * b * c )), rotation_sign)
-    elevation_angle = math.atan(altitude / c)
+    east, north = self.to_east_north_(latitude, longitude)
+    # Rotate into a frame where 'forward' points at zero_position. Rotation angles are positive
+    # clockwise (looking down), towards 'right'.
+    forward = east * self.zero_east + north * self.zero_north
+    right = east * self.zero_north - north * self.zero_east
+    rotation_angle = math.atan2(right, forward)
+    elevation_angle = math.atan2(altitude, math.hypot(east, north))
     self.target_angle(rotation_angle, elevation_angle)
 
   def target_angle(self, azimuth, elevation):
     """Aims the searchlight at given azimuth and elevation angle, relative to zero."""
+    self.set_motor_positions(self.motor_positions_for_angle(azimuth, elevation))
+
+  def motor_positions_for_angle(self, azimuth, elevation):
+    """Returns a dict mapping channel to motor position, to aim at the given angles in radians."""
     azimuth_degrees = azimuth * RADIANS_TO_DEGREES
     elevation_degrees = elevation * RADIANS_TO_DEGREES
     logging.debug('target_angle: azimuth %s elevation %s', azimuth_degrees, elevation_degrees)
@@ -163,13 +198,11 @@ class Searchlight(object):
       azimuth_motor_position = clamp_and_scale(
           azimuth_motor_position, -1, 1,
           self.config.azimuth_lower_bound, self.config.azimuth_upper_bound)
-      self.motor_controller.go(AZIMUTH_CHANNEL, azimuth_motor_position)
       elevation_motor_position = clamp_and_scale(
           elevation_degrees, elevation_degrees_min, elevation_degrees_max, -1, 1)
       elevation_motor_position = clamp_and_scale(
           elevation_motor_position, -1, 1,
           self.config.elevation_lower_bound, self.config.elevation_upper_bound)
-      self.motor_controller.go(ELEVATION_CHANNEL, elevation_motor_position)
     elif self.positioning_mode == POSITIONING_MODE_MIRROR:
       azimuth_degrees_min, azimuth_degrees_max = self.mirror_positioning['azimuth_angle_bound']
       elevation_degrees_min, elevation_degrees_max = self.mirror_positioning['elevation_angle_bound']      
@@ -180,90 +213,93 @@ class Searchlight(object):
       azimuth_motor_position = clamp_and_scale(
           actual_azimuth_degrees / 2.0, azimuth_degrees_min, azimuth_degrees_max, 1, -1)
       # TODO(robgaunt): Azimuth motor position is inverted because the controllers aren't set up right.
-      self.motor_controller.go(AZIMUTH_CHANNEL, azimuth_motor_position)
       # TODO(robgaunt): This is wrong - we need to know the height that the searchlight sits above
       # the mirror in order to actually calculate this. But good enough for now.
       elevation_motor_position = clamp_and_scale(
           elevation_degrees, elevation_degrees_min, elevation_degrees_max, -1, 1)
-      self.motor_controller.go(ELEVATION_CHANNEL, elevation_motor_position)
     else:
       raise AssertionError('Invalid positioning mode.')
+    return {AZIMUTH_CHANNEL: azimuth_motor_position, ELEVATION_CHANNEL: elevation_motor_position}
 
-  def add_osc_callback(self, callback_name, callback):
-    self.osc_receiver.addCallback('/%s/%s' % (self.name, callback_name), callback)
-    self.osc_receiver.addCallback('/%s/%s' % (SEARCHLIGHT_NAME_ALL, callback_name), callback)
+  def set_motor_positions(self, channel_positions, stop_pattern=True, stop_show=True):
+    """Moves motors to the given positions, via the motion engine if there is one.
+
+    Args:
+      channel_positions: A dict mapping motor controller channel to position between -1 and 1.
+        All channels are sent on one command line so they move together.
+      stop_pattern: Whether to stop any pattern playing, so that it doesn't fight whatever else is
+        moving the searchlight. Only the pattern player itself passes False.
+      stop_show: Whether to stop any show playing on this searchlight, for the same reason. Only
+        the show scheduler itself passes False.
+    """
+    if stop_pattern:
+      self.pattern_player.stop()
+    if stop_show and self.show_scheduler:
+      self.show_scheduler.stop_for_searchlight(self.name)
+    if self.motion_engine:
+      self.motion_engine.set_targets(channel_positions)
+    else:
+      self.motor_controller.go_multiple(channel_positions)
 
-  def unwrap_osc(func):
-    """Decorator for all OSC handlers."""
-    def handler(self, message, address):
-      logging.debug('Searchlight %s received %s from %s', self.name, message, address)
-      func(self, *message.getValues())
-    return handler
+  def add_osc_callback(self, callback_name, callback):
+    """Registers an OSC handler, which is called with the message arguments."""
+    self.osc_dispatcher.add_searchlight_callback(self.name, callback_name, callback)
 
-  @unwrap_osc
   def osc_raw_elevation(self, value):
     assert 0 <= value and value <= 1, 'Invalid osc_raw_elevation value: %s' % value
     value = clamp_and_scale(
         value, 0, 1, self.config.elevation_lower_bound, self.config.elevation_upper_bound)
-    self.motor_controller.go(ELEVATION_CHANNEL, value)
+    self.set_motor_positions({ELEVATION_CHANNEL: value})
 
-  @unwrap_osc
   def osc_raw_azimuth(self, value):
     assert 0 <= value and value <= 1, 'Invalid osc_raw_azimuth value: %s' % value
     value = clamp_and_scale(
         value, 0, 1, self.config.azimuth_lower_bound, self.config.azimuth_upper_bound)
-    self.motor_controller.go(AZIMUTH_CHANNEL, value)
+    self.set_motor_positions({AZIMUTH_CHANNEL: value})
 
-  @unwrap_osc
   def osc_target_grid(self, y, x):
     assert 0 <= x and x <= 1, 'Invalid osc_target_grid x: %s' % x
     assert 0 <= y and y <= 1, 'Invalid osc_target_grid y: %s' % y
     self.last_target_lat, self.last_target_lon = self.target_grid.transform(x, y)
     self.target_position(self.last_target_lat, self.last_target_lon, self.last_elevation)
 
-  @unwrap_osc
   def osc_target_grid_elevation(self, elevation):
     assert 0 <= elevation and elevation <= 1, 'Invalid osc_target_grid_elevation: %s' % elevation
     self.last_elevation = elevation * MAX_ELEVATION
     self.target_position(self.last_target_lat, self.last_target_lon, self.last_elevation)
 
-  @unwrap_osc
   def osc_elevation_limit(self, value):
     assert 0 <= value and value <= 1, 'Invalid osc_elevation_limit value: %s' % value
     value = clamp_and_scale(value, 0, 1, -1, 1)
-    self.motor_controller.go(ELEVATION_CHANNEL, value)
+    self.set_motor_positions({ELEVATION_CHANNEL: value})
     self.config.elevation_lower_bound = value
     self.config_store.commit()
 
-  @unwrap_osc
   def osc_azimuth_lower_limit(self, value):
     assert 0 <= value and value <= 1, 'Invalid osc_azimuth_lower_limit value: %s' % value
     value = clamp_and_scale(value, 0, 1, -1, 1)
     if value > self.config.azimuth_upper_bound:
         value = self.config.azimuth_upper_bound
-    self.motor_controller.go(AZIMUTH_CHANNEL, value)
+    self.set_motor_positions({AZIMUTH_CHANNEL: value})
     self.config.azimuth_lower_bound = value
     self.config_store.commit()
 
-  @unwrap_osc
   def osc_azimuth_upper_limit(self, value):
     assert 0 <= value and value <= 1, 'Invalid osc_azimuth_upper_limit value: %s' % value
     value = clamp_and_scale(value, 0, 1, -1, 1)
     if value < self.config.azimuth_lower_bound:
         value = self.config.azimuth_lower_bound
-    self.motor_controller.go(AZIMUTH_CHANNEL, value)
+    self.set_motor_positions({AZIMUTH_CHANNEL: value})
     self.config.azimuth_upper_bound = value
     self.config_store.commit()
 
-  @unwrap_osc
   def osc_limit_reset(self, value):
     self.config.azimuth_lower_bound = -1
     self.config.azimuth_upper_bound = 1
     self.config.elevation_lower_bound = -1
     self.config.elevation_upper_bound = 1
     self.config_store.commit()
-    self.motor_controller.go(AZIMUTH_CHANNEL, 0)
-    self.motor_controller.go(ELEVATION_CHANNEL, 0)
+    self.set_motor_positions({AZIMUTH_CHANNEL: 0, ELEVATION_CHANNEL: 0})
 
   def _osc_draw_grid(self, x, y):
     # TODO(robgaunt): This be some magic.
@@ -272,13 +308,15 @@ class Searchlight(object):
     elevation_angle = math.atan(ELEVATION_FACTOR / math.sqrt(x * x + y * y))
     self.target_angle(azimuth_angle, elevation_angle)
 
-  @unwrap_osc
   def osc_draw_grid(self, x, y):
     self._osc_draw_grid(x, y)
 
-  @unwrap_osc
   def osc_draw_grid_yx(self, y, x):
     self._osc_draw_grid(x, y)
 
-  def osc_ignore(self, message, address):
-    pass
+  def osc_pattern(self, pattern_name, *params):
+    """Starts a server-side pattern. See pattern_engine.PatternPlayer.start for parameters."""
+    self.pattern_player.start(pattern_name, *params)
+
+  def osc_pattern_stop(self, *unused_values):
+    self.pattern_player.stop()
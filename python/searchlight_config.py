@@ -2,9 +2,15 @@
 
 __author__ = 'Rob Gaunt (robgaunt@gmail.com)'
 
+import logging
+import Queue
+import threading
+
 import storm.locals
 
 _TABLE_NAME = 'searchlight_config'
+# Configuration changes are written to the database at most this often.
+WRITE_DELAY_SECONDS = 1.0
 
 
 class SearchlightConfigStore(storm.locals.Store):
@@ -19,6 +25,19 @@ class SearchlightConfigStore(storm.locals.Store):
     )
   """ % _TABLE_NAME
 
+  def __init__(self, database, cache=None):
+    storm.locals.Store.__init__(self, database, cache)
+    # Functions called without arguments after each commit.
+    self.commit_callbacks = []
+
+  def add_commit_callback(self, callback):
+    self.commit_callbacks.append(callback)
+
+  def commit(self):
+    storm.locals.Store.commit(self)
+    for callback in self.commit_callbacks:
+      callback()
+
   def create_config_table(self):
     self.execute(self.DROP_TABLE_SQL)
     self.execute(self.CREATE_TABLE_SQL)
@@ -47,6 +66,117 @@ class SearchlightConfigStore(storm.locals.Store):
     return SearchlightConfigStore(database)
 
 
+class WriteBehindConfigStore(object):
+  """Keeps configuration changes in memory and writes them to the database on a separate thread.
+
+  Configs are loaded through a SearchlightConfigStore at startup. After that, changes to a
+  SearchlightConfig take effect as soon as its attributes are set. commit() only schedules a write:
+  any further commits within WRITE_DELAY_SECONDS are coalesced into the same write, which is done
+  by a background thread with its own store. Pending changes are written before the reactor shuts
+  down.
+
+  Storm stores may only be used from the thread that created them, so the writer thread is given a
+  snapshot of the config values rather than the SearchlightConfig objects.
+  """
+
+  def __init__(self, reactor, store, create_writer_store, write_delay_seconds=WRITE_DELAY_SECONDS):
+    """Initializes a WriteBehindConfigStore.
+
+    Args:
+      reactor: The twisted.internet.reactor module.
+      store: The SearchlightConfigStore which configs are loaded from.
+      create_writer_store: A function returning a new SearchlightConfigStore for the same
+        database. Called on the writer thread.
+      write_delay_seconds: The time to wait after a commit before writing.
+    """
+    self.reactor = reactor
+    self.store = store
+    self.write_delay_seconds = write_delay_seconds
+    self.configs = []
+    # Functions called without arguments after each commit, once the new values are in effect.
+    self.commit_callbacks = []
+    self.delayed_write_call = None
+    # Snapshots are lists of tuples of config values. None tells the writer thread to exit.
+    self.snapshot_queue = Queue.Queue()
+    self.writer_thread = threading.Thread(
+        target=self.writer_loop_, args=(create_writer_store,), name='config writer')
+    self.writer_thread.daemon = True
+    self.writer_thread.start()
+    self.reactor.addSystemEventTrigger('before', 'shutdown', self.before_shutdown_)
+
+  @classmethod
+  def create_with_sqlite_database(cls, reactor, database_path):
+    return cls(reactor, SearchlightConfigStore.create_with_sqlite_database(database_path),
+               lambda: SearchlightConfigStore.create_with_sqlite_database(database_path))
+
+  def get_or_create_config_by_name(self, name):
+    stored_config = self.store.get_or_create_config_by_name(name)
+    # Return a copy which isn't bound to the store. Storm reloads bound objects from the database
+    # after a commit, which would leave the reactor thread holding a lock that blocks the writer.
+    config = SearchlightConfig()
+    config.name = stored_config.name
+    config.azimuth_lower_bound = stored_config.azimuth_lower_bound
+    config.azimuth_upper_bound = stored_config.azimuth_upper_bound
+    config.elevation_lower_bound = stored_config.elevation_lower_bound
+    config.elevation_upper_bound = stored_config.elevation_upper_bound
+    # End the read transaction, so that it doesn't hold a lock that blocks the writer thread.
+    self.store.commit()
+    self.configs.append(config)
+    return config
+
+  def add_commit_callback(self, callback):
+    self.commit_callbacks.append(callback)
+
+  def commit(self):
+    """Schedules the current config values to be written to the database."""
+    if not self.delayed_write_call:
+      self.delayed_write_call = self.reactor.callLater(self.write_delay_seconds, self.write_)
+    for callback in self.commit_callbacks:
+      callback()
+
+  def write_(self):
+    self.delayed_write_call = None
+    self.snapshot_queue.put([
+        (config.name, config.azimuth_lower_bound, config.azimuth_upper_bound,
+         config.elevation_lower_bound, config.elevation_upper_bound)
+        for config in self.configs])
+
+  def before_shutdown_(self):
+    if self.delayed_write_call:
+      self.delayed_write_call.cancel()
+      self.write_()
+    self.snapshot_queue.put(None)
+    self.writer_thread.join()
+
+  def writer_loop_(self, create_writer_store):
+    store = create_writer_store()
+    running = True
+    while running:
+      snapshots = [self.snapshot_queue.get()]
+      while not self.snapshot_queue.empty():
+        snapshots.append(self.snapshot_queue.get())
+      if snapshots[-1] is None:
+        running = False
+        snapshots.pop()
+      if snapshots:
+        # Only the most recent snapshot needs to be written.
+        self.write_snapshot_(store, snapshots[-1])
+
+  def write_snapshot_(self, store, snapshot):
+    try:
+      for (name, azimuth_lower_bound, azimuth_upper_bound,
+           elevation_lower_bound, elevation_upper_bound) in snapshot:
+        config = store.get_or_create_config_by_name(name)
+        config.azimuth_lower_bound = azimuth_lower_bound
+        config.azimuth_upper_bound = azimuth_upper_bound
+        config.elevation_lower_bound = elevation_lower_bound
+        config.elevation_upper_bound = elevation_upper_bound
+      store.commit()
+    except Exception:
+      logging.exception('Failed to write searchlight configuration.')
+      store.rollback()
+
+
 class SearchlightConfig(object):
   __storm_table__ = 'searchlight_config'
   name = storm.locals.Unicode(primary=True)
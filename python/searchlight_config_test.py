@@ -0,0 +1,75 @@
+"""Tests for searchlight_config."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import task
+
+from searchlight_config import SearchlightConfigStore
+from searchlight_config import WriteBehindConfigStore
+
+
+class FakeReactor(task.Clock):
+
+  def __init__(self):
+    task.Clock.__init__(self)
+    self.shutdown_callbacks = []
+
+  def addSystemEventTrigger(self, phase, event_type, callback):
+    self.shutdown_callbacks.append(callback)
+
+  def shutdown(self):
+    for callback in self.shutdown_callbacks:
+      callback()
+
+
+class WriteBehindConfigStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'config.db')
+    store = SearchlightConfigStore.create_with_sqlite_database(self.path)
+    store.create_config_table()
+    store.commit()
+    self.reactor = FakeReactor()
+    self.config_store = WriteBehindConfigStore.create_with_sqlite_database(
+        self.reactor, self.path)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def read_config(self, name):
+    return SearchlightConfigStore.create_with_sqlite_database(self.path).get_config_by_name(name)
+
+  def test_commits_are_written_on_shutdown(self):
+    config = self.config_store.get_or_create_config_by_name('1')
+    config.azimuth_lower_bound = 0.25
+    self.config_store.commit()
+    self.reactor.shutdown()
+    self.assertEqual(0.25, self.read_config(u'1').azimuth_lower_bound)
+
+  def test_repeated_writes(self):
+    # Each write used to leave the reactor thread's store holding a lock which blocked the next.
+    config = self.config_store.get_or_create_config_by_name('1')
+    for value in (0.1, 0.2, 0.3):
+      config.azimuth_lower_bound = value
+      self.config_store.commit()
+      self.reactor.advance(self.config_store.write_delay_seconds)
+      self.assertEqual(1, config.azimuth_upper_bound)
+    self.reactor.shutdown()
+    self.assertEqual(0.3, self.read_config(u'1').azimuth_lower_bound)
+
+  def test_commit_callbacks(self):
+    calls = []
+    self.config_store.add_commit_callback(lambda: calls.append(True))
+    self.config_store.commit()
+    self.assertEqual([True], calls)
+    self.reactor.shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
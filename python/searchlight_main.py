@@ -10,16 +10,23 @@ __author__ = 'robgaunt@gmail.com (Rob Gaunt)'
 
 import argparse
 import logging
+import os
 import pprint
-from txosc import dispatch
 from twisted.internet import reactor
 import yaml
 
 from admin import admin_server
+from batch_targeting import AllTargetGrid
+from choreography import ShowScheduler
+from motion_engine import MotionScheduler
 from motor_controller import MotorController
+from motor_telemetry import MotorTelemetry
+from osc_feedback import FeedbackPublisher
+from osc_recording import OscRecorder
+from osc_recording import OscReplayer
 from psmove_connection_manager import PSMoveConnectionManager
 from searchlight import Searchlight
-from searchlight_config import SearchlightConfigStore
+from searchlight_config import WriteBehindConfigStore
 import logging_common
 import osc_server
 
@@ -29,6 +36,12 @@ def main():
       description='OSC server to control some number of searchlights.')
   parser.add_argument('--config_file', type=argparse.FileType(), required=True,
                       help='YAML config file specifying how the searchlights are set up.')
+  parser.add_argument('--record_osc_file', type=str,
+                      help='If set, appends every OSC datagram received to this file.')
+  parser.add_argument('--replay_osc_file', type=str,
+                      help='If set, replays the OSC datagrams recorded in this file on startup.')
+  parser.add_argument('--replay_speed', type=float, default=1.0,
+                      help='Speed multiplier for --replay_osc_file.')
   logging_common.add_logging_args(parser)
   args = parser.parse_args()
 
@@ -40,31 +53,64 @@ def main():
   if not config.get('configuration_database'):
     logging.error('Config file does not specify a searchlight configuration database.')
     return
-  config_store = SearchlightConfigStore.create_with_sqlite_database(
-      config.get('configuration_database'))
-
-  osc_receiver = dispatch.Receiver()
-  reactor.listenMulticast(
-      config['osc_server']['port'],
-      osc_server.MulticastDatagramServerProtocol(
-          osc_receiver, config['osc_server']['address']),
-      listenMultiple=True)
+  config_store = WriteBehindConfigStore.create_with_sqlite_database(
+      reactor, config.get('configuration_database'))
+
+  osc_dispatcher = osc_server.OscDispatcher(config.get('osc_groups'))
+  osc_recorder = None
+  if args.record_osc_file:
+    osc_recorder = OscRecorder(reactor, args.record_osc_file)
+  osc_handler = osc_server.OscDatagramHandler(reactor, osc_dispatcher, recorder=osc_recorder)
+  listener_configs = list(config.get('osc_listeners', []))
+  if config.get('osc_server'):
+    # The original multicast listener.
+    listener_configs.insert(0, dict(
+        transport=osc_server.LISTENER_TRANSPORT_MULTICAST, **config['osc_server']))
+  if not listener_configs:
+    logging.error('Config file specifies no OSC listeners.')
+    return
+  for listener_config in listener_configs:
+    osc_server.listen(reactor, osc_handler, **listener_config)
 
   if not config.get('searchlights'):
     logging.error('Config file specifies no searchlights.')
     return
 
   name_to_searchlight = {}
+  # Motion engines tick together, so that a bundle which moves several searchlights moves them on
+  # the same tick.
+  motion_scheduler = MotionScheduler(reactor)
   for config_values in config.get('searchlights'):
     motor_controller = MotorController(reactor, **config_values.pop('motor_controller'))
-    searchlight = Searchlight(motor_controller, osc_receiver, config_store, **config_values)
+    osc_dispatcher.add_bundle_callbacks(motor_controller.begin_batch, motor_controller.end_batch)
+    telemetry_config = config_values.pop('telemetry', None)
+    if telemetry_config is not None:
+      MotorTelemetry(reactor, motor_controller, config_values['name'], **telemetry_config)
+    searchlight = Searchlight(
+        reactor, motor_controller, osc_dispatcher, config_store,
+        motion_scheduler=motion_scheduler, **config_values)
     name_to_searchlight[searchlight.name] = searchlight
 
+  target_grid_searchlights = [
+      s for s in name_to_searchlight.itervalues() if hasattr(s, 'target_grid')]
+  if target_grid_searchlights:
+    AllTargetGrid(target_grid_searchlights, osc_dispatcher)
+  if config.get('choreography'):
+    # Show files are found relative to the config file, wherever the server is started from.
+    ShowScheduler(reactor, name_to_searchlight, osc_dispatcher,
+                  show_directory=os.path.dirname(os.path.abspath(args.config_file.name)),
+                  **config['choreography'])
+  osc_dispatcher.compile()
+
+  if config.get('feedback'):
+    FeedbackPublisher(reactor, osc_handler, name_to_searchlight.values(), **config['feedback'])
+
   psmove_connection_manager = None
   psmove_controller_configs = config.get('psmove_controllers', [])
   if psmove_controller_configs:
     psmove_connection_manager = PSMoveConnectionManager(
-        reactor, psmove_controller_configs, name_to_searchlight)
+        reactor, psmove_controller_configs, name_to_searchlight, config.get('psmove_poller'),
+        **config.get('psmove_discovery', {}))
 
   if not config.get('admin_server_port'):
     logging.error('Config file does not specify administration server port.')
@@ -73,6 +119,11 @@ def main():
       config.get('admin_server_port'),
       admin_server.AdminServer(name_to_searchlight.values()))
 
+  if args.replay_osc_file:
+    replayer = OscReplayer(
+        reactor, args.replay_osc_file, osc_handler.datagramReceived, speed=args.replay_speed)
+    reactor.callWhenRunning(replayer.start)
+
   reactor.run()
 
 
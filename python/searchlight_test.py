@@ -0,0 +1,94 @@
+"""Tests for searchlight."""
+
+__author__ = 'Rob Gaunt (robgaunt@gmail.com)'
+
+import math
+import unittest
+
+from twisted.internet import task
+
+from motor_controller import MotorController
+from osc_server import OscDispatcher
+from searchlight import haversine
+from searchlight import Searchlight
+from searchlight_config import SearchlightConfigStore
+
+# Searchlight 1 in configs/searchlights_1_2.yaml.
+POSITION = (40.79704, -119.19889)
+ZERO_POSITION = (40.78639, -119.20647)
+
+
+def create_searchlight(position, zero_position):
+  clock = task.Clock()
+  config_store = SearchlightConfigStore.create_with_sqlite_database(':memory:')
+  config_store.create_config_table()
+  return Searchlight(
+      clock, MotorController(clock, '', 2), OscDispatcher(), config_store, 'test',
+      positioning_mode='direct', position=position, zero_position=zero_position,
+      direct_positioning={'azimuth_angle_bound': [-90, 90], 'elevation_angle_bound': [0, 90]})
+
+
+def haversine_angles(position, zero_position, latitude, longitude, altitude):
+  """Returns (azimuth, elevation) as target_position computed them before the local frame."""
+  pos_lat, pos_lon = position
+  zpos_lat, zpos_lon = zero_position
+  a = haversine(zpos_lat, zpos_lon, latitude, longitude)
+  b = haversine(pos_lat, pos_lon, zpos_lat, zpos_lon)
+  c = haversine(latitude, longitude, pos_lat, pos_lon)
+  rotation_sign = latitude - pos_lat - (longitude - pos_lon) * (
+      (zpos_lat - pos_lat) / (zpos_lon - pos_lon))
+  rotation_angle = math.copysign(
+      math.acos((b ** 2 + c ** 2 - a ** 2) / (2 * b * c)), rotation_sign)
+  return rotation_angle, math.atan(altitude / c)
+
+
+class TargetPositionTest(unittest.TestCase):
+
+  def target_position(self, searchlight, latitude, longitude, altitude):
+    """Returns the angles target_position aims the searchlight at."""
+    angles = []
+    searchlight.target_angle = lambda azimuth, elevation: angles.append((azimuth, elevation))
+    searchlight.target_position(latitude, longitude, altitude)
+    return angles[0]
+
+  def test_matches_haversine_angles(self):
+    searchlight = create_searchlight(POSITION, ZERO_POSITION)
+    targets = [
+        (40.7900, -119.2100, 100),
+        (40.7800, -119.1900, 500),
+        (40.8050, -119.2000, 1000),
+        (40.7950, -119.2200, 50),
+    ]
+    tolerance = math.radians(0.01)
+    for latitude, longitude, altitude in targets:
+      azimuth, elevation = self.target_position(searchlight, latitude, longitude, altitude)
+      expected_azimuth, expected_elevation = haversine_angles(
+          POSITION, ZERO_POSITION, latitude, longitude, altitude)
+      self.assertAlmostEqual(expected_azimuth, azimuth, delta=tolerance)
+      self.assertAlmostEqual(expected_elevation, elevation, delta=tolerance)
+
+  def test_zero_position_is_zero_azimuth(self):
+    searchlight = create_searchlight(POSITION, ZERO_POSITION)
+    azimuth, unused_elevation = self.target_position(searchlight, *(ZERO_POSITION + (100,)))
+    self.assertAlmostEqual(0, azimuth)
+
+  def test_zero_position_due_north(self):
+    # The haversine code divided by zero here.
+    latitude, longitude = POSITION
+    searchlight = create_searchlight(POSITION, (latitude + 0.01, longitude))
+    azimuth, unused_elevation = self.target_position(searchlight, latitude, longitude + 0.01, 0)
+    self.assertAlmostEqual(math.pi / 2, azimuth)
+    azimuth, unused_elevation = self.target_position(searchlight, latitude, longitude - 0.01, 0)
+    self.assertAlmostEqual(-math.pi / 2, azimuth)
+
+  def test_elevation(self):
+    latitude, longitude = POSITION
+    searchlight = create_searchlight(POSITION, ZERO_POSITION)
+    distance = haversine(latitude, longitude, latitude + 0.01, longitude)
+    unused_azimuth, elevation = self.target_position(
+        searchlight, latitude + 0.01, longitude, distance)
+    self.assertAlmostEqual(math.pi / 4, elevation)
+
+
+if __name__ == '__main__':
+  unittest.main()